@@ -0,0 +1,200 @@
+import pickle
+import queue
+import socket
+import time
+import zmq
+from concurrent.futures import ThreadPoolExecutor
+from plico.utils.constants import Constants
+from plico.utils.logger import Logger
+from plico_io_server.utils.metrics import MetricsRegistry
+
+
+class AsyncRequestServer(object):
+    """Serve the RPC requests received on a ROUTER socket concurrently.
+    
+    The requests have the format sent by ZmqRemoteProcedureCall.sendRequest,
+    so plico clients are served unchanged. Each request is run by a pool of
+    worker threads and its reply is sent as soon as it completes, so that a
+    slow device command does not delay the requests received after it.
+    
+    The socket is only used by the thread of the control loop: the workers
+    queue their results and wake the loop up through a socket pair. When
+    maxInFlight requests are running the socket is no longer read, and the
+    new requests wait in the ZeroMQ queues until a slot is freed.
+    
+    Only the public methods of the target can be called: the requests for
+    other methods, and the malformed ones, get an exception as reply and
+    are recorded in the metrics under the 'unknown' method.
+    """
+    
+    DEFAULT_MAX_IN_FLIGHT = 16
+    # Label of the requests for methods the target does not expose, so
+    # that the clients cannot create any number of metrics
+    UNKNOWN_METHOD = 'unknown'
+    
+    def __init__(self, target, routerSocket, maxInFlight=DEFAULT_MAX_IN_FLIGHT, metrics=None):
+        """Create a server dispatching the requests to target.
+        
+        Parameters
+        ----------
+        target : object
+            Object whose methods are called by the requests
+        routerSocket : zmq.Socket
+            Bound ROUTER socket receiving the requests
+        maxInFlight : int, optional
+            Maximum number of requests running at the same time
+        metrics : MetricsRegistry, optional
+            Registry the RPC metrics are recorded in
+        """
+        self._target = target
+        self._socket = routerSocket
+        self._maxInFlight = max(1, maxInFlight)
+        self._logger = Logger.of('AsyncRequestServer')
+        self._executor = ThreadPoolExecutor(
+            max_workers=self._maxInFlight, thread_name_prefix='rpc')
+        self._completed = queue.SimpleQueue()
+        self._wakeUpReader, self._wakeUpWriter = socket.socketpair()
+        self._wakeUpReader.setblocking(False)
+        self._wakeUpWriter.setblocking(False)
+        self._loop = None
+        self._inFlight = 0
+        self._paused = False
+        
+        self._metrics = metrics if metrics is not None else MetricsRegistry()
+        self._methodMetrics = {}
+        self._inFlightGauge = self._metrics.gauge(
+            'rpc_in_flight', 'RPC requests being served')
+        self._inFlightGauge.setFunction(lambda: self._inFlight)
+        self._pauses = self._metrics.counter(
+            'rpc_backpressure_total', 'Times the in-flight limit stopped reading requests')
+    
+    def register(self, loop):
+        """Serve the requests from an EventDrivenControlLoop.
+        
+        Parameters
+        ----------
+        loop : EventDrivenControlLoop
+            Loop watching the request socket and the completed requests
+        """
+        self._loop = loop
+        loop.addReader(self._socket, self.handleRequests)
+        loop.addReader(self._wakeUpReader.fileno(), self.sendReplies)
+    
+    def handleRequests(self):
+        """Dispatch the pending requests to the workers, up to the in-flight limit."""
+        while self._inFlight < self._maxInFlight:
+            try:
+                frames = self._socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+            self._dispatch(frames)
+        
+        # Stop reading until a reply frees a slot
+        self._loop.removeReader(self._socket)
+        self._paused = True
+        self._pauses.inc()
+    
+    def _dispatch(self, frames):
+        receivedTime = time.perf_counter()
+        try:
+            # Routing envelope up to the empty delimiter, then method and arguments
+            delimiter = frames.index(b'')
+            envelope = frames[:delimiter + 1]
+            method = frames[delimiter + 1].decode()
+            args = pickle.loads(frames[delimiter + 2], encoding='latin1')
+        except Exception as e:
+            self._logger.error(f"Malformed request: {str(e)}")
+            self._replyMalformed(frames, e, receivedTime)
+            return
+        
+        label = self._methodLabel(method)
+        self._inFlight += 1
+        future = self._executor.submit(self._call, method, label, args)
+        future.add_done_callback(
+            lambda f: self._complete(envelope, label, receivedTime, f))
+    
+    def _replyMalformed(self, frames, error, receivedTime):
+        """Reply to a malformed request with an exception, through the identity frames it came with."""
+        envelope = frames[:frames.index(b'') + 1] if b'' in frames else frames[:1]
+        if envelope:
+            reply = pickle.dumps(ValueError(f"Malformed request: {str(error)}"),
+                                 Constants.PICKLE_PROTOCOL)
+            self._socket.send_multipart(envelope + [reply], zmq.NOBLOCK)
+        self._recordMetrics(self.UNKNOWN_METHOD, time.perf_counter() - receivedTime, True)
+    
+    def _methodLabel(self, method):
+        """Label of a method in the metrics, UNKNOWN_METHOD if the target does not expose it."""
+        if method in self._methodMetrics:
+            return method
+        if not method.startswith('_') and callable(getattr(self._target, method, None)):
+            return method
+        return self.UNKNOWN_METHOD
+    
+    def _call(self, method, label, args):
+        """Run a request in a worker thread, returning its result or exception."""
+        try:
+            if label == self.UNKNOWN_METHOD:
+                raise AttributeError(f"Unknown method {method}")
+            return getattr(self._target, method)(*args), False
+        except Exception as e:
+            self._logger.notice(
+                f"Request {method} {str(args)} failed. Caught {type(e)} {str(e)}")
+            return e, True
+    
+    def _complete(self, envelope, label, receivedTime, future):
+        """Queue the result of a request for the control loop, from a worker thread."""
+        try:
+            result, failed = future.result()
+        except BaseException as e:
+            result, failed = e, True
+        self._completed.put((envelope, label, receivedTime, result, failed))
+        try:
+            self._wakeUpWriter.send(b'\0')
+        except BlockingIOError:
+            # The loop has not consumed the previous wake-ups yet
+            pass
+    
+    def sendReplies(self):
+        """Send the replies of the completed requests."""
+        try:
+            while self._wakeUpReader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        
+        while True:
+            try:
+                envelope, label, receivedTime, result, failed = self._completed.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                reply = pickle.dumps(result, Constants.PICKLE_PROTOCOL)
+            except Exception as e:
+                reply = pickle.dumps(e, Constants.PICKLE_PROTOCOL)
+                failed = True
+            self._socket.send_multipart(envelope + [reply], zmq.NOBLOCK)
+            self._inFlight -= 1
+            self._recordMetrics(label, time.perf_counter() - receivedTime, failed)
+        
+        if self._paused and self._inFlight < self._maxInFlight:
+            self._paused = False
+            self._loop.addReader(self._socket, self.handleRequests)
+    
+    def _recordMetrics(self, label, latencySec, failed):
+        metrics = self._methodMetrics.get(label)
+        if metrics is None:
+            metrics = self._methodMetrics[label] = (
+                self._metrics.histogram(
+                    'rpc_latency_seconds', 'Time spent serving an RPC request', method=label),
+                self._metrics.counter(
+                    'rpc_errors_total', 'RPC requests that raised an exception', method=label))
+        metrics[0].observe(latencySec)
+        if failed:
+            metrics[1].inc()
+    
+    def close(self):
+        """Wait for the running requests, send their replies and release the workers."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self.sendReplies()
+        self._wakeUpReader.close()
+        self._wakeUpWriter.close()
@@ -1,10 +1,16 @@
 import time
 import json
+import threading
+import zmq
 from plico.utils.logger import Logger
 from plico.rpc.zmq_ports import ZmqPorts
 from plico.rpc.sockets import Sockets
 from plico.rpc.zmq_remote_procedure_call import ZmqRemoteProcedureCall
+from plico_io_server.controller.event_publisher import EventPublisher
+from plico_io_server.controller.status_worker import StatusWorker
 from plico_io_server.utils.constants import Constants
+from plico_io_server.utils.deadline import boundTimeout, deadlineAfter
+from plico_io_server.utils.metrics import MetricsRegistry
 from plico.utils.decorator import override
 from plico.utils.stepable import Stepable
 
@@ -13,10 +19,20 @@ class Controller(Stepable):
     """Controller class to handle controller device operations.
     
     This class handles the RPC requests to the controller device and
-    forwards them to the appropriate device methods.
+    forwards them to the appropriate device methods. The device status is
+    acquired by a StatusWorker and published when it changes, and the
+    device events by an optional EventPublisher.
     """
     
-    def __init__(self, name, ports, controller_device, replySocket, statusSocket, rpc):
+    DEFAULT_HEARTBEAT_PERIOD_SEC = 60.0
+    # Time getStatus waits for the first status of the device
+    FIRST_STATUS_TIMEOUT_SEC = 10.0
+    # Status entries that change continuously and are not a state change
+    VOLATILE_STATUS_KEYS = ('status_age_sec',)
+    
+    def __init__(self, name, ports, controller_device, replySocket, statusSocket, rpc,
+                 heartbeatPeriodSec=DEFAULT_HEARTBEAT_PERIOD_SEC, metrics=None,
+                 statusWorker=None, eventPublisher=None):
         """Create a controller instance.
         
         Parameters
@@ -33,6 +49,15 @@ class Controller(Stepable):
             Socket for sending status updates
         rpc : ZmqRemoteProcedureCall
             RPC handler instance
+        heartbeatPeriodSec : float, optional
+            Period for republishing an unchanged status
+        metrics : MetricsRegistry, optional
+            Registry of the process metrics (default: a new registry)
+        statusWorker : StatusWorker, optional
+            Worker acquiring the status of controller_device (default: a
+            new worker with a queue of one request)
+        eventPublisher : EventPublisher, optional
+            Publisher of the device events (default: no events)
         """
         self._name = name
         self._ports = ports
@@ -44,31 +69,184 @@ class Controller(Stepable):
         self._isTerminated = False
         self._stepCounter = 0
         self._timekeep = time.time()
+        self._heartbeatPeriodSec = heartbeatPeriodSec
+        self._statusSequence = 0
+        self._lastPublishedStatus = None
+        self._lastPublishTime = 0
+        self._lastPublished = None
+        # The status is published by the thread of the control loop or, in
+        # polling mode, also by the status worker
+        self._publishLock = threading.Lock()
+        self._eventPublisher = eventPublisher
+        self._lastDeviceStatuses = {}
+        self._metrics = metrics if metrics is not None else MetricsRegistry()
+        self._rpcTarget = _InstrumentedRpcTarget(self, self._metrics)
+        self._stepRate = self._metrics.gauge(
+            'control_loop_rate_hz', 'Steps per second of the control loop')
+        self._publications = self._metrics.counter(
+            'status_publications_total', 'Published status messages', kind='change')
+        self._heartbeats = self._metrics.counter(
+            'status_publications_total', 'Published status messages', kind='heartbeat')
+        self._lastValues = self._metrics.counter(
+            'status_publications_total', 'Published status messages', kind='last_value')
+        self._statusWorker = statusWorker if statusWorker is not None else StatusWorker(
+            controller_device.getStatus, metrics=self._metrics)
+        self._statusWorker.start()
+        self._statusWorker.request()
+        # A status change reported by the device, e.g. the optimistic state
+        # of an acknowledged command, is acquired and published at once
+        controller_device.add_status_listener(self._statusWorker.request)
         
     @override
     def step(self):
         """Process RPC requests and publish status updates."""
-        self._rpc.handleRequest(self, self._replySocket, multi=True)
-        self._publishStatus()
+        self.handleRequests()
+        self.publishStatus()
+        if self._eventPublisher is not None:
+            self._eventPublisher.flush()
         if time.time() - self._timekeep >= 1.0:
-            self._logger.notice('Stepping at %5.2f Hz' % (self._stepCounter / (time.time() - self._timekeep)))
+            self._stepRate.set(self._stepCounter / (time.time() - self._timekeep))
+            self._logger.notice('Stepping at %5.2f Hz' % self._stepRate.value)
             self._timekeep = time.time()
             self._stepCounter = 0
         self._stepCounter += 1
         
-    def _publishStatus(self):
-        """Publish the current status of the controller device."""
-        self._rpc.publishPickable(self._statusSocket, self.getStatus())
+    def handleRequests(self):
+        """Serve all the RPC requests pending on the reply socket."""
+        self._rpc.handleRequest(self._rpcTarget, self._replySocket, multi=True)
+        
+    def publishStatus(self):
+        """Ask for a new status of the controller device and publish the last one if it changed."""
+        self._statusWorker.request()
+        self.publishAcquiredStatus()
+        
+    def publishAcquiredStatus(self):
+        """Publish the last acquired status of the controller device if it changed.
+        
+        The published dictionary extends the device status with the
+        sequence number of the status, a heartbeat flag set when the status
+        did not change since the previous publication, and the publication
+        time.
+        """
+        with self._publishLock:
+            self._publishAcquiredStatus()
+        
+    def _publishAcquiredStatus(self):
+        status = self._statusWorker.latest()
+        if status is None:
+            return
+        self._publishDeviceEvents(status)
+        comparable = self._comparableStatus(status)
+        now = time.time()
+        changed = comparable != self._lastPublishedStatus
+        if not changed and now - self._lastPublishTime < self._heartbeatPeriodSec:
+            return
+        
+        if changed:
+            self._statusSequence += 1
+            self._lastPublishedStatus = comparable
+            self._publications.inc()
+        else:
+            self._heartbeats.inc()
+        published = dict(status)
+        published['sequence'] = self._statusSequence
+        published['heartbeat'] = not changed
+        published['publish_time'] = now
+        self._rpc.publishPickable(self._statusSocket, published)
+        self._lastPublishTime = now
+        self._lastPublished = published
+        
+    def handleSubscriptions(self):
+        """Republish the last status if a subscriber joined the XPUB status socket.
+        
+        Every pending subscription message is read, and the status is sent
+        once however many subscribers joined. The subscribers that already
+        had it receive it again as a heartbeat.
+        """
+        with self._publishLock:
+            self._handleSubscriptions()
+        
+    def _handleSubscriptions(self):
+        subscribed = False
+        while True:
+            try:
+                message = self._statusSocket.recv(zmq.NOBLOCK)
+            except zmq.Again:
+                break
+            # Subscriptions start with 1, unsubscriptions with 0
+            subscribed = subscribed or message[:1] == b'\x01'
+        if not subscribed or self._lastPublished is None:
+            return
+        self._lastValues.inc()
+        published = dict(self._lastPublished)
+        published['heartbeat'] = True
+        published['publish_time'] = time.time()
+        self._rpc.publishPickable(self._statusSocket, published)
+        
+    def _publishDeviceEvents(self, status):
+        """Publish the changes of every device since the previous status as events."""
+        if self._eventPublisher is None:
+            return
+        devices = status.get('devices') or {}
+        for uuid, device in devices.items():
+            previous = self._lastDeviceStatuses.get(uuid, {})
+            channels = device.get('channels')
+            unconfirmed = device.get('unconfirmed', [])
+            if channels and (channels != previous.get('channels') or
+                             unconfirmed != previous.get('unconfirmed', [])):
+                self._eventPublisher.publish(
+                    uuid, EventPublisher.STATE, channels=channels,
+                    unconfirmed=unconfirmed)
+            if device.get('online') != previous.get('online'):
+                self._eventPublisher.publish(
+                    uuid, EventPublisher.ONLINE, online=device.get('online'))
+            if device.get('error') != previous.get('error'):
+                self._eventPublisher.publish(
+                    uuid, EventPublisher.ERROR, error=device.get('error'))
+        self._lastDeviceStatuses.update(devices)
+        self._eventPublisher.flush()
+        
+    def _publishCommandResult(self, result):
+        """Publish the result of a command on the topic of its device, if it was found."""
+        if self._eventPublisher is not None and result.get('uuid'):
+            self._eventPublisher.publish(
+                result['uuid'], EventPublisher.COMMAND,
+                **{key: value for key, value in result.items()
+                   if key not in ('device', 'uuid')})
+        return result
+        
+    def _comparableStatus(self, status):
+        """Strip the entries that must not trigger a publication."""
+        return {key: value for key, value in status.items()
+                if key not in self.VOLATILE_STATUS_KEYS}
         
-    def getStatus(self):
-        """Get the current status of the controller device.
+    def getStatus(self, timeoutSec=None):
+        """Get the last acquired status of the controller device.
         
+        A new acquisition is requested, so that polling clients follow the
+        device. Only the first request waits for the device.
+        
+        Parameters
+        ----------
+        timeoutSec : float, optional
+            Seconds the client waits for the answer
+            
         Returns
         -------
         dict
-            Current status of the controller device
+            Last status of the controller device
+            
+        Raises
+        ------
+        TimeoutError
+            If no status was acquired yet when the client stops waiting
         """
-        return self._controller_device.getStatus()
+        self._statusWorker.request()
+        status = self._statusWorker.latest(
+            boundTimeout(self.FIRST_STATUS_TIMEOUT_SEC, deadlineAfter(timeoutSec)))
+        if status is None:
+            raise TimeoutError(f"No status acquired yet from {self._name}")
+        return status
         
     def getSnapshot(self):
         """Get a snapshot of the controller device state.
@@ -80,29 +258,123 @@ class Controller(Stepable):
         """
         return self._controller_device.getSnapshot()
         
-    def turnOn(self):
-        """Turn on the controller device.
+    def turnOn(self, device_id=None, channel=0, force=False, timeoutSec=None):
+        """Turn on a device of the controller.
         
+        Parameters
+        ----------
+        device_id : str, optional
+            uuid, name or type of the device (default: the target device)
+        channel : int, optional
+            Channel number (default: 0)
+        force : bool, optional
+            Send the command even if the channel is known to be on
+        timeoutSec : float, optional
+            Seconds the client waits for the answer: the command is dropped
+            if it was not sent by then
+            
         Returns
         -------
         bool
             True if the operation was successful
         """
-        return self._controller_device.turnOn()
+        return self.setState(device_id, channel, True, force, timeoutSec)['success']
         
-    def turnOff(self):
-        """Turn off the controller device.
+    def turnOff(self, device_id=None, channel=0, force=False, timeoutSec=None):
+        """Turn off a device of the controller.
         
+        Parameters
+        ----------
+        device_id : str, optional
+            uuid, name or type of the device (default: the target device)
+        channel : int, optional
+            Channel number (default: 0)
+        force : bool, optional
+            Send the command even if the channel is known to be off
+        timeoutSec : float, optional
+            Seconds the client waits for the answer: the command is dropped
+            if it was not sent by then
+            
         Returns
         -------
         bool
             True if the operation was successful
         """
-        return self._controller_device.turnOff()
+        return self.setState(device_id, channel, False, force, timeoutSec)['success']
+        
+    def setState(self, device_id=None, channel=0, state=True, force=False, timeoutSec=None):
+        """Switch a channel of a device, reporting what was done.
+        
+        Parameters
+        ----------
+        device_id : str, optional
+            uuid, name or type of the device (default: the target device)
+        channel : int, optional
+            Channel number (default: 0)
+        state : bool, optional
+            True to turn the channel on (default: True)
+        force : bool, optional
+            Send the command even if the channel is known to be in state
+        timeoutSec : float, optional
+            Seconds the client waits for the answer: the command is dropped
+            if it was not sent by then
+            
+        Returns
+        -------
+        dict
+            Device, its uuid, channel, state, success, error and outcome of
+            the command: 'sent', 'skipped', 'coalesced' or 'expired'
+        """
+        return self._publishCommandResult(self._controller_device.setState(
+            device_id, channel, state, force, deadlineAfter(timeoutSec)))
+        
+    def setStates(self, states, timeoutSec=None):
+        """Switch many device channels with a single request.
+        
+        Parameters
+        ----------
+        states : list
+            (device_id, channel, state) entries, state being True for on,
+            optionally followed by a force flag
+        timeoutSec : float, optional
+            Seconds the client waits for the answer: the commands not sent
+            by then are dropped
+            
+        Returns
+        -------
+        list
+            One dictionary per entry with the result of the command
+        """
+        results = self._controller_device.setStates(states, deadlineAfter(timeoutSec))
+        for result in results:
+            self._publishCommandResult(result)
+        return results
+        
+    def listDevices(self):
+        """List the devices managed by the controller.
+        
+        Returns
+        -------
+        dict
+            Name, type and channels of each device, indexed by uuid
+        """
+        return self._controller_device.listDevices()
+        
+    def getMetrics(self):
+        """Get the runtime metrics of the server.
+        
+        Returns
+        -------
+        dict
+            For every metric name, its type, help and samples, as returned
+            by MetricsRegistry.snapshot
+        """
+        return self._metrics.snapshot()
         
     def terminate(self):
         """Terminate the controller instance."""
         self._logger.notice("Terminating")
+        self._statusWorker.stop()
         self._controller_device.terminate()
         self._isTerminated = True
         
@@ -115,4 +387,45 @@ class Controller(Stepable):
         bool
             True if the controller has been terminated
         """
-        return self._isTerminated 
\ No newline at end of file
+        return self._isTerminated 
+
+
+class _InstrumentedRpcTarget(object):
+    """Expose the methods of the controller to the RPC, recording their metrics.
+    
+    The timing wrapper of a method is built at its first call and reused,
+    so serving a request does not create new metrics or wrappers. Only the
+    public methods are exposed.
+    """
+    
+    def __init__(self, controller, metrics):
+        self._controller = controller
+        self._metrics = metrics
+        self._wrappers = {}
+        
+    def __getattr__(self, method):
+        wrapper = self._wrappers.get(method)
+        if wrapper is None:
+            if method.startswith('_'):
+                raise AttributeError(f"Unknown method {method}")
+            wrapper = self._wrappers[method] = self._wrap(
+                method, getattr(self._controller, method))
+        return wrapper
+        
+    def _wrap(self, method, function):
+        latency = self._metrics.histogram(
+            'rpc_latency_seconds', 'Time spent serving an RPC request', method=method)
+        errors = self._metrics.counter(
+            'rpc_errors_total', 'RPC requests that raised an exception', method=method)
+        perfCounter = time.perf_counter
+        
+        def timed(*args):
+            startTime = perfCounter()
+            try:
+                return function(*args)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                latency.observe(perfCounter() - startTime)
+        return timed
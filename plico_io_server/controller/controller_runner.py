@@ -1,14 +1,20 @@
 import os
 import time
+import zmq
 from plico.utils.base_runner import BaseRunner
 from plico.utils.logger import Logger
 from plico.rpc.zmq_ports import ZmqPorts
 from plico.rpc.zmq_remote_procedure_call import ZmqRemoteProcedureCall
 from plico_io_server.controller.controller import Controller
-from plico_io_server.devices.meross_controller import MerossController
+from plico_io_server.controller.async_request_server import AsyncRequestServer
+from plico_io_server.controller.event_publisher import EventPublisher
+from plico_io_server.controller.status_worker import StatusWorker
+from plico_io_server.devices.driver_registry import DriverRegistry
 from plico_io_server.utils.constants import Constants
 from plico.utils.decorator import override
 from plico.utils.control_loop import FaultTolerantControlLoop
+from plico_io_server.utils.event_driven_control_loop import EventDrivenControlLoop
+from plico_io_server.utils.metrics import MetricsRegistry, MetricsHttpServer
 
 
 class ControllerRunner(BaseRunner):
@@ -26,41 +32,50 @@ class ControllerRunner(BaseRunner):
         """Create a runner for controller server."""
         BaseRunner.__init__(self)
         self._controller = None
-        self._controller_device = None
+        self._server = None
         self._logger = Logger.of(self.__class__.__name__)
-        self._iteration_interval_sec = self.DEFAULT_ITERATION_INTERVAL_SEC
+        self._metrics = MetricsRegistry()
+        self._drivers = DriverRegistry()
         
-    def _createControllerDevice(self):
-        """Create the appropriate controller device based on configuration."""
+    def _createControllerDevice(self, section, metrics):
+        """Create the controller device configured in a controller section."""
         # Get the controller device section from the configuration
         controllerDeviceSection = self.configuration.getValue(
-            self.getConfigurationSection(), 'controller')
+            section, 'controller')
         
         # Get the device model
         controllerModel = self.configuration.deviceModel(
             controllerDeviceSection)
             
-        if controllerModel == 'meross':
-            self._createMerossController(controllerDeviceSection)
-        else:
-            raise KeyError('Unsupported controller model %s' % controllerModel)
-            
-    def _createMerossController(self, controllerDeviceSection):
-        """Create a Meross controller device instance."""
-        # Get the device name from the configuration
-        name = self.configuration.deviceName(controllerDeviceSection)
-        
-        # Get Meross-specific configuration
-        email = self.configuration.getValue(controllerDeviceSection, 'email')
-        password = self.configuration.getValue(controllerDeviceSection, 'password')
-        device_type = self.configuration.getValue(controllerDeviceSection, 'device_type')
-        
-        self._controller_device = MerossController(
-            name=name,
-            email=email,
-            password=password,
-            model=device_type)
+        # The driver of the model, and its backend, are imported only now
+        return self._drivers.create(
+            controllerModel, self, controllerDeviceSection, metrics)
+        
+    def sharedSession(self, model, key, factory):
+        """Get the session the controllers of a model share.
+        
+        Drivers call it to let the controllers of the same account share
+        one connection to their backend.
+        
+        Parameters
+        ----------
+        model : str
+            Model of the driver asking for the session, e.g. 'meross'
+        key : hashable
+            Identifier of the session among the ones of the model, e.g.
+            the account the controllers log in with
+        factory : callable
+            factory(loopThread, metrics) creating the session on the given
+            EventLoopThread, recording its metrics in the given
+            MetricsRegistry
             
+        Returns
+        -------
+        object or None
+            The shared session, None to let each controller create its own
+        """
+        return None
+        
     def _replyPort(self):
         """Get the reply port from configuration."""
         return self.configuration.replyPort(self.getConfigurationSection())
@@ -73,13 +88,25 @@ class ControllerRunner(BaseRunner):
         """Get the status port from configuration."""
         return self.configuration.statusPort(self.getConfigurationSection())
         
-    def _getIterationInterval(self):
+    def _zmqContext(self):
+        """Get the ZeroMQ context of the RPC, to create the sockets it has no factory for."""
+        # ZmqRemoteProcedureCall does not expose its context
+        return self.rpc()._context
+        
+    def _getOptionalValue(self, section, key, default, **kwargs):
+        """Get an optional value from a section of the configuration."""
+        try:
+            return self.configuration.getValue(section, key, **kwargs)
+        except KeyError:
+            return default
+        
+    def _getIterationInterval(self, section):
         """Get the iteration interval from configuration or use default."""
         try:
             # Try to get custom interval from configuration, with a minimum allowed value
-            interval_sec = float(self.configuration.getValue(
-                self.getConfigurationSection(), 'iteration_interval_sec', 
-                self.DEFAULT_ITERATION_INTERVAL_SEC))
+            interval_sec = self.configuration.getValue(
+                section, 'iteration_interval_sec',
+                getfloat=True)
             
             # Enforce minimum threshold to prevent excessive load
             MIN_INTERVAL_SEC = 1.0  # Minimum 1 second between iterations
@@ -96,46 +123,159 @@ class ControllerRunner(BaseRunner):
                 f"(100 iterations per hour)")
             return self.DEFAULT_ITERATION_INTERVAL_SEC
         
-    def _setUp(self):
-        """Set up the controller server."""
-        self._logger = Logger.of("Controller runner")
+    def _setUpController(self, section, metrics):
+        """Create the sockets, the device and the controller of a controller section.
         
-        self._zmqPorts = ZmqPorts.fromConfiguration(
-            self.configuration, self.getConfigurationSection())
-        self._replySocket = self.rpc().replySocket(
-            self._zmqPorts.SERVER_REPLY_PORT)
-        self._publishSocket = self.rpc().publisherSocket(
-            self._zmqPorts.SERVER_PUBLISHER_PORT, hwm=100)
-        self._statusSocket = self.rpc().publisherSocket(
-            self._zmqPorts.SERVER_STATUS_PORT, hwm=1)
+        Parameters
+        ----------
+        section : str
+            Controller section of the configuration
+        metrics : MetricsRegistry
+            Registry the controller metrics are recorded in
+        
+        Returns
+        -------
+        _ControllerServer
+            The controller with its sockets, ready to be run
+        """
+        zmqPorts = ZmqPorts.fromConfiguration(self.configuration, section)
+        
+        # In asynchronous request mode a ROUTER socket receives the requests
+        # of the REQ clients, so that many of them can be in flight
+        asyncRequests = self._getOptionalValue(
+            section, 'async_requests', False, getboolean=True)
+        if asyncRequests:
+            replySocket = self._zmqContext().socket(zmq.ROUTER)
+            replySocket.bind(
+                self.rpc().tcpAddress('*', zmqPorts.SERVER_REPLY_PORT))
+        else:
+            replySocket = self.rpc().replySocket(zmqPorts.SERVER_REPLY_PORT)
+        publishSocket = self.rpc().publisherSocket(
+            zmqPorts.SERVER_PUBLISHER_PORT, hwm=100)
+        # In last value cache mode an XPUB socket reports the subscriptions,
+        # so that the last status is sent at once to every new subscriber
+        statusLastValueCache = self._getOptionalValue(
+            section, 'status_last_value_cache', False, getboolean=True)
+        if statusLastValueCache:
+            statusSocket = self._zmqContext().socket(zmq.XPUB)
+            statusSocket.setsockopt(zmq.SNDHWM, 1)
+            statusSocket.setsockopt(zmq.LINGER, 0)
+            # Report every subscription, not only the first one of a topic
+            statusSocket.setsockopt(zmq.XPUB_VERBOSE, 1)
+            statusSocket.bind(
+                self.rpc().tcpAddress('*', zmqPorts.SERVER_STATUS_PORT))
+        else:
+            statusSocket = self.rpc().publisherSocket(
+                zmqPorts.SERVER_STATUS_PORT, hwm=1)
             
-        self._createControllerDevice()
+        controllerDevice = self._createControllerDevice(section, metrics)
         
         # Get the iteration interval from configuration
-        self._iteration_interval_sec = self._getIterationInterval()
+        iterationIntervalSec = self._getIterationInterval(section)
         self._logger.notice(
-            f"Controller will run at maximum {3600/self._iteration_interval_sec:.1f} times per hour "
-            f"(every {self._iteration_interval_sec:.1f}s)")
-        
-        self._controller = Controller(
-            self.name,
-            self._zmqPorts,
-            self._controller_device,
-            self._replySocket,
-            self._statusSocket,
-            self.rpc())
-            
+            f"Controller {section} will run at maximum {3600/iterationIntervalSec:.1f} times per hour "
+            f"(every {iterationIntervalSec:.1f}s)")
+        
+        # In event driven mode requests are served as soon as they arrive,
+        # independently of the status iteration interval
+        eventDriven = self._getOptionalValue(
+            section, 'event_driven', False, getboolean=True)
+        if asyncRequests and not eventDriven:
+            self._logger.notice("Asynchronous requests need the event driven mode, enabling it")
+            eventDriven = True
+        if statusLastValueCache and not eventDriven:
+            self._logger.notice("The status last value cache needs the event driven mode, enabling it")
+            eventDriven = True
+        if eventDriven:
+            self._logger.notice(
+                "Event driven mode: RPC requests are served as soon as they arrive")
+        
+        heartbeatPeriodSec = self._getOptionalValue(
+            section, 'status_heartbeat_sec',
+            Controller.DEFAULT_HEARTBEAT_PERIOD_SEC, getfloat=True)
+        
+        # The status is acquired in a worker thread, never by the thread
+        # serving the requests
+        statusQueueSize = self._getOptionalValue(
+            section, 'status_queue_size',
+            StatusWorker.DEFAULT_QUEUE_SIZE, getint=True)
+        statusWorker = StatusWorker(
+            controllerDevice.getStatus, statusQueueSize, metrics)
+        
+        # The publisher socket carries the events of every device, on the
+        # topic of its uuid
+        eventPublisher = EventPublisher(publishSocket, metrics)
+        
+        controller = Controller(
+            self.configuration.getValue(section, 'name'),
+            zmqPorts,
+            controllerDevice,
+            replySocket,
+            statusSocket,
+            self.rpc(),
+            heartbeatPeriodSec=heartbeatPeriodSec,
+            metrics=metrics,
+            statusWorker=statusWorker,
+            eventPublisher=eventPublisher)
+        if not eventDriven:
+            # The loop sleeps between its iterations: the status acquired
+            # on a change reported by the device is published by the worker
+            statusWorker.addCallback(controller.publishAcquiredStatus)
+        
+        requestServer = None
+        if asyncRequests:
+            maxInFlight = self._getOptionalValue(
+                section, 'max_in_flight_requests',
+                AsyncRequestServer.DEFAULT_MAX_IN_FLIGHT, getint=True)
+            requestServer = AsyncRequestServer(
+                controller, replySocket, maxInFlight, metrics)
+            self._logger.notice(
+                f"Asynchronous requests: up to {maxInFlight} requests served concurrently")
+        
+        # Optional HTTP endpoint serving the metrics in text format
+        metricsServer = None
+        metricsPort = self._getOptionalValue(
+            section, 'metrics_port', None, getint=True)
+        if metricsPort is not None:
+            metricsServer = MetricsHttpServer(
+                metrics, metricsPort, self._getOptionalValue(
+                    section, 'metrics_host', ''))
+            metricsServer.start()
+            self._logger.notice(
+                f"Metrics exposed on http://{metricsServer.host or '*'}:{metricsServer.port}/metrics")
+        
+        return _ControllerServer(controller, replySocket, publishSocket,
+                                 iterationIntervalSec, eventDriven,
+                                 requestServer, metricsServer, statusWorker,
+                                 eventPublisher,
+                                 statusSocket if statusLastValueCache else None)
+        
+    def _setUp(self):
+        """Set up the controller server."""
+        self._logger = Logger.of("Controller runner")
+        self._server = self._setUpController(
+            self.getConfigurationSection(), self._metrics)
+        self._controller = self._server.controller
         self._logger.notice(f"Runner {self.name} ready to handle requests")
         
     def _runLoop(self):
         """Run the control loop."""
         self._logRunning()
         
-        FaultTolerantControlLoop(
-            self._controller,
-            Logger.of("Controller control loop"),
-            time,
-            self._iteration_interval_sec).start()
+        if self._server.eventDriven:
+            loop = EventDrivenControlLoop(
+                self._controller,
+                Logger.of("Controller control loop"),
+                time)
+            self._server.register(loop)
+            loop.start()
+        else:
+            FaultTolerantControlLoop(
+                self._controller,
+                Logger.of("Controller control loop"),
+                time,
+                self._server.iterationIntervalSec).start()
+        self._server.close()
         self._logger.notice("Terminated")
         
     @override
@@ -155,4 +295,57 @@ class ControllerRunner(BaseRunner):
     def terminate(self, signal, frame):
         """Terminate the runner."""
         if self._controller:
-            self._controller.terminate() 
\ No newline at end of file
+            self._controller.terminate()
+
+
+class _ControllerServer(object):
+    """A controller with its sockets and the settings of its loop."""
+    
+    # Time left to the last replies to be sent when the ROUTER socket is closed
+    CLOSE_LINGER_MS = 1000
+    
+    def __init__(self, controller, replySocket, publishSocket,
+                 iterationIntervalSec, eventDriven, requestServer=None,
+                 metricsServer=None, statusWorker=None, eventPublisher=None,
+                 lastValueSocket=None):
+        self.controller = controller
+        self.replySocket = replySocket
+        self.publishSocket = publishSocket
+        self.iterationIntervalSec = iterationIntervalSec
+        self.eventDriven = eventDriven
+        self.requestServer = requestServer
+        self.metricsServer = metricsServer
+        self.statusWorker = statusWorker
+        self.eventPublisher = eventPublisher
+        self.lastValueSocket = lastValueSocket
+    
+    def register(self, loop):
+        """Serve the requests and publish the status from an EventDrivenControlLoop."""
+        if self.requestServer is not None:
+            self.requestServer.register(loop)
+        else:
+            loop.addReader(self.replySocket, self.controller.handleRequests)
+        loop.addPeriodic(self.iterationIntervalSec, self.controller.publishStatus)
+        if self.statusWorker is not None:
+            # A new status is published as soon as it is acquired
+            self.statusWorker.register(loop, self.controller.publishAcquiredStatus)
+        if self.eventPublisher is not None:
+            self.eventPublisher.register(loop)
+        if self.lastValueSocket is not None:
+            # New status subscribers get the last status at once
+            loop.addReader(self.lastValueSocket, self.controller.handleSubscriptions)
+    
+    def close(self):
+        """Release the request and status workers, the event publisher, the metrics endpoint and the sockets created by the runner."""
+        if self.requestServer is not None:
+            self.requestServer.close()
+            # Unlike the REP socket, the ROUTER socket is not cached by the RPC
+            self.replySocket.close(linger=self.CLOSE_LINGER_MS)
+        if self.metricsServer is not None:
+            self.metricsServer.stop()
+        if self.statusWorker is not None:
+            self.statusWorker.close()
+        if self.eventPublisher is not None:
+            self.eventPublisher.close()
+        if self.lastValueSocket is not None:
+            self.lastValueSocket.close()
@@ -0,0 +1,116 @@
+import pickle
+import queue
+import socket
+import threading
+import time
+import zmq
+from plico.utils.constants import Constants
+from plico_io_server.utils.metrics import MetricsRegistry
+
+
+class EventPublisher(object):
+    """Publish device events on a PUB socket, one topic per device.
+    
+    Every event is sent as a two frame message: the topic, i.e. the uuid
+    of the device encoded in UTF-8, and the pickled event dictionary. Besides its
+    own entries, an event has the device, its type, a sequence number
+    increasing by one at every event of the same topic, so that subscribers
+    can detect lost events, and the time it happened. Subscribers select
+    the devices they follow by subscribing to their topics.
+    
+    publish() can be called from any thread: the events are queued and
+    sent when flush() is called or, once register() was called, as soon
+    as the control loop is woken up. The sends are serialized by a lock.
+    """
+    
+    # Event types
+    STATE = 'state'
+    ONLINE = 'online'
+    COMMAND = 'command'
+    ERROR = 'error'
+    
+    def __init__(self, publisherSocket, metrics=None, clock=time.time):
+        """Create a publisher sending on publisherSocket.
+        
+        Parameters
+        ----------
+        publisherSocket : zmq.Socket
+            Bound PUB socket
+        metrics : MetricsRegistry, optional
+            Registry the count of published events is recorded in
+        clock : callable, optional
+            Wall clock time of the events (default: time.time)
+        """
+        self._socket = publisherSocket
+        self._clock = clock
+        self._pending = queue.SimpleQueue()
+        self._sequences = {}
+        self._lock = threading.Lock()
+        self._wakeUpReader, self._wakeUpWriter = socket.socketpair()
+        self._wakeUpReader.setblocking(False)
+        self._wakeUpWriter.setblocking(False)
+        self._metrics = metrics if metrics is not None else MetricsRegistry()
+        self._published = {}
+    
+    def publish(self, topic, eventType, **data):
+        """Queue an event of a device, to be sent by the control loop.
+        
+        Parameters
+        ----------
+        topic : str
+            uuid of the device
+        eventType : str
+            Type of the event: state, online, command or error
+        data : dict
+            Entries of the event
+        """
+        self._pending.put((topic, eventType, self._clock(), data))
+        try:
+            self._wakeUpWriter.send(b'\0')
+        except BlockingIOError:
+            # The loop has not consumed the previous wake-ups yet
+            pass
+    
+    def register(self, loop):
+        """Send the queued events as soon as they are published, from an EventDrivenControlLoop."""
+        loop.addReader(self._wakeUpReader.fileno(), self.flush)
+    
+    def flush(self):
+        """Send the queued events."""
+        try:
+            while self._wakeUpReader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            self._send()
+    
+    def _send(self):
+        while True:
+            try:
+                topic, eventType, timestamp, data = self._pending.get_nowait()
+            except queue.Empty:
+                return
+            sequence = self._sequences.get(topic, 0) + 1
+            self._sequences[topic] = sequence
+            event = dict(data, device=topic, type=eventType,
+                         sequence=sequence, timestamp=timestamp)
+            # A PUB socket never blocks: the events exceeding its high
+            # water mark are dropped for the slow subscribers
+            self._socket.send_multipart(
+                [topic.encode(), pickle.dumps(event, Constants.PICKLE_PROTOCOL)],
+                zmq.NOBLOCK)
+            self._counter(eventType).inc()
+    
+    def _counter(self, eventType):
+        counter = self._published.get(eventType)
+        if counter is None:
+            counter = self._published[eventType] = self._metrics.counter(
+                'events_published_total', 'Device events published', type=eventType)
+        return counter
+    
+    def close(self):
+        """Send the queued events and release the wake-up sockets."""
+        self.flush()
+        self._wakeUpReader.close()
+        self._wakeUpWriter.close()
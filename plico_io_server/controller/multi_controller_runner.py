@@ -0,0 +1,132 @@
+import time
+from plico.utils.logger import Logger
+from plico.rpc.zmq_remote_procedure_call import ZmqRemoteProcedureCall
+from plico.utils.decorator import override
+from plico_io_server.controller.controller_runner import ControllerRunner
+from plico_io_server.devices.meross_watchdog import MerossWatchdog
+from plico_io_server.utils.event_driven_control_loop import EventDrivenControlLoop
+from plico_io_server.utils.event_loop_thread import EventLoopThread
+from plico_io_server.utils.metrics import MetricsRegistry
+
+
+class MultiControllerRunner(ControllerRunner):
+    """Runner hosting many controller servers in one process.
+    
+    The configuration section given on the command line names the process
+    and lists the controller sections to host in its 'controllers' entry,
+    comma separated (default: every controllerN section). Each controller
+    keeps its own ports, so that clients and scripts are unaffected, while
+    the process runs a single event driven loop polling all the reply
+    sockets and a single asyncio event loop for all the devices.
+    
+    The controllers whose drivers ask for the same session, identified by
+    the model and a key of the driver (see ControllerRunner.sharedSession),
+    share it: the Meross controllers of the same account share one
+    MerossSession, that is one login, one MQTT connection, one discovery
+    and one rate limit for the account. A single MerossWatchdog supervises
+    the event loop and all the Meross controllers. The metrics of the
+    shared sessions, event loop and watchdog are reported by every
+    controller.
+    
+    The process exits when all the hosted controllers are terminated.
+    """
+    
+    RUNNING_MESSAGE = "Multi controller server is running."
+    
+    def __init__(self):
+        """Create a runner for many controller servers."""
+        ControllerRunner.__init__(self)
+        self._servers = []
+        self._sessions = {}
+        self._loopThread = None
+        self._watchdog = None
+    
+    @override
+    def _createZmqBasedRPC(self):
+        # The ports are the ones of the hosted controllers, the section
+        # of the process has none
+        self._rpc = ZmqRemoteProcedureCall()
+    
+    def _controllerSections(self):
+        """Get the controller sections to host."""
+        sections = self._getOptionalValue(
+            self.getConfigurationSection(), 'controllers', None)
+        if sections:
+            return [section.strip() for section in sections.split(',')
+                    if section.strip()]
+        return self.configuration.numberedSectionList(prefix='controller')
+    
+    @override
+    def sharedSession(self, model, key, factory):
+        """Get the session of the account, created by its first controller."""
+        session = self._sessions.get((model, key))
+        if session is None:
+            session = self._sessions[(model, key)] = factory(
+                self._loopThread, self._metrics)
+        return session
+    
+    @override
+    def _createControllerDevice(self, section, metrics):
+        """Create a controller device, supervised by the watchdog of the process if it runs on a shared session."""
+        device = ControllerRunner._createControllerDevice(
+            self, section, metrics)
+        if getattr(device, 'session', None) in self._sessions.values():
+            self._watchdog.watch(device)
+        return device
+    
+    def _setUp(self):
+        """Set up the hosted controller servers."""
+        self._logger = Logger.of("Multi controller runner")
+        self._loopThread = EventLoopThread('meross', self._metrics)
+        self._loopThread.start()
+        self._watchdog = MerossWatchdog(self._loopThread, metrics=self._metrics)
+        
+        sections = self._controllerSections()
+        if not sections:
+            raise KeyError('No controller section to host')
+        for section in sections:
+            # The metrics of the shared objects are recorded in the
+            # registry of the process, included by every controller
+            metrics = MetricsRegistry()
+            metrics.include(self._metrics)
+            server = self._setUpController(section, metrics)
+            if not server.eventDriven:
+                self._logger.notice(
+                    f"Controller {section} served in event driven mode, as all the hosted controllers")
+                server.eventDriven = True
+            self._servers.append(server)
+        self._watchdog.start()
+        
+        self._logger.notice(
+            f"Runner {self.name} ready to handle requests for {len(self._servers)} controllers "
+            f"({', '.join(sections)}) with {len(self._sessions)} shared sessions")
+    
+    def _runLoop(self):
+        """Run one control loop serving all the controllers."""
+        self._logRunning()
+        
+        loop = EventDrivenControlLoop(
+            self,
+            Logger.of("Multi controller control loop"),
+            time)
+        for server in self._servers:
+            server.register(loop)
+        loop.start()
+        
+        self._watchdog.stop()
+        for server in self._servers:
+            server.close()
+        for session in self._sessions.values():
+            session.close()
+        self._loopThread.stop()
+        self._logger.notice("Terminated")
+    
+    def isTerminated(self):
+        """Check whether all the hosted controllers are terminated."""
+        return all(server.controller.isTerminated() for server in self._servers)
+    
+    @override
+    def terminate(self, signal, frame):
+        """Terminate all the hosted controllers."""
+        for server in self._servers:
+            server.controller.terminate()
@@ -0,0 +1,175 @@
+import collections
+import socket
+import threading
+import time
+from plico.utils.logger import Logger
+from plico_io_server.utils.metrics import MetricsRegistry
+
+
+class StatusWorker(object):
+    """Acquire the status of a controller device in a dedicated thread.
+    
+    Acquisitions are requested with request() and run one at a time by the
+    worker thread, so that a slow device, e.g. waiting for a cloud call,
+    never blocks the thread serving the RPC requests: that thread only
+    reads the last completed status with latest().
+    
+    Pending requests wait in a queue of queueSize entries, all served by
+    the next acquisition. When the queue is full the oldest request is
+    dropped. The queue depth, the dropped requests and the acquisition
+    time and errors are recorded in the metrics.
+    
+    Every completed acquisition wakes up the control loop registered with
+    register() and calls the callbacks added with addCallback(), so that a
+    new status is published as soon as it is known.
+    """
+    
+    DEFAULT_QUEUE_SIZE = 1
+    
+    def __init__(self, acquire, queueSize=DEFAULT_QUEUE_SIZE, metrics=None):
+        """Create a worker, to be started with start().
+        
+        Parameters
+        ----------
+        acquire : callable
+            Function called without arguments returning the status
+        queueSize : int, optional
+            Maximum number of pending requests (default: 1)
+        metrics : MetricsRegistry, optional
+            Registry the worker metrics are recorded in
+        """
+        self._acquire = acquire
+        self._queueSize = max(1, queueSize)
+        self._logger = Logger.of('StatusWorker')
+        self._requests = collections.deque()
+        self._condition = threading.Condition()
+        self._latest = None
+        self._callbacks = []
+        self._stopped = False
+        self._thread = None
+        self._wakeUpReader, self._wakeUpWriter = socket.socketpair()
+        self._wakeUpReader.setblocking(False)
+        self._wakeUpWriter.setblocking(False)
+        
+        self._metrics = metrics if metrics is not None else MetricsRegistry()
+        self._depth = self._metrics.gauge(
+            'status_queue_depth', 'Status acquisitions waiting for the worker')
+        self._depth.setFunction(lambda: len(self._requests))
+        self._dropped = self._metrics.counter(
+            'status_requests_dropped_total', 'Status acquisitions dropped by a full queue')
+        self._latency = self._metrics.histogram(
+            'status_acquisition_seconds', 'Time spent acquiring the device status')
+        self._errors = self._metrics.counter(
+            'status_acquisition_errors_total', 'Status acquisitions that raised an exception')
+    
+    def start(self):
+        """Start the worker thread."""
+        self._thread = threading.Thread(
+            target=self._run, name='status-worker', daemon=True)
+        self._thread.start()
+    
+    def request(self):
+        """Queue a status acquisition, dropping the oldest one if the queue is full."""
+        with self._condition:
+            if len(self._requests) >= self._queueSize:
+                self._requests.popleft()
+                self._dropped.inc()
+            self._requests.append(time.time())
+            self._condition.notify_all()
+    
+    def latest(self, timeoutSec=0):
+        """Get the last acquired status.
+        
+        Parameters
+        ----------
+        timeoutSec : float, optional
+            Time to wait for the first acquisition (default: do not wait)
+        
+        Returns
+        -------
+        dict or None
+            The last status, None if none was acquired yet
+        """
+        with self._condition:
+            if self._latest is None and timeoutSec:
+                self._condition.wait_for(
+                    lambda: self._latest is not None or self._stopped, timeoutSec)
+            return self._latest
+    
+    def register(self, loop, callback):
+        """Call callback() from an EventDrivenControlLoop after every acquisition.
+        
+        Parameters
+        ----------
+        loop : EventDrivenControlLoop
+            Loop watching the completed acquisitions
+        callback : callable
+            Function called without arguments, e.g. publishing the status
+        """
+        def completed():
+            try:
+                while self._wakeUpReader.recv(4096):
+                    pass
+            except BlockingIOError:
+                pass
+            callback()
+        loop.addReader(self._wakeUpReader.fileno(), completed)
+    
+    def addCallback(self, callback):
+        """Call callback() from the worker thread after every acquisition."""
+        self._callbacks.append(callback)
+    
+    def _run(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._requests or self._stopped)
+                if self._stopped:
+                    return
+                # One acquisition serves all the pending requests
+                self._requests.clear()
+            
+            startTime = time.perf_counter()
+            try:
+                status = self._acquire()
+            except Exception as e:
+                self._errors.inc()
+                self._logger.error(f"Error acquiring the status: {str(e)}")
+                status = None
+            finally:
+                self._latency.observe(time.perf_counter() - startTime)
+            
+            with self._condition:
+                if self._stopped:
+                    return
+                if status is not None:
+                    self._latest = status
+                    self._condition.notify_all()
+            if status is None:
+                continue
+            for callback in self._callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    self._logger.error(f"Error in a status callback: {str(e)}")
+            try:
+                self._wakeUpWriter.send(b'\0')
+            except BlockingIOError:
+                # The loop has not consumed the previous wake-ups yet
+                pass
+    
+    def stop(self, timeoutSec=5):
+        """Stop the worker, waiting up to timeoutSec for the running acquisition."""
+        with self._condition:
+            self._stopped = True
+            self._requests.clear()
+            self._condition.notify_all()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeoutSec)
+        self._thread = None
+    
+    def close(self):
+        """Stop the worker and release the wake-up sockets, once the loop is over."""
+        self.stop()
+        self._wakeUpReader.close()
+        self._wakeUpWriter.close()
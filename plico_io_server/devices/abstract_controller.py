@@ -5,6 +5,13 @@ class AbstractController(ABC):
     '''
     Abstract base class for all controller devices.
     This defines the interface that all controller devices must implement.
+    
+    The controller server calls the camelCase methods: getStatus, from the
+    status worker thread, setState, setStates, listDevices, getSnapshot and
+    terminate, from the threads serving the requests, possibly at the same
+    time, and add_status_listener once, when the server is created. The
+    snake_case methods are the simpler interface of the scripts using a
+    controller device directly.
     '''
 
     @abstractmethod
@@ -76,4 +83,131 @@ class AbstractController(ABC):
         --------
         dict : A dictionary of available devices with their IDs as keys
         """
-        pass 
\ No newline at end of file
+        pass
+
+    def add_status_listener(self, listener):
+        """
+        Register a function to call when the status of the devices changes
+        
+        Controllers that learn about state changes, e.g. from acknowledged
+        commands or notifications pushed by the devices, call listener()
+        without arguments, possibly from another thread, so that the new
+        status is published at once. This default implementation never
+        calls it: the status is only published periodically.
+        
+        Parameters:
+        -----------
+        listener : callable
+            Function called without arguments, quickly returning
+        """
+        pass
+
+    def get_statuses(self):
+        """
+        Get the state of every channel of every device in one call
+        
+        Controllers whose backend can fetch the states of many devices at
+        once, or concurrently, override it: this default implementation
+        calls get_status once per device channel.
+        
+        Returns:
+        --------
+        dict : for every device ID, a dictionary of the channel states,
+            True if the channel is on
+        """
+        statuses = {}
+        for device_id, device in self.list_devices().items():
+            channels = device.get('channels', [0]) if isinstance(device, dict) else [0]
+            statuses[device_id] = {channel: self.get_status(device_id, channel)
+                                   for channel in channels}
+        return statuses
+
+    @abstractmethod
+    def getStatus(self, deadline=None):
+        """
+        Get the status of the controller and of its devices
+        
+        Parameters:
+        -----------
+        deadline : float or None
+            Monotonic time (time.monotonic()) after which the caller no longer
+            waits for the status, None to wait as long as needed
+            
+        Returns:
+        --------
+        dict : the status, published on the status socket of the server
+        """
+        pass
+
+    @abstractmethod
+    def setState(self, device_id=None, channel=0, state=True, force=False, deadline=None):
+        """
+        Switch a channel of a device on or off
+        
+        Parameters:
+        -----------
+        device_id : str or None
+            The ID of the device to switch. If None, use the first available device.
+        channel : int
+            The channel to switch (default: 0)
+        state : bool
+            True to turn the channel on, False to turn it off
+        force : bool
+            Send the command even if the channel is known to be in state
+        deadline : float or None
+            Monotonic time (time.monotonic()) after which the caller no longer
+            waits: the command is dropped if it was not sent by then
+            
+        Returns:
+        --------
+        dict : the device, its uuid, channel, state, success and error of
+            the command, and its outcome: 'sent', 'skipped', 'coalesced' or
+            'expired'
+        """
+        pass
+
+    def setStates(self, states, deadline=None):
+        """
+        Switch many device channels at once
+        
+        Controllers able to send the commands concurrently override it:
+        this default implementation calls setState once per entry.
+        
+        Parameters:
+        -----------
+        states : list
+            (device_id, channel, state) entries, optionally followed by a
+            force flag
+        deadline : float or None
+            Monotonic time (time.monotonic()) after which the caller no longer
+            waits: the commands not sent by then are dropped
+            
+        Returns:
+        --------
+        list : one result per entry, in the same order, as returned by setState
+        """
+        return [self.setState(entry[0], entry[1], entry[2],
+                              bool(entry[3]) if len(entry) > 3 else False, deadline)
+                for entry in states]
+
+    def listDevices(self):
+        """
+        List the managed devices
+        
+        Returns:
+        --------
+        dict : name, type and channels of each device, indexed by device ID
+        """
+        return self.list_devices()
+
+    def getSnapshot(self, prefix=''):
+        """
+        Get a snapshot of the controller state, by default its status
+        """
+        return self.getStatus()
+
+    def terminate(self):
+        """
+        Terminate the controller, by default deinitializing it
+        """
+        self.deinitialize()
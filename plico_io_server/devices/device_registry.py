@@ -0,0 +1,73 @@
+class DeviceRegistry:
+    '''
+    Registry of the devices managed by a controller.
+    
+    Devices are indexed by uuid, name and type, so that a device identifier
+    given by a client is resolved in constant time whatever the number of
+    devices. Names and types are matched case-insensitively.
+    '''
+    
+    def __init__(self):
+        self._by_uuid = {}
+        self._by_name = {}
+        self._by_type = {}
+    
+    def add(self, device, uuid, name, device_type):
+        """Register a device under its uuid, name and type"""
+        if uuid in self._by_uuid:
+            raise ValueError(f"Device with uuid '{uuid}' already registered")
+        self._by_uuid[uuid] = device
+        if name:
+            self._by_name.setdefault(name.lower(), device)
+        if device_type:
+            self._by_type.setdefault(device_type.lower(), []).append(device)
+    
+    def lookup(self, device_id=None):
+        """
+        Find a device by uuid, name or type
+        
+        Parameters:
+        -----------
+        device_id : str or None
+            uuid, name or type of the device. If None, the first registered
+            device is returned. A type matches the first registered device
+            of that type.
+        
+        Returns:
+        --------
+        object : the registered device
+        
+        Raises:
+        -------
+        KeyError : if no device matches device_id
+        """
+        if device_id is None:
+            for device in self._by_uuid.values():
+                return device
+            raise KeyError("No device registered")
+        
+        device = self._by_uuid.get(device_id)
+        if device is not None:
+            return device
+        key = str(device_id).lower()
+        device = self._by_name.get(key)
+        if device is not None:
+            return device
+        devices = self._by_type.get(key)
+        if devices:
+            return devices[0]
+        raise KeyError(f"Unknown device '{device_id}'")
+    
+    def uuids(self):
+        """List the uuids of the registered devices, in registration order"""
+        return list(self._by_uuid.keys())
+    
+    def devices(self):
+        """List the registered devices, in registration order"""
+        return list(self._by_uuid.values())
+    
+    def __contains__(self, uuid):
+        return uuid in self._by_uuid
+    
+    def __len__(self):
+        return len(self._by_uuid)
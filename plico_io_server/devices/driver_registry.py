@@ -0,0 +1,106 @@
+import importlib
+from importlib import metadata
+
+
+class DriverRegistry:
+    '''
+    Registry of the controller drivers, indexed by model name
+    
+    A driver is a callable driver(runner, controller_device_section, metrics)
+    returning the controller device configured in controller_device_section,
+    an AbstractController: the server calls its getStatus, setState,
+    setStates, listDevices, getSnapshot, terminate and add_status_listener
+    methods. The model of the device section selects the driver.
+    
+    Drivers are declared as 'module:attribute' references and imported only
+    when a device section selects them, so that the backends that are not
+    used, e.g. the Meross client with aiohttp and paho-mqtt, are never
+    imported. Besides the built-in drivers, packages add drivers by
+    declaring entry points in the ENTRY_POINT_GROUP group, named after the
+    model:
+        
+        entry_points={
+            'plico_io_server.drivers': [
+                'mymodel=mypackage.mydriver:create_controller',
+            ],
+        }
+    
+    An entry point named after a built-in model replaces the built-in driver.
+    The entry points are read once, at the first lookup.
+    '''
+    
+    ENTRY_POINT_GROUP = 'plico_io_server.drivers'
+    BUILTIN_DRIVERS = {
+        'meross': 'plico_io_server.devices.meross_driver:create_controller',
+    }
+    
+    def __init__(self, builtin_drivers=None, use_entry_points=True):
+        self._builtin = dict(self.BUILTIN_DRIVERS if builtin_drivers is None else builtin_drivers)
+        self._registered = {}
+        self._drivers = {}
+        self._use_entry_points = use_entry_points
+        self._entry_points = None
+    
+    def register(self, model, driver):
+        """Register a driver for a model, as a callable or a 'module:attribute' reference, replacing any other"""
+        self._drivers.pop(model, None)
+        self._registered[model] = driver
+    
+    def models(self):
+        """Names of the models with a driver, without importing them"""
+        return sorted(set(self._builtin) | set(self._registered) | set(self._entry_point_references()))
+    
+    def load(self, model):
+        """
+        Get the driver of a model, importing it at the first call
+        
+        The drivers registered with register() come first, then the entry
+        points and then the built-in drivers.
+        
+        Raises:
+        -------
+        KeyError : no driver is registered for the model
+        ImportError : the driver cannot be imported, e.g. a dependency of its
+            backend is not installed
+        """
+        driver = self._drivers.get(model)
+        if driver is None:
+            if model in self._registered:
+                driver = self._import(self._registered[model])
+            elif model in self._entry_point_references():
+                driver = self._entry_point_references()[model].load()
+            elif model in self._builtin:
+                driver = self._import(self._builtin[model])
+            else:
+                raise KeyError('Unsupported controller model %s (available: %s)' % (
+                    model, ', '.join(self.models()) or 'none'))
+            self._drivers[model] = driver
+        return driver
+    
+    def create(self, model, runner, controller_device_section, metrics):
+        """Create the controller device of a device section with the driver of its model"""
+        return self.load(model)(runner, controller_device_section, metrics)
+    
+    def _entry_point_references(self):
+        """Entry points of the driver group by model, read once"""
+        if self._entry_points is None:
+            self._entry_points = {}
+            if self._use_entry_points:
+                entry_points = metadata.entry_points()
+                if hasattr(entry_points, 'select'):
+                    group = entry_points.select(group=self.ENTRY_POINT_GROUP)
+                else:
+                    group = entry_points.get(self.ENTRY_POINT_GROUP, [])
+                self._entry_points = {entry_point.name: entry_point for entry_point in group}
+        return self._entry_points
+    
+    @staticmethod
+    def _import(reference):
+        """Import the attribute a 'module:attribute' reference points to"""
+        if callable(reference):
+            return reference
+        module_name, _, attribute = reference.partition(':')
+        driver = importlib.import_module(module_name)
+        for name in attribute.split('.') if attribute else []:
+            driver = getattr(driver, name)
+        return driver
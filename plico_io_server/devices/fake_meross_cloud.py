@@ -0,0 +1,554 @@
+import asyncio
+import base64
+import collections
+import hashlib
+import ipaddress
+import json
+import os
+import random
+import ssl
+import subprocess
+import time
+import uuid as uuid_module
+from aiohttp import web
+from plico.utils.logger import Logger
+
+
+# Meross API status codes
+API_NO_ERROR = 0
+API_WRONG_CREDENTIALS = 1004
+API_TOKEN_ERROR = 1022
+API_TOKEN_EXPIRED = 1200
+API_REQUESTED_TOO_FREQUENTLY = 1028
+
+# Meross namespaces implemented by the fake plugs
+NAMESPACE_ABILITY = 'Appliance.System.Ability'
+NAMESPACE_ALL = 'Appliance.System.All'
+NAMESPACE_ONLINE = 'Appliance.System.Online'
+NAMESPACE_TOGGLEX = 'Appliance.Control.ToggleX'
+
+# MQTT 3.1.1 control packet types
+_CONNECT = 1
+_CONNACK = 2
+_PUBLISH = 3
+_PUBACK = 4
+_PUBREC = 5
+_PUBREL = 6
+_PUBCOMP = 7
+_SUBSCRIBE = 8
+_SUBACK = 9
+_UNSUBSCRIBE = 10
+_UNSUBACK = 11
+_PINGREQ = 12
+_PINGRESP = 13
+_DISCONNECT = 14
+
+
+def _md5(text):
+    return hashlib.md5(text.encode('utf8')).hexdigest().lower()
+
+
+def _random_id():
+    return uuid_module.uuid4().hex
+
+
+class FakePlug:
+    '''
+    Smart plug simulated by the fake Meross cloud
+    '''
+
+    def __init__(self, uuid, name, device_type, channels=1, online=True):
+        self.uuid = uuid
+        self.name = name
+        self.type = device_type
+        self.channels = channels
+        self.online = online
+        self.states = [False] * channels
+
+    def http_info(self, domain):
+        """Device description returned by the device list API"""
+        channels = [{}] + [{"type": "Switch", "devName": f"Switch {index}"}
+                           for index in range(1, self.channels)]
+        return {
+            "uuid": self.uuid,
+            "onlineStatus": 1 if self.online else 2,
+            "devName": self.name,
+            "devIconId": "device001",
+            "bindTime": int(time.time()),
+            "deviceType": self.type,
+            "subType": "eu",
+            "channels": channels,
+            "region": "eu",
+            "fmwareVersion": "9.9.9",
+            "hdwareVersion": "9.0.0",
+            "userDevIcon": "",
+            "iconType": 1,
+            "skillNumber": "",
+            "domain": domain,
+            "reservedDomain": domain
+        }
+
+    def abilities(self):
+        """Payload of the Appliance.System.Ability namespace"""
+        return {namespace: {} for namespace in
+                (NAMESPACE_ALL, NAMESPACE_ONLINE, NAMESPACE_TOGGLEX)}
+
+    def system_all(self):
+        """Payload of the Appliance.System.All namespace"""
+        return {
+            "all": {
+                "system": {
+                    "hardware": {"type": self.type, "uuid": self.uuid,
+                                 "macAddress": "00:00:00:00:00:00"},
+                    "firmware": {"version": "9.9.9", "innerIp": "127.0.0.1"},
+                    "online": {"status": 1 if self.online else 2}
+                },
+                "digest": {"togglex": self.togglex()}
+            }
+        }
+
+    def togglex(self, channels=None):
+        """State of the given channels, all of them by default, in ToggleX format"""
+        channels = range(self.channels) if channels is None else channels
+        return [{"channel": channel, "onoff": int(self.states[channel])}
+                for channel in channels]
+
+
+class FakeMerossCloud:
+    '''
+    Local stand-in of the Meross cloud, for tests and benchmarks
+
+    It serves the subset of the Meross HTTP API used by MerossHttpClient
+    (login, token check, device list, logout) and a minimal MQTT 3.1.1
+    broker over TLS on which the simulated plugs answer the commands of
+    MerossManager and push their state changes, so that MerossController
+    runs its real code path without reaching the cloud.
+
+    Every HTTP request and device command is delayed by latency_sec plus a
+    uniform random jitter of up to jitter_sec. Device commands fail with an
+    ERROR reply with probability failure_rate, and get no reply at all
+    (the client times out) with probability drop_rate. Tokens older than
+    token_ttl_sec are rejected as expired, if token_ttl_sec is positive.
+    When rate_limit_per_sec is positive, the HTTP requests and device
+    commands exceeding that many in the last second are rejected with the
+    'requested too frequently' error code.
+    '''
+
+    def __init__(self, email, password, plugs, host='127.0.0.1', http_port=0, mqtt_port=0,
+                 cert_file=None, key_file=None, latency_sec=0.0, jitter_sec=0.0,
+                 failure_rate=0.0, drop_rate=0.0, token_ttl_sec=0.0, rate_limit_per_sec=0.0, seed=None):
+        self._logger = Logger.of('FakeMerossCloud')
+        self._email = email
+        self._password = password
+        self._plugs = {plug.uuid: plug for plug in plugs}
+        self._host = host
+        self._http_port = http_port
+        self._mqtt_port = mqtt_port
+        self._cert_file = cert_file
+        self._key_file = key_file
+        self._latency_sec = latency_sec
+        self._jitter_sec = jitter_sec
+        self._failure_rate = failure_rate
+        self._drop_rate = drop_rate
+        self._token_ttl_sec = token_ttl_sec
+        self._rate_limit_per_sec = rate_limit_per_sec
+        self._request_times = collections.deque()
+        self._random = random.Random(seed)
+        self._user_id = '100000'
+        self._key = _random_id()
+        self._tokens = {}
+        self._sessions = set()
+        self._http_runner = None
+        self._mqtt_server = None
+        self.login_count = 0
+        self.command_count = 0
+        self.throttled_count = 0
+
+    @property
+    def api_base_url(self):
+        return f"http://{self._host}:{self._http_port}"
+
+    @property
+    def mqtt_address(self):
+        return (self._host, self._mqtt_port)
+
+    @property
+    def cert_file(self):
+        return self._cert_file
+
+    def plugs(self):
+        return list(self._plugs.values())
+
+    async def start(self):
+        """Start the HTTP and MQTT servers, binding free ports when the ports are 0"""
+        app = web.Application()
+        app.router.add_post('/v1/Auth/signIn', self._http_sign_in)
+        app.router.add_post('/v1/log/user', self._http_log)
+        app.router.add_post('/v1/Device/devList', self._http_device_list)
+        app.router.add_post('/v1/Hub/getSubDevices', self._http_sub_devices)
+        app.router.add_post('/v1/Profile/logout', self._http_logout)
+        self._http_runner = web.AppRunner(app, access_log=None)
+        await self._http_runner.setup()
+        site = web.TCPSite(self._http_runner, self._host, self._http_port)
+        await site.start()
+        self._http_port = self._http_runner.addresses[0][1]
+
+        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ssl_context.load_cert_chain(self._cert_file, self._key_file)
+        self._mqtt_server = await asyncio.start_server(
+            self._handle_mqtt_client, self._host, self._mqtt_port, ssl=ssl_context)
+        self._mqtt_port = self._mqtt_server.sockets[0].getsockname()[1]
+        self._logger.notice(f"Fake Meross cloud listening: API {self.api_base_url}, MQTT {self._host}:{self._mqtt_port}, {len(self._plugs)} plugs")
+
+    async def stop(self):
+        """Close the client connections and stop the servers"""
+        for session in list(self._sessions):
+            session.writer.close()
+        if self._mqtt_server:
+            self._mqtt_server.close()
+            await self._mqtt_server.wait_closed()
+            self._mqtt_server = None
+        if self._http_runner:
+            await self._http_runner.cleanup()
+            self._http_runner = None
+
+    def _rate_exceeded(self):
+        """Record a request, returning whether it exceeds the rate limit"""
+        if self._rate_limit_per_sec <= 0:
+            return False
+        now = time.monotonic()
+        while self._request_times and now - self._request_times[0] > 1.0:
+            self._request_times.popleft()
+        if len(self._request_times) >= self._rate_limit_per_sec:
+            self.throttled_count += 1
+            return True
+        self._request_times.append(now)
+        return False
+
+    async def _delay(self):
+        delay = self._latency_sec + self._random.uniform(0, self._jitter_sec)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    # HTTP API
+
+    async def _read_params(self, request):
+        body = await request.json()
+        return json.loads(base64.b64decode(body.get('params', '')) or '{}')
+
+    def _api_response(self, api_status, data=None):
+        return web.json_response({"apiStatus": api_status, "sysStatus": 0, "info": "", "timeStamp": int(time.time()), "data": data})
+
+    def _token_status(self, request):
+        """API status of the token of an authenticated request"""
+        token = request.headers.get('Authorization', '').replace('Basic', '', 1).strip()
+        issued_on = self._tokens.get(token)
+        if issued_on is None:
+            return API_TOKEN_ERROR
+        if self._token_ttl_sec > 0 and time.time() - issued_on > self._token_ttl_sec:
+            del self._tokens[token]
+            return API_TOKEN_EXPIRED
+        return API_NO_ERROR
+
+    async def _http_sign_in(self, request):
+        await self._delay()
+        if self._rate_exceeded():
+            return self._api_response(API_REQUESTED_TOO_FREQUENTLY)
+        params = await self._read_params(request)
+        if params.get('email') != self._email or params.get('password') != _md5(self._password):
+            return self._api_response(API_WRONG_CREDENTIALS)
+        token = _random_id()
+        self._tokens[token] = time.time()
+        self.login_count += 1
+        self._logger.notice(f"Login #{self.login_count} of {self._email}")
+        return self._api_response(API_NO_ERROR, {
+            "token": token,
+            "key": self._key,
+            "userid": self._user_id,
+            "email": self._email,
+            "domain": self.api_base_url,
+            "mqttDomain": self._host
+        })
+
+    async def _http_authenticated(self, request, data):
+        await self._delay()
+        if self._rate_exceeded():
+            return self._api_response(API_REQUESTED_TOO_FREQUENTLY)
+        api_status = self._token_status(request)
+        return self._api_response(api_status, data if api_status == API_NO_ERROR else None)
+
+    async def _http_log(self, request):
+        return await self._http_authenticated(request, {})
+
+    async def _http_device_list(self, request):
+        return await self._http_authenticated(
+            request, [plug.http_info(self._host) for plug in self._plugs.values()])
+
+    async def _http_sub_devices(self, request):
+        return await self._http_authenticated(request, [])
+
+    async def _http_logout(self, request):
+        response = await self._http_authenticated(request, {})
+        token = request.headers.get('Authorization', '').replace('Basic', '', 1).strip()
+        self._tokens.pop(token, None)
+        return response
+
+    # MQTT broker
+
+    async def _handle_mqtt_client(self, reader, writer):
+        session = _MqttSession(writer)
+        try:
+            packet_type, _, body = await _read_packet(reader)
+            if packet_type != _CONNECT:
+                return
+            if not self._accept_connection(body):
+                writer.write(_encode_packet(_CONNACK, 0, b'\x00\x04'))
+                return
+            writer.write(_encode_packet(_CONNACK, 0, b'\x00\x00'))
+            self._sessions.add(session)
+
+            while True:
+                packet_type, flags, body = await _read_packet(reader)
+                if packet_type == _PUBLISH:
+                    self._handle_publish(session, flags, body)
+                elif packet_type == _PUBREL:
+                    writer.write(_encode_packet(_PUBCOMP, 0, body[:2]))
+                elif packet_type == _SUBSCRIBE:
+                    writer.write(_encode_packet(_SUBACK, 0, body[:2] + session.subscribe(body)))
+                elif packet_type == _UNSUBSCRIBE:
+                    session.unsubscribe(body)
+                    writer.write(_encode_packet(_UNSUBACK, 0, body[:2]))
+                elif packet_type == _PINGREQ:
+                    writer.write(_encode_packet(_PINGRESP, 0, b''))
+                elif packet_type == _DISCONNECT:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ssl.SSLError):
+            pass
+        finally:
+            self._sessions.discard(session)
+            writer.close()
+
+    def _accept_connection(self, body):
+        """Check the user and password of a CONNECT packet against the account"""
+        _, offset = _decode_string(body, 0)
+        flags = body[offset + 1]
+        _, offset = _decode_string(body, offset + 4)
+        if flags & 0x04:
+            _, offset = _decode_string(body, offset)
+            _, offset = _decode_string(body, offset)
+        username = password = None
+        if flags & 0x80:
+            username, offset = _decode_string(body, offset)
+        if flags & 0x40:
+            password, offset = _decode_string(body, offset)
+        return username == self._user_id and password == _md5(f"{self._user_id}{self._key}")
+
+    def _handle_publish(self, session, flags, body):
+        topic, offset = _decode_string(body, 0)
+        qos = (flags >> 1) & 0x03
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            session.writer.write(_encode_packet(_PUBACK if qos == 1 else _PUBREC, 0, packet_id))
+        payload = body[offset:]
+        self._publish(topic, payload)
+
+        levels = topic.split('/')
+        if len(levels) == 4 and levels[1] == 'appliance' and levels[3] == 'subscribe':
+            plug = self._plugs.get(levels[2])
+            if plug is not None:
+                asyncio.ensure_future(self._handle_command(plug, payload))
+
+    def _publish(self, topic, payload):
+        packet = _encode_packet(_PUBLISH, 0, _encode_string(topic) + payload)
+        for session in list(self._sessions):
+            if session.is_subscribed(topic):
+                session.writer.write(packet)
+
+    # Simulated plugs
+
+    async def _handle_command(self, plug, payload):
+        """Execute a command sent to a plug and reply to its sender"""
+        message = json.loads(payload)
+        header = message['header']
+        if header.get('sign') != _md5(f"{header['messageId']}{self._key}{header['timestamp']}"):
+            self._logger.error(f"Discarding command with invalid signature for {plug.name}")
+            return
+        if header.get('method') not in ('GET', 'SET') or not plug.online:
+            return
+
+        self.command_count += 1
+        await self._delay()
+        if self._random.random() < self._drop_rate:
+            return
+        if self._rate_exceeded():
+            self._reply(plug, header, 'ERROR', {"error": {"code": API_REQUESTED_TOO_FREQUENTLY, "detail": "Requested too frequently"}})
+            return
+        if self._random.random() < self._failure_rate:
+            self._reply(plug, header, 'ERROR', {"error": {"code": 5000, "detail": "Injected failure"}})
+            return
+
+        method, namespace = header['method'], header['namespace']
+        if method == 'GET' and namespace == NAMESPACE_ABILITY:
+            self._reply(plug, header, 'GETACK', {"ability": plug.abilities()})
+        elif method == 'GET' and namespace == NAMESPACE_ALL:
+            self._reply(plug, header, 'GETACK', plug.system_all())
+        elif method == 'SET' and namespace == NAMESPACE_TOGGLEX:
+            togglex = message['payload']['togglex']
+            changes = togglex if isinstance(togglex, list) else [togglex]
+            for change in changes:
+                plug.states[change['channel']] = change['onoff'] == 1
+            self._reply(plug, header, 'SETACK', {})
+            self._push(plug, NAMESPACE_TOGGLEX,
+                       {"togglex": plug.togglex([change['channel'] for change in changes])})
+        else:
+            self._reply(plug, header, 'ERROR', {"error": {"code": 5000, "detail": f"Unsupported {method} {namespace}"}})
+
+    def _message(self, plug, method, namespace, payload, message_id=None):
+        message_id = message_id or _random_id()
+        timestamp = int(time.time())
+        return json.dumps({
+            "header": {
+                "from": f"/appliance/{plug.uuid}/publish",
+                "messageId": message_id,
+                "method": method,
+                "namespace": namespace,
+                "payloadVersion": 1,
+                "sign": _md5(f"{message_id}{self._key}{timestamp}"),
+                "timestamp": timestamp,
+                "uuid": plug.uuid
+            },
+            "payload": payload
+        }).encode('utf8')
+
+    def _reply(self, plug, header, method, payload):
+        self._publish(header['from'], self._message(
+            plug, method, header['namespace'], payload, header['messageId']))
+
+    def _push(self, plug, namespace, payload):
+        self._publish(f"/app/{self._user_id}/subscribe",
+                      self._message(plug, 'PUSH', namespace, payload))
+
+    def toggle_from_app(self, plug_uuid, channel, on):
+        """Switch a plug as the Meross app would, notifying the change with a push"""
+        plug = self._plugs[plug_uuid]
+        plug.states[channel] = on
+        self._push(plug, NAMESPACE_TOGGLEX, {"togglex": plug.togglex([channel])})
+
+    def set_online(self, plug_uuid, online):
+        """Bring a plug online or offline, notifying the change with a push"""
+        plug = self._plugs[plug_uuid]
+        plug.online = online
+        self._push(plug, NAMESPACE_ONLINE, {"online": {"status": 1 if online else 2}})
+
+
+class _MqttSession:
+
+    def __init__(self, writer):
+        self.writer = writer
+        self._filters = set()
+
+    def subscribe(self, body):
+        """Add the topic filters of a SUBSCRIBE packet, returning the granted QoS list"""
+        granted = bytearray()
+        offset = 2
+        while offset < len(body):
+            topic_filter, offset = _decode_string(body, offset)
+            self._filters.add(topic_filter)
+            granted.append(min(body[offset], 1))
+            offset += 1
+        return bytes(granted)
+
+    def unsubscribe(self, body):
+        offset = 2
+        while offset < len(body):
+            topic_filter, offset = _decode_string(body, offset)
+            self._filters.discard(topic_filter)
+
+    def is_subscribed(self, topic):
+        return any(_topic_matches(topic_filter, topic) for topic_filter in self._filters)
+
+
+def _topic_matches(topic_filter, topic):
+    filter_levels = topic_filter.split('/')
+    levels = topic.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(levels) or level not in ('+', levels[index]):
+            return False
+    return len(filter_levels) == len(levels)
+
+
+async def _read_packet(reader):
+    first_byte = (await reader.readexactly(1))[0]
+    length = 0
+    multiplier = 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7F) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+    body = await reader.readexactly(length) if length else b''
+    return first_byte >> 4, first_byte & 0x0F, body
+
+
+def _encode_packet(packet_type, flags, body):
+    length = len(body)
+    encoded_length = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        encoded_length.append(byte | 0x80 if length else byte)
+        if not length:
+            break
+    return bytes([packet_type << 4 | flags]) + bytes(encoded_length) + body
+
+
+def _encode_string(value):
+    data = value.encode('utf8')
+    return len(data).to_bytes(2, 'big') + data
+
+
+def _decode_string(data, offset):
+    length = int.from_bytes(data[offset:offset + 2], 'big')
+    return data[offset + 2:offset + 2 + length].decode('utf8', 'replace'), offset + 2 + length
+
+
+def create_plugs(specs):
+    """Create the fake plugs described by 'type:channels:count' strings, numbered by type"""
+    plugs = []
+    numbers = {}
+    for spec in specs:
+        fields = spec.split(':')
+        device_type = fields[0]
+        channels = int(fields[1]) if len(fields) > 1 else 1
+        count = int(fields[2]) if len(fields) > 2 else 1
+        for _ in range(count):
+            # Numbered across all the specs, so that the names and uuids of
+            # the plugs of the same type in different specs do not collide
+            numbers[device_type] = numbers.get(device_type, 0) + 1
+            name = f"Fake {device_type} {numbers[device_type]}"
+            # Stable uuids, so that the same plugs are found across restarts
+            plugs.append(FakePlug(_md5(name), name, device_type, channels))
+    return plugs
+
+
+def generate_certificate(directory, host='127.0.0.1'):
+    """Generate a self-signed certificate for host with openssl, unless already there"""
+    cert_file = os.path.join(directory, 'fake_meross_cloud.crt')
+    key_file = os.path.join(directory, 'fake_meross_cloud.key')
+    if not (os.path.exists(cert_file) and os.path.exists(key_file)):
+        os.makedirs(directory, exist_ok=True)
+        try:
+            alt_name = f'IP:{ipaddress.ip_address(host)}'
+        except ValueError:
+            alt_name = f'DNS:{host}'
+        subprocess.run(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+             '-keyout', key_file, '-out', cert_file, '-days', '3650',
+             '-subj', '/CN=localhost',
+             '-addext', f'subjectAltName=DNS:localhost,{alt_name}'],
+            check=True, capture_output=True)
+    return cert_file, key_file
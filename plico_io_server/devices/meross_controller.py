@@ -1,239 +1,790 @@
 import asyncio
-import os
+import concurrent.futures
 import threading
 import time
 from plico.utils.logger import Logger
 from plico.utils.decorator import override
-from meross_iot.http_api import MerossHttpClient
-from meross_iot.manager import MerossManager
-from meross_iot.model.enums import OnlineStatus
+from meross_iot.model.enums import Namespace, OnlineStatus
+from meross_iot.model.push.online import OnlinePushNotification
+from plico_io_server.devices.abstract_controller import AbstractController
+from plico_io_server.devices.device_registry import DeviceRegistry
+from plico_io_server.devices.meross_session import MerossSession
+from plico_io_server.devices.meross_watchdog import MerossWatchdog
+from plico_io_server.utils.deadline import DeadlineExceeded, boundTimeout, checkDeadline
+from plico_io_server.utils.metrics import MetricsRegistry
 
 
-class MerossController:
+class MerossController(AbstractController):
     '''
     Meross smart plug controller implementation
+    
+    Manages the devices of a Meross account whose type starts with model,
+    optionally restricted to the uuids or names listed in devices, through
+    a MerossSession that may be shared with other controllers. The status
+    is served from a cache kept current by the pushed notifications and by
+    background refreshes.
     '''
     
-    def __init__(self, name='MerossController', email=None, password=None, model=None, api_base_url='https://iotx-eu.meross.com', simulation_mode=False, **_):
+    DEFAULT_STATUS_TTL_SEC = 5.0
+    DEFAULT_PUSH_SILENCE_SEC = 300.0
+    DEFAULT_RATE_LIMIT_PER_SEC = MerossSession.DEFAULT_RATE_LIMIT_PER_SEC
+    DEFAULT_RATE_LIMIT_BURST = MerossSession.DEFAULT_RATE_LIMIT_BURST
+    DEFAULT_STATUS_TIMEOUT_SEC = 5.0
+    DEFAULT_COMMAND_TIMEOUT_SEC = 10.0
+    DEFAULT_INIT_TIMEOUT_SEC = 15.0
+    DEFAULT_CLEANUP_TIMEOUT_SEC = MerossSession.DEFAULT_CLEANUP_TIMEOUT_SEC
+    
+    STATE_INITIALIZING = 'initializing'
+    STATE_READY = 'ready'
+    STATE_DEGRADED = 'degraded'
+    STATE_FAILED = 'failed'
+    
+    # Reasons of a recovery
+    RECOVERY_INITIALIZATION = 'initialization'
+    RECOVERY_SESSION = 'session'
+    RECOVERY_RECONNECTED = 'reconnected'
+    
+    # Outcome of a switching command
+    COMMAND_SENT = 'sent'
+    COMMAND_SKIPPED = 'skipped'
+    COMMAND_COALESCED = 'coalesced'
+    COMMAND_EXPIRED = 'expired'
+    
+    # Push notifications carrying the state of the channels
+    STATE_NAMESPACES = (Namespace.CONTROL_TOGGLEX, Namespace.CONTROL_TOGGLE)
+    
+    def __init__(self, name='MerossController', email=None, password=None, model=None, api_base_url=MerossSession.DEFAULT_API_BASE_URL, simulation_mode=False, status_ttl_sec=DEFAULT_STATUS_TTL_SEC, push_updates=True, push_silence_sec=DEFAULT_PUSH_SILENCE_SEC, devices=None, discovery_cache_file=None, credentials_cache_file=None, mqtt_override_server=None, mqtt_ca_cert=None, rate_limit_per_sec=DEFAULT_RATE_LIMIT_PER_SEC, rate_limit_burst=DEFAULT_RATE_LIMIT_BURST, breaker_failure_threshold=MerossSession.DEFAULT_BREAKER_FAILURE_THRESHOLD, breaker_reset_sec=MerossSession.DEFAULT_BREAKER_RESET_SEC, init_timeout_sec=DEFAULT_INIT_TIMEOUT_SEC, command_timeout_sec=DEFAULT_COMMAND_TIMEOUT_SEC, status_timeout_sec=DEFAULT_STATUS_TIMEOUT_SEC, cleanup_timeout_sec=DEFAULT_CLEANUP_TIMEOUT_SEC, metrics=None, session=None, **_):
         self._name = name
         self._logger = Logger.of(f'MerossController({name} - {model})')
-        self._email = email
-        self._password = password
-        self._api_base_url = api_base_url
         self._simulation_mode = simulation_mode
         self._model = model
-        self._target_device = None
-        self._manager = None
-        self._http_client = None
+        self._device_filter = [device_id.strip() for device_id in (devices or []) if device_id.strip()]
+        self._devices = DeviceRegistry()
+        self._session = session
+        self._owns_session = False
         self._loop = None
-        self._thread = None
         self._initialized = False
+        self._state = self.STATE_INITIALIZING
+        self._init_error = None
+        self._session_generation = None
+        self._watchdog = None
+        self._init_future = None
+        self._init_timeout_sec = init_timeout_sec
+        self._command_timeout_sec = command_timeout_sec
+        # A command may wait for the one being sent on the same channel
+        self._queued_command_timeout_sec = 2 * command_timeout_sec + 1
+        self._status_timeout_sec = status_timeout_sec
+        self._cleanup_timeout_sec = cleanup_timeout_sec
+        self._status_ttl_sec = status_ttl_sec
+        self._status_lock = threading.Lock()
+        self._cached_status = {}
+        self._status_timestamps = {}
+        self._refresh_task = None
+        self._refresh_future = None
+        self._refresher_future = None
+        self._push_updates = push_updates
+        self._push_silence_sec = push_silence_sec
+        self._push_connected = False
+        self._last_push_activity = None
+        self._discovery_future = None
+        self._channel_queues = {}
+        # uuid -> {channel: state requested by a command, not confirmed yet}
+        self._unconfirmed = {}
+        # uuid -> time of the last push notification of the channel states
+        self._state_push_times = {}
+        self._status_listeners = []
+        self._create_metrics(metrics if metrics is not None else MetricsRegistry())
         
         if not self._simulation_mode:
-            if email is None or password is None:
-                self._logger.error("Email and password are required for Meross controller")
-                self._logger.notice("Falling back to simulation mode")
-                self._simulation_mode = True
-            elif model is None:
-                self._logger.error("Model (device_type) is required for Meross controller")
-                self._logger.notice("Falling back to simulation mode")
-                self._simulation_mode = True
+            if session is None and (email is None or password is None):
+                self._init_error = "Email and password are required for Meross controller"
+                self._logger.error(self._init_error)
+                self._state = self.STATE_FAILED
             else:
-                self._initialize_async_loop()
+                if session is None:
+                    self._session = MerossSession(
+                        email, password, api_base_url,
+                        discovery_cache_file=discovery_cache_file,
+                        credentials_cache_file=credentials_cache_file,
+                        mqtt_override_server=mqtt_override_server,
+                        mqtt_ca_cert=mqtt_ca_cert,
+                        rate_limit_per_sec=rate_limit_per_sec,
+                        rate_limit_burst=rate_limit_burst,
+                        breaker_failure_threshold=breaker_failure_threshold,
+                        breaker_reset_sec=breaker_reset_sec,
+                        metrics=self._metrics)
+                    self._owns_session = True
+                    # A shared session is supervised by its owner
+                    self._watchdog = MerossWatchdog(self._session.loop_thread, metrics=self._metrics)
+                    self._watchdog.watch(self)
+                self._start_session()
+                if self._watchdog is not None:
+                    self._watchdog.start()
         
         if self._simulation_mode:
             self._logger.notice("Running in simulation mode")
-            self._target_device = {
-                "name": self._name or f"Simulated {self._model or 'Device'}",
-                "model": self._model or "simulated",
-                "status": False,
-                "online": True
-            }
+            self._create_simulated_devices()
             self._initialized = True
+            self._state = self.STATE_READY
     
-    def _initialize_async_loop(self):
-        """Initialize the async event loop in a background thread"""
-        if os.name == 'nt':
-            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-        
-        self._loop = asyncio.new_event_loop()
-        
-        # Start the event loop in a separate thread
-        self._thread = threading.Thread(target=self._run_event_loop, daemon=True)
-        self._thread.start()
-        
-        # Give the event loop time to start
-        time.sleep(1)
-        
-        # Initialize the client and manager
-        future = asyncio.run_coroutine_threadsafe(self._initialize_client(), self._loop)
+    def _create_metrics(self, metrics):
+        """Create the metrics of the push notifications, the status cache and the commands"""
+        self._metrics = metrics
+        self._push_notifications = metrics.counter('meross_push_notifications_total', 'Notifications pushed by the Meross cloud')
+        self._status_age = metrics.gauge('meross_status_age_seconds', 'Age of the oldest entry of the status cache')
+        self._status_age.setFunction(self._oldest_status_age)
+        self._command_outcomes = {
+            outcome: metrics.counter('meross_commands_total', 'Switching commands by outcome', outcome=outcome)
+            for outcome in (self.COMMAND_SENT, self.COMMAND_SKIPPED, self.COMMAND_COALESCED, self.COMMAND_EXPIRED)}
+        self._optimistic_results = {
+            result: metrics.counter('meross_optimistic_states_total', 'Optimistic channel states by result', result=result)
+            for result in ('confirmed', 'rolled_back')}
+    
+    def _oldest_status_age(self):
+        """Age of the oldest entry of the status cache, None if it is empty"""
+        with self._status_lock:
+            if not self._status_timestamps:
+                return None
+            return time.time() - min(self._status_timestamps.values())
+    
+    def _create_simulated_devices(self):
+        """Create one simulated device for each entry of the device filter"""
+        names = self._device_filter or [self._name or f"Simulated {self._model or 'Device'}"]
+        registry = DeviceRegistry()
+        for index, device_name in enumerate(names):
+            device = _SimulatedDevice(f"simulated-{index}", device_name, self._model or "simulated")
+            registry.add(device, device.uuid, device.name, device.type)
+        self._devices = registry
+    
+    def _start_session(self):
+        """Start the event loop of the session and initialize the client and devices in background"""
+        self._loop = self._session.loop
+        self._session.start()
+        self._init_future = self._session.run(self._async_initialize())
+    
+    async def _async_initialize(self):
+        """Initialize the client and the devices, then mark the controller as ready or failed"""
+        start_time = time.time()
         try:
-            future.result(timeout=15)
-            self._initialized = True
-            self._logger.notice(f"Meross controller initialized. Target device found: {self._target_device is not None}")
-            if not self._target_device:
-                self._logger.error(f"Could not find a Meross device matching model '{self._model}'")
+            await asyncio.wait_for(self._initialize_client(), timeout=self._init_timeout_sec)
         except asyncio.TimeoutError:
-            self._logger.error("Timeout initializing Meross client or finding device")
-            self._simulation_mode = True
+            self._initialization_failed("Timeout initializing Meross client or finding devices")
+            return
         except Exception as e:
-            self._logger.error(f"Error initializing Meross client: {str(e)}")
-            self._simulation_mode = True
+            self._initialization_failed(f"Error initializing Meross client: {str(e)}")
+            return
+        
+        self._initialized = True
+        self._state = self.STATE_READY
+        self._init_error = None
+        self._logger.notice(f"Meross controller initialized in {time.time() - start_time:.2f}s. Managed devices: {len(self._devices)}")
+        if not len(self._devices):
+            self._logger.error(f"Could not find any Meross device matching model '{self._model}'")
+        else:
+            self._start_status_refresher()
+        if self._session.warm_start:
+            self._discovery_future = self._session.run(self._async_revalidate_discovery())
+    
+    def _initialization_failed(self, error):
+        """Record an initialization failure, the watchdog retries it"""
+        self._logger.error(f"{error}, the controller is degraded until it reconnects")
+        self._init_error = error
+        self._state = self.STATE_DEGRADED
     
-    def _run_event_loop(self):
-        """Run the asyncio event loop in a background thread"""
-        asyncio.set_event_loop(self._loop)
-        self._loop.run_forever()
+    @property
+    def session(self):
+        """MerossSession of the controller, None in simulation mode"""
+        return self._session
+    
+    def is_ready(self):
+        """Check whether the controller is initialized and connected"""
+        return self._state == self.STATE_READY
+    
+    def recovery_reason(self):
+        """Why the controller needs to be initialized again, None if it does not"""
+        if self._session is None or self._state in (self.STATE_INITIALIZING, self.STATE_FAILED):
+            return None
+        if self._init_future is not None and not self._init_future.done():
+            # A recovery is in progress
+            return None
+        if self._state == self.STATE_DEGRADED:
+            return self.RECOVERY_INITIALIZATION
+        if not self._session.is_healthy():
+            return self.RECOVERY_SESSION
+        if self._session.generation != self._session_generation:
+            return self.RECOVERY_RECONNECTED
+        return None
+    
+    def recover(self, reason):
+        """Initialize the controller again, on a new cloud connection if the session is unhealthy.
+        
+        Called by the watchdog thread. The controller is degraded until the
+        initialization succeeds.
+        """
+        self._logger.notice(f"Recovering the Meross controller ({reason})")
+        self._state = self.STATE_DEGRADED
+        for future in (self._init_future, self._refresher_future, self._discovery_future):
+            if future is not None:
+                future.cancel()
+        self._refresher_future = self._discovery_future = None
+        self._refresh_task = self._refresh_future = None
+        # The queued commands belong to the previous initialization
+        self._channel_queues = {}
+        self._push_connected = False
+        if reason == self.RECOVERY_SESSION and not self._session.is_healthy():
+            self._session.run(self._session.async_reset())
+        self._start_session()
     
     async def _initialize_client(self):
-        """Initialize the Meross HTTP client, manager, and find the target device."""
+        """Connect the session to the Meross cloud and find the managed devices."""
+        if self._push_updates:
+            self._session.remove_push_handler(self._async_handle_push_notification)
+            self._session.add_push_handler(self._async_handle_push_notification)
         try:
-            self._http_client = await MerossHttpClient.async_from_user_password(
-                api_base_url=self._api_base_url,
-                email=self._email,
-                password=self._password
-            )
-            
-            self._manager = MerossManager(http_client=self._http_client)
-            await self._manager.async_init()
+            await self._session.async_connect()
+            self._session_generation = self._session.generation
+            self._register_managed_devices()
             
-            # Discover devices
-            await self._manager.async_device_discovery()
-            await asyncio.sleep(5)
-            
-            found_devices = self._manager.find_devices()
-            self._logger.notice(f"Found {len(found_devices)} Meross devices associated with the account.")
-            
-            for device in found_devices:
-                # Perform case-insensitive comparison
-                device_type_lower = getattr(device, 'type', '').lower()
-                target_model_lower = (self._model or '').lower()
-
-                if device_type_lower and target_model_lower and device_type_lower.startswith(target_model_lower):
-                    await device.async_update() # Get latest state
-                    if self._target_device is None:
-                        self._target_device = device
-                        self._logger.notice(f"Target device found: Name='{device.name}', Type='{device.type}', UUID='{device.uuid}'")
-                    else:
-                        self._logger.warning(f"Found multiple devices matching model '{self._model}'. Using the first one found: '{self._target_device.name}'.")
-                        break
-            
-            if self._target_device is None:
-                self._logger.error(f"No online device found matching model type '{self._model}'. Available devices: {[(d.name, d.type, d.online_status) for d in found_devices]}")
+            if not self._session.warm_start:
+                # Get the latest state of all the devices at once
+                errors = await self._async_update_devices(self._devices.devices())
+                if len(errors) < len(self._devices):
+                    self._mark_push_activity()
         except Exception as e:
             self._logger.error(f"Failed during Meross client/device initialization: {str(e)}")
-            if self._manager:
-                self._manager.close()
-            if self._http_client:
-                await self._http_client.async_logout()
-            self._http_client = None
-            self._manager = None
+            self._session.remove_push_handler(self._async_handle_push_notification)
             raise
     
+    async def _async_revalidate_discovery(self):
+        """Replace the devices loaded from the discovery cache with a new discovery"""
+        try:
+            await self._session.async_revalidate_discovery()
+        except Exception as e:
+            self._logger.error(f"Background device discovery failed, keeping the cached devices: {str(e)}")
+            return
+        self._register_managed_devices()
+        await self._async_refresh_status()
+    
+    def _register_managed_devices(self):
+        """Rebuild the registry of the managed devices from the devices known to the manager"""
+        found_devices = self._session.manager.find_devices()
+        self._logger.notice(f"Found {len(found_devices)} Meross devices associated with the account.")
+        
+        registry = DeviceRegistry()
+        for device in found_devices:
+            if self._is_managed(device):
+                registry.add(device, device.uuid, device.name, device.type)
+                if device.uuid not in self._devices:
+                    self._logger.notice(f"Managing device: Name='{device.name}', Type='{device.type}', UUID='{device.uuid}', Firmware='{device.firmware_version}'")
+        
+        if not len(registry):
+            self._logger.error(f"No device found matching model type '{self._model}' and devices {self._device_filter}. Available devices: {[(d.name, d.type, d.online_status) for d in found_devices]}")
+        self._devices = registry
+        
+        # Forget the status of the devices that are no longer managed
+        with self._status_lock:
+            for uuid in list(self._cached_status):
+                if uuid not in registry:
+                    del self._cached_status[uuid]
+                    del self._status_timestamps[uuid]
+                    self._unconfirmed.pop(uuid, None)
+    
+    def _is_managed(self, device):
+        """Check whether a discovered device matches the model and the device filter"""
+        # Perform case-insensitive comparisons
+        device_type_lower = (getattr(device, 'type', '') or '').lower()
+        if self._model and not device_type_lower.startswith(self._model.lower()):
+            return False
+        if not self._device_filter:
+            return True
+        wanted = {device_id.lower() for device_id in self._device_filter}
+        return device.uuid.lower() in wanted or (device.name or '').lower() in wanted
+    
+    async def _async_update_devices(self, devices):
+        """Update the given devices concurrently and return the errors by uuid"""
+        results = await asyncio.gather(
+            *(self._session.async_call('update', device.async_update(), self._status_timeout_sec)
+              for device in devices),
+            return_exceptions=True)
+        errors = {}
+        for device, result in zip(devices, results):
+            if isinstance(result, Exception):
+                errors[device.uuid] = str(result) or type(result).__name__
+                self._logger.error(f"Error getting status of device '{device.name}': {errors[device.uuid]}")
+        return errors
+    
+    def _start_status_refresher(self):
+        """Start the background task refreshing the status cache"""
+        if self._status_ttl_sec > 0:
+            self._refresher_future = asyncio.run_coroutine_threadsafe(
+                self._status_refresh_loop(), self._loop)
+    
+    async def _status_refresh_loop(self):
+        """Refresh the status cache every status_ttl_sec seconds"""
+        while True:
+            await self._async_refresh_status()
+            await asyncio.sleep(self._status_ttl_sec)
+    
+    async def _async_refresh_status(self):
+        """Refresh the status cache, joining an update already in progress"""
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.ensure_future(self._async_update_cached_status())
+        await asyncio.shield(self._refresh_task)
+    
+    async def _async_update_cached_status(self):
+        """Update the status cache, polling the cloud only if push updates are not flowing"""
+        devices = self._devices.devices()
+        if self._push_channel_alive():
+            # The optimistic states not confirmed by a push yet are checked
+            unconfirmed = [device for device in devices if self._unconfirmed.get(device.uuid)]
+            errors = await self._async_update_devices(unconfirmed) if unconfirmed else {}
+            self._store_device_status(devices, errors)
+            return
+        
+        errors = await self._async_update_devices(devices)
+        if len(errors) < len(devices):
+            # A successful update proves that the MQTT connection is up
+            self._mark_push_activity()
+        
+        # On error a device keeps its last known state
+        self._store_device_status(devices, errors)
+    
+    def _store_device_status(self, devices, errors=None, confirm=True):
+        """Store the last known state of the given devices in the status cache.
+        
+        Unless confirm is False, the state of the devices updated without
+        error confirms or rolls back their optimistic channel states.
+        """
+        errors = errors or {}
+        statuses = {}
+        for device in devices:
+            status = statuses[device.uuid] = self._device_status(device)
+            status["error"] = errors.get(device.uuid)
+            if confirm and status["error"] is None and status["channels"]:
+                self._confirm_channels(device, status)
+            status["unconfirmed"] = sorted(self._unconfirmed.get(device.uuid, {}))
+        now = time.time()
+        with self._status_lock:
+            changed = any(self._cached_status.get(uuid) != status for uuid, status in statuses.items())
+            self._cached_status.update(statuses)
+            self._status_timestamps.update((uuid, now) for uuid in statuses)
+        if changed:
+            self._notify_status_listeners()
+    
+    def _confirm_channels(self, device, status):
+        """Confirm the optimistic states of a device matching its actual state, rolling back the others"""
+        for channel, requested in self._unconfirmed.pop(device.uuid, {}).items():
+            actual = status["channels"].get(channel)
+            if actual == requested:
+                self._optimistic_results['confirmed'].inc()
+            else:
+                self._optimistic_results['rolled_back'].inc()
+                self._logger.notice(f"Device '{device.name}' channel {channel} is {'ON' if actual else 'OFF'} "
+                                    f"instead of {'ON' if requested else 'OFF'}, rolling back its optimistic state")
+    
+    def _apply_optimistic_state(self, device, channel, on, sent_time):
+        """Show the state requested by an acknowledged command at once, until the device confirms it"""
+        with self._status_lock:
+            status = self._cached_status.get(device.uuid)
+        if status is None or not status["channels"]:
+            # The state of the device is not known yet, the next refresh reports it
+            return
+        if self._state_push_times.get(device.uuid, 0) >= sent_time and status["channels"].get(channel) == on:
+            # Already confirmed by the state the device pushed meanwhile
+            self._optimistic_results['confirmed'].inc()
+            return
+        self._unconfirmed.setdefault(device.uuid, {})[channel] = on
+        status = dict(status, channels=dict(status["channels"]))
+        status["channels"][channel] = on
+        status["status"] = status["channels"].get(0, on)
+        status["unconfirmed"] = sorted(self._unconfirmed[device.uuid])
+        with self._status_lock:
+            self._cached_status[device.uuid] = status
+        self._notify_status_listeners()
+    
+    def _notify_status_listeners(self):
+        """Tell the status listeners that the status changed"""
+        for listener in list(self._status_listeners):
+            try:
+                listener()
+            except Exception as e:
+                self._logger.error(f"Error notifying a status listener: {str(e)}")
+    
+    def _mark_push_activity(self):
+        """Record that the push channel is connected and the device state is current"""
+        self._push_connected = True
+        self._last_push_activity = time.time()
+    
+    def _push_channel_alive(self):
+        """Check whether the device state can be trusted without polling the cloud"""
+        if not self._push_updates or not self._push_connected:
+            return False
+        return time.time() - self._last_push_activity < self._push_silence_sec
+    
+    async def _async_handle_push_notification(self, push_notification, target_devices, manager):
+        """Keep the status cache current with the notifications pushed by the Meross cloud"""
+        uuid = push_notification.originating_device_uuid
+        if uuid not in self._devices:
+            return
+        self._push_notifications.inc()
+        
+        # The manager notifies an UNKNOWN online status when the MQTT connection drops
+        online = (push_notification.raw_data or {}).get('online', {})
+        if isinstance(push_notification, OnlinePushNotification) and online.get('status') == OnlineStatus.UNKNOWN.value:
+            if self._push_connected:
+                self._logger.notice("Push channel connection dropped, falling back to polling")
+            self._push_connected = False
+        else:
+            self._mark_push_activity()
+        # Only a pushed channel state confirms the optimistic states
+        pushed_state = push_notification.namespace in self.STATE_NAMESPACES
+        if pushed_state:
+            self._state_push_times[uuid] = time.time()
+        self._store_device_status([self._devices.lookup(uuid)], confirm=pushed_state)
+    
+    def _device_status(self, device):
+        """Build the status dictionary of a device from its last known state"""
+        status = {
+            "uuid": device.uuid,
+            "name": getattr(device, 'name', 'N/A'),
+            "model": getattr(device, 'type', self._model),
+            "online": getattr(device, 'online_status', OnlineStatus.UNKNOWN) == OnlineStatus.ONLINE,
+            "status": None,
+            "channels": {},
+            "unconfirmed": [],
+            "error": None
+        }
+        # The state of a device is unknown until its first full update
+        if hasattr(device, 'is_on') and getattr(device, 'last_full_update_timestamp', None) is not None:
+            channels = [channel.index for channel in getattr(device, 'channels', [])] or [0]
+            status["channels"] = {channel: device.is_on(channel=channel) for channel in channels}
+            status["status"] = status["channels"].get(0, status["channels"][channels[0]])
+        return status
+    
+    def _read_status(self, deadline=None):
+        """Get the status of the managed devices and the age of the oldest one from the cache.
+        
+        Stale entries are returned as they are, while a refresh is triggered
+        in background (stale-while-revalidate). The cloud is waited for only
+        when the cache is still empty or disabled, and not past the deadline.
+        """
+        if self._status_ttl_sec <= 0 or not self._cached_status:
+            checkDeadline(deadline, "status request")
+            future = asyncio.run_coroutine_threadsafe(self._async_refresh_status(), self._loop)
+            try:
+                future.result(timeout=boundTimeout(self._status_timeout_sec + 1, deadline))
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                checkDeadline(deadline, "status request")
+                raise
+        
+        with self._status_lock:
+            statuses = dict(self._cached_status)
+            age_sec = time.time() - min(self._status_timestamps.values())
+        
+        if age_sec > self._status_ttl_sec > 0:
+            if self._refresh_future is None or self._refresh_future.done():
+                self._refresh_future = asyncio.run_coroutine_threadsafe(
+                    self._async_refresh_status(), self._loop)
+        return statuses, age_sec
+    
+    @override
     def name(self):
         """Get the name of the controller"""
         return self._name
     
+    @override
     def terminate(self):
         """Terminate the controller instance"""
         return self.deinitialize()
     
+    @override
     def deinitialize(self):
         """Clean up resources"""
-        if self._loop and self._loop.is_running():
-            if not self._simulation_mode and self._initialized:
-                future = asyncio.run_coroutine_threadsafe(self._cleanup(), self._loop)
-                try:
-                    future.result(timeout=5)
-                except Exception as e:
-                    self._logger.error(f"Error during cleanup: {str(e)}")
-            
-            self._loop.call_soon_threadsafe(self._loop.stop)
-        if self._thread and self._thread.is_alive():
-            self._thread.join(timeout=5)
-            if self._thread.is_alive():
-                self._logger.warning("Event loop thread did not terminate cleanly.")
+        if self._init_future and not self._init_future.done():
+            self._init_future.cancel()
+        if self._refresher_future:
+            self._refresher_future.cancel()
+            self._refresher_future = None
+        if self._discovery_future:
+            self._discovery_future.cancel()
+            self._discovery_future = None
+        if self._watchdog is not None:
+            self._watchdog.stop()
+            self._watchdog = None
+        if self._session is not None:
+            self._session.remove_push_handler(self._async_handle_push_notification)
+            # A shared session is closed by its owner
+            if self._owns_session:
+                self._session.close(self._cleanup_timeout_sec)
         
         self._initialized = False
     
-    async def _cleanup(self):
-        """Clean up the Meross manager and client"""
-        if self._manager:
-            self._manager.close()
-            self._manager = None
-        if self._http_client:
-            try:
-                await self._http_client.async_logout()
-            except Exception as e:
-                self._logger.error(f"Error logging out http client: {e}")
-            self._http_client = None
+    def _find_device(self, device_id):
+        """Resolve a device identifier, returning None if no managed device matches"""
+        try:
+            return self._devices.lookup(device_id)
+        except KeyError:
+            return None
     
-    def turnOn(self, channel=0):
-        """Turn on the target device."""
-        if not self._target_device:
-            self._logger.error(f"Cannot turn on: No target device '{self._model}' found or initialized.")
-            return False
+    def _unavailable_reason(self):
+        """Why commands cannot be sent to the cloud, None if they can"""
+        if self._simulation_mode:
+            return None
+        if self._state == self.STATE_INITIALIZING:
+            return "Meross controller still initializing"
+        if self._state == self.STATE_FAILED:
+            return f"Meross controller failed: {self._init_error}"
+        if not self._initialized:
+            return f"Meross controller degraded, reconnecting: {self._init_error}"
+        if not self._loop or not self._loop.is_running():
+            return "Meross event loop stopped"
+        return None
+    
+    def _switch(self, device_id, channel, on, force=False, deadline=None):
+        """Turn a channel of a device on or off, returning the result of the command.
         
-        self._logger.notice(f"Turning on target device (Channel: {channel})")
+        The result is a dictionary with the device, its uuid once found,
+        channel, state, success and error of the command, and its outcome: sent, skipped because
+        the channel is known to be in that state already, coalesced with a
+        later command for the same channel, or expired because its deadline
+        passed before it could be sent.
+        """
+        action = "ON" if on else "OFF"
+        result = {"device": device_id, "uuid": None, "channel": channel, "state": on, "success": False, "error": None, "outcome": None}
+        if self._expired(result, deadline):
+            self._logger.error(f"Cannot turn {action.lower()}: {result['error']}.")
+            return result
+        result["error"] = self._unavailable_reason()
+        device = self._find_device(device_id)
+        if device is None and result["error"] is None:
+            result["error"] = f"No device '{device_id if device_id is not None else self._model}' found"
+        elif device is not None:
+            result["uuid"] = device.uuid
+        if result["error"]:
+            self._logger.error(f"Cannot turn {action.lower()}: {result['error']}.")
+            return result
         
         if self._simulation_mode:
-            self._target_device["status"] = True
-            self._logger.notice(f"Simulated device '{self._target_device['name']}' turned ON.")
-            return True
-        
-        if not self._initialized or not self._loop or not self._loop.is_running():
-            self._logger.error("Cannot turn on: Meross controller not initialized or event loop stopped.")
-            return False
+            result["outcome"] = self._switch_simulated(device, channel, on, force)
+            result["success"] = True
+            self._logger.notice(f"Simulated device '{device.name}' channel {channel} {action}: {result['outcome']}.")
+            return result
         
         future = asyncio.run_coroutine_threadsafe(
-            self._target_device.async_turn_on(channel=channel),
-            self._loop
-        )
+            self._async_set_channel(device, channel, on, force, deadline), self._loop)
         try:
-            result = future.result(timeout=10)
-            self._logger.notice(f"Turn ON command successful for '{self._target_device.name}'.")
-            return result if result is not None else True
+            result["outcome"] = future.result(timeout=boundTimeout(self._queued_command_timeout_sec, deadline))
+            result["success"] = True
+            self._logger.notice(f"Turn {action} command for '{device.name}' channel {channel}: {result['outcome']}.")
         except Exception as e:
-            self._logger.error(f"Error turning ON target device '{self._target_device.name}': {str(e)}")
-            return False
+            future.cancel()
+            if not self._expired(result, deadline, e):
+                result["error"] = str(e) or type(e).__name__
+            self._logger.error(f"Error turning {action} device '{device.name}': {result['error']}")
+        return result
     
-    def turnOff(self, channel=0):
-        """Turn off the target device."""
-        if not self._target_device:
-            self._logger.error(f"Cannot turn off: No target device '{self._model}' found or initialized.")
-            return False
+    def _expired(self, result, deadline, error=None):
+        """Mark the result of a command as expired if its deadline has passed or error is DeadlineExceeded, returning True if it is"""
+        if not isinstance(error, DeadlineExceeded):
+            try:
+                checkDeadline(deadline, "command")
+            except DeadlineExceeded as e:
+                error = e
+            else:
+                return False
+        self._command_outcomes[self.COMMAND_EXPIRED].inc()
+        result["outcome"] = self.COMMAND_EXPIRED
+        result["error"] = str(error)
+        return True
+    
+    def _switch_simulated(self, device, channel, on, force):
+        """Switch a simulated device, returning the outcome of the command"""
+        if not force and device.is_on(channel) == on:
+            outcome = self.COMMAND_SKIPPED
+        else:
+            device.set_on(channel, on)
+            outcome = self.COMMAND_SENT
+            self._notify_status_listeners()
+        self._command_outcomes[outcome].inc()
+        return outcome
+    
+    def _known_state(self, device, channel):
+        """State of a channel if it is known to be current, None otherwise"""
+        if getattr(device, 'last_full_update_timestamp', None) is None:
+            return None
+        if not self._push_channel_alive():
+            with self._status_lock:
+                updated = self._status_timestamps.get(device.uuid)
+            if updated is None or time.time() - updated > self._status_ttl_sec:
+                return None
+        return device.is_on(channel=channel)
+    
+    def _async_switch(self, device, channel, on):
+        """Coroutine turning a channel of a Meross device on or off"""
+        if on:
+            return device.async_turn_on(channel=channel)
+        return device.async_turn_off(channel=channel)
+    
+    async def _async_set_channel(self, device, channel, on, force=False, deadline=None):
+        """Queue a command for a channel and wait for its outcome.
         
-        self._logger.notice(f"Turning off target device (Channel: {channel})")
+        A channel has at most one command being sent and one waiting: a
+        newer command replaces the waiting one, whose outcome is coalesced.
+        A command still waiting at its deadline is dropped.
+        """
+        queue = self._channel_queues.get((device.uuid, channel))
+        if queue is None:
+            queue = self._channel_queues[(device.uuid, channel)] = _ChannelQueue()
+        if queue.waiting is not None:
+            self._resolve_command(queue.waiting[2], self.COMMAND_COALESCED)
+        future = self._loop.create_future()
+        queue.waiting = (on, force, future, deadline)
+        if queue.worker is None or queue.worker.done():
+            queue.worker = asyncio.ensure_future(self._async_channel_worker(device, channel, queue))
+        return await future
+    
+    async def _async_channel_worker(self, device, channel, queue):
+        """Send the commands queued for a channel, one at a time"""
+        while queue.waiting is not None:
+            on, force, future, deadline = queue.waiting
+            queue.waiting = None
+            if future.done():
+                # The caller gave up waiting
+                continue
+            if not force and self._known_state(device, channel) == on:
+                self._resolve_command(future, self.COMMAND_SKIPPED)
+                continue
+            sent_time = time.time()
+            try:
+                await self._session.async_call('switch', self._async_switch(device, channel, on), self._command_timeout_sec, deadline)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self._apply_optimistic_state(device, channel, on, sent_time)
+                self._resolve_command(future, self.COMMAND_SENT)
+    
+    def _resolve_command(self, future, outcome):
+        """Report the outcome of a queued command to its caller"""
+        self._command_outcomes[outcome].inc()
+        if not future.done():
+            future.set_result(outcome)
+    
+    async def _async_switch_many(self, commands, deadline=None):
+        """Queue the (device, channel, on, force) commands concurrently, returning the outcome or exception of each"""
+        return await asyncio.gather(
+            *(self._async_set_channel(device, channel, on, force, deadline) for device, channel, on, force in commands),
+            return_exceptions=True)
+    
+    @override
+    def setStates(self, states, deadline=None):
+        """Switch many device channels at once.
         
-        if self._simulation_mode:
-            self._target_device["status"] = False
-            self._logger.notice(f"Simulated device '{self._target_device['name']}' turned OFF.")
-            return True
+        states is a list of (device_id, channel, state) entries, optionally
+        followed by a force flag. The commands are sent concurrently, so the
+        whole batch takes about one cloud round-trip, and of several entries
+        for the same channel only the last one is sent. The commands not
+        sent by the deadline are dropped. Returns one dictionary per entry,
+        in the same order, with the device, its uuid, channel, state,
+        success, error and outcome of the command.
+        """
+        results = []
+        commands = []
+        for entry in states:
+            device_id, channel, state = entry[:3]
+            force = bool(entry[3]) if len(entry) > 3 else False
+            on = bool(state)
+            result = {"device": device_id, "uuid": None, "channel": channel, "state": on, "success": False, "error": None, "outcome": None}
+            results.append(result)
+            device = self._find_device(device_id)
+            if device is None:
+                result["error"] = f"Unknown device '{device_id}'"
+                continue
+            result["uuid"] = device.uuid
+            if self._expired(result, deadline):
+                pass
+            elif self._simulation_mode:
+                result["outcome"] = self._switch_simulated(device, channel, on, force)
+                result["success"] = True
+            else:
+                commands.append((result, (device, channel, on, force)))
         
-        if not self._initialized or not self._loop or not self._loop.is_running():
-            self._logger.error("Cannot turn off: Meross controller not initialized or event loop stopped.")
-            return False
+        if commands:
+            unavailable = self._unavailable_reason()
+            if unavailable:
+                for result, _ in commands:
+                    result["error"] = unavailable
+            else:
+                future = asyncio.run_coroutine_threadsafe(
+                    self._async_switch_many([command for _, command in commands], deadline), self._loop)
+                try:
+                    outcomes = future.result(timeout=boundTimeout(self._queued_command_timeout_sec, deadline))
+                except Exception as e:
+                    future.cancel()
+                    outcomes = [e] * len(commands)
+                for (result, _), outcome in zip(commands, outcomes):
+                    if isinstance(outcome, BaseException):
+                        if not self._expired(result, deadline, outcome):
+                            result["error"] = str(outcome) or type(outcome).__name__
+                    else:
+                        result["outcome"] = outcome
+                        result["success"] = True
         
-        future = asyncio.run_coroutine_threadsafe(
-            self._target_device.async_turn_off(channel=channel),
-            self._loop
-        )
-        try:
-            result = future.result(timeout=10)
-            self._logger.notice(f"Turn OFF command successful for '{self._target_device.name}'.")
-            return result if result is not None else True
-        except Exception as e:
-            self._logger.error(f"Error turning OFF target device '{self._target_device.name}': {str(e)}")
-            return False
+        failed = [result for result in results if not result["success"]]
+        sent = [result for result in results if result["outcome"] == self.COMMAND_SENT]
+        self._logger.notice(f"Switched {len(results) - len(failed)}/{len(results)} channels, {len(sent)} commands sent")
+        for result in failed:
+            self._logger.error(f"Error switching device '{result['device']}' channel {result['channel']}: {result['error']}")
+        return results
+    
+    @override
+    def setState(self, device_id=None, channel=0, state=True, force=False, deadline=None):
+        """Switch a channel of a device, returning the result of the command.
+        
+        Unless force is True, the command is not sent when the channel is
+        known to be in the requested state already. The result has the
+        device, its uuid, channel, state, success, error and outcome of the
+        command.
+        """
+        return self._switch(device_id, channel, bool(state), force, deadline)
     
-    def getStatus(self):
-        """Get the current status of the target device."""
+    def turnOn(self, device_id=None, channel=0, force=False, deadline=None):
+        """Turn on a device, the target device if device_id is None."""
+        return self._switch(device_id, channel, True, force, deadline)["success"]
+    
+    def turnOff(self, device_id=None, channel=0, force=False, deadline=None):
+        """Turn off a device, the target device if device_id is None."""
+        return self._switch(device_id, channel, False, force, deadline)["success"]
+    
+    @override
+    def listDevices(self):
+        """List the managed devices, indexed by uuid."""
+        return {
+            device.uuid: {
+                "name": device.name,
+                "type": device.type,
+                "channels": [channel.index for channel in device.channels] or [0]
+            }
+            for device in self._devices.devices()
+        }
+    
+    @override
+    def getStatus(self, deadline=None):
+        """Get the current status of the managed devices, waiting for the cloud not past the deadline."""
         status = {
             "controller_name": self._name,
             "target_model": self._model,
             "simulation_mode": self._simulation_mode,
             "initialized": self._initialized,
-            "target_device_status": {}
+            "state": self._state,
+            "init_error": self._init_error,
+            "login_count": self._session.login_count if self._session else 0,
+            "circuit_breaker": self._circuit_breaker_status(),
+            "rate_limiter": self._rate_limiter_status(),
+            "status_age_sec": None,
+            "target_device_status": {},
+            "devices": {}
         }
         
         target_status = {
@@ -245,38 +796,76 @@ class MerossController:
         }
         
         if self._simulation_mode:
-            if self._target_device:
-                target_status["name"] = self._target_device["name"]
-                target_status["online"] = self._target_device["online"]
-                target_status["status"] = self._target_device["status"]
+            if len(self._devices):
+                status["devices"] = {device.uuid: self._device_status(device)
+                                     for device in self._devices.devices()}
             else:
-                target_status["error"] = "Simulation device not created"
-        elif self._initialized and self._target_device and self._loop and self._loop.is_running():
+                target_status["error"] = "Simulation devices not created"
+        elif self._initialized and len(self._devices) and self._loop and self._loop.is_running():
             try:
-                future = asyncio.run_coroutine_threadsafe(
-                    self._target_device.async_update(),
-                    self._loop
-                )
-                future.result(timeout=5)
-                
-                target_status["name"] = getattr(self._target_device, 'name', 'N/A')
-                target_status["online"] = getattr(self._target_device, 'online_status', OnlineStatus.UNKNOWN) == OnlineStatus.ONLINE
-                target_status["status"] = self._target_device.is_on() if hasattr(self._target_device, 'is_on') else False
+                status["devices"], status["status_age_sec"] = self._read_status(deadline)
             except Exception as e:
-                self._logger.error(f"Error getting target device status: {str(e)}")
-                target_status["error"] = str(e)
-                target_status["name"] = getattr(self._target_device, 'name', 'N/A')
-                target_status["online"] = getattr(self._target_device, 'online_status', OnlineStatus.UNKNOWN) == OnlineStatus.ONLINE
+                error = str(e) or type(e).__name__
+                self._logger.error(f"Error getting device status: {error}")
+                target_status["error"] = error
+                target_device = self._devices.lookup()
+                target_status["name"] = getattr(target_device, 'name', 'N/A')
+                target_status["online"] = getattr(target_device, 'online_status', OnlineStatus.UNKNOWN) == OnlineStatus.ONLINE
+        elif self._state == self.STATE_INITIALIZING:
+            target_status["error"] = "Controller initializing"
         elif not self._initialized:
-            target_status["error"] = "Controller not initialized"
-        elif not self._target_device:
-            target_status["error"] = f"Target device matching model '{self._model}' not found"
+            target_status["error"] = self._unavailable_reason()
+        elif not len(self._devices):
+            target_status["error"] = f"No device matching model '{self._model}' found"
         elif not self._loop or not self._loop.is_running():
             target_status["error"] = "Async event loop not running"
         
+        if status["devices"]:
+            target_status = status["devices"].get(self._devices.uuids()[0], target_status)
         status["target_device_status"] = target_status
         return status
     
+    def _circuit_breaker_status(self):
+        """State of the circuit breaker of the cloud calls, None without one"""
+        if self._session is None or self._session.circuit_breaker is None:
+            return None
+        return self._session.circuit_breaker.stats()
+    
+    def _rate_limiter_status(self):
+        """State and throttling counters of the rate limiter of the cloud calls, None without one"""
+        if self._session is None or self._session.rate_limiter is None:
+            return None
+        return self._session.rate_limiter.stats()
+    
+    @override
+    def turn_on(self, device_id=None, channel=0):
+        return self.turnOn(device_id, channel)
+    
+    @override
+    def turn_off(self, device_id=None, channel=0):
+        return self.turnOff(device_id, channel)
+    
+    @override
+    def get_status(self, device_id=None, channel=0):
+        device = self._devices.lookup(device_id)
+        return self.getStatus()["devices"][device.uuid]["channels"].get(channel)
+    
+    @override
+    def list_devices(self):
+        return self.listDevices()
+    
+    @override
+    def add_status_listener(self, listener):
+        """Call listener() from the event loop, or the switching thread in simulation, when the status changes"""
+        self._status_listeners.append(listener)
+    
+    @override
+    def get_statuses(self):
+        """States of the channels of all the devices from a single status read, refreshed concurrently"""
+        return {uuid: dict(status.get("channels", {}))
+                for uuid, status in self.getStatus()["devices"].items()}
+    
+    @override
     def getSnapshot(self, prefix=''):
         """Get a snapshot of the controller state."""
         raw_status = self.getStatus()
@@ -290,4 +879,42 @@ class MerossController:
                     snapshot[f"{prefix}.{key}.{sub_key}"] = sub_value
             else:
                 snapshot[f"{prefix}.{key}"] = value
-        return snapshot 
\ No newline at end of file
+        return snapshot
+
+
+class _ChannelQueue:
+    '''
+    Commands of a device channel: the task sending them and the command
+    waiting to be sent, a (on, force, future, deadline) tuple
+    '''
+    
+    def __init__(self):
+        self.worker = None
+        self.waiting = None
+
+
+class _SimulatedChannel:
+
+    def __init__(self, index):
+        self.index = index
+
+
+class _SimulatedDevice:
+    '''
+    In-memory stand-in for a Meross device, used in simulation mode
+    '''
+    
+    def __init__(self, uuid, name, device_type, channels=1):
+        self.uuid = uuid
+        self.name = name
+        self.type = device_type
+        self.online_status = OnlineStatus.ONLINE
+        self.channels = [_SimulatedChannel(index) for index in range(channels)]
+        self.last_full_update_timestamp = time.time()
+        self._states = {index: False for index in range(channels)}
+    
+    def is_on(self, channel=0):
+        return self._states.get(channel, False)
+    
+    def set_on(self, channel, on):
+        self._states[channel] = on
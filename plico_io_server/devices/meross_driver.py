@@ -0,0 +1,103 @@
+import os
+from plico_io_server.devices.meross_controller import MerossController
+from plico_io_server.devices.meross_session import MerossSession
+
+
+def _optional_value(configuration, section, key, default, **kwargs):
+    """Get an optional value from a section of the configuration"""
+    try:
+        return configuration.getValue(section, key, **kwargs)
+    except KeyError:
+        return default
+
+
+def _cache_file(runner, controller_device_section, kind):
+    """Path of a cache file of the device, next to the configuration file"""
+    return os.path.join(os.path.dirname(os.path.abspath(runner.getConfigFilePath())),
+                        f'{controller_device_section}_{kind}_cache.json')
+
+
+def create_controller(runner, controller_device_section, metrics):
+    """
+    Create a MerossController from a Meross device section
+    
+    The controllers of a runner that shares sessions (see
+    ControllerRunner.sharedSession) use the session of their account,
+    otherwise each controller creates its own.
+    
+    Parameters:
+    -----------
+    runner : ControllerRunner
+        Runner whose configuration holds the device section
+    controller_device_section : str
+        Device section of the configuration, e.g. deviceMeross
+    metrics : MetricsRegistry
+        Registry the controller metrics are recorded in
+    
+    Returns:
+    --------
+    MerossController : the controller of the devices of the section
+    """
+    configuration = runner.configuration
+    section = controller_device_section
+    
+    def optional(key, default, **kwargs):
+        return _optional_value(configuration, section, key, default, **kwargs)
+    
+    name = configuration.deviceName(section)
+    email = configuration.getValue(section, 'email')
+    password = configuration.getValue(section, 'password')
+    device_type = optional('device_type', None)
+    devices = optional('devices', None)
+    discovery_cache = optional('discovery_cache', True, getboolean=True)
+    credentials_cache = optional('credentials_cache', True, getboolean=True)
+    mqtt_override_server = optional('mqtt_override_server', None)
+    if mqtt_override_server:
+        host, port = mqtt_override_server.rsplit(':', 1)
+        mqtt_override_server = (host.strip(), int(port))
+    simulation_mode = optional('simulation_mode', False, getboolean=True)
+    timeouts = {
+        entry: optional(entry, default, getfloat=True)
+        for entry, default in (
+            ('init_timeout_sec', MerossController.DEFAULT_INIT_TIMEOUT_SEC),
+            ('command_timeout_sec', MerossController.DEFAULT_COMMAND_TIMEOUT_SEC),
+            ('status_timeout_sec', MerossController.DEFAULT_STATUS_TIMEOUT_SEC),
+            ('cleanup_timeout_sec', MerossController.DEFAULT_CLEANUP_TIMEOUT_SEC))}
+    
+    session_parameters = dict(
+        email=email,
+        password=password,
+        api_base_url=optional('api_base_url', MerossSession.DEFAULT_API_BASE_URL),
+        rate_limit_per_sec=optional(
+            'rate_limit_per_sec', MerossController.DEFAULT_RATE_LIMIT_PER_SEC, getfloat=True),
+        rate_limit_burst=optional(
+            'rate_limit_burst', MerossController.DEFAULT_RATE_LIMIT_BURST, getint=True),
+        breaker_failure_threshold=optional(
+            'breaker_failure_threshold', MerossSession.DEFAULT_BREAKER_FAILURE_THRESHOLD, getint=True),
+        breaker_reset_sec=optional(
+            'breaker_reset_sec', MerossSession.DEFAULT_BREAKER_RESET_SEC, getfloat=True),
+        discovery_cache_file=_cache_file(runner, section, 'discovery') if discovery_cache else None,
+        credentials_cache_file=_cache_file(runner, section, 'credentials') if credentials_cache else None,
+        mqtt_override_server=mqtt_override_server,
+        mqtt_ca_cert=optional('mqtt_ca_cert', None))
+    session = None
+    if not simulation_mode:
+        session = runner.sharedSession(
+            'meross', MerossSession.key(**session_parameters),
+            lambda loop_thread, metrics: MerossSession(
+                loop_thread=loop_thread, metrics=metrics, **session_parameters))
+    
+    return MerossController(
+        name=name,
+        model=device_type,
+        simulation_mode=simulation_mode,
+        metrics=metrics,
+        status_ttl_sec=optional(
+            'status_ttl_sec', MerossController.DEFAULT_STATUS_TTL_SEC, getfloat=True),
+        push_updates=optional('push_updates', True, getboolean=True),
+        push_silence_sec=optional(
+            'push_silence_sec', MerossController.DEFAULT_PUSH_SILENCE_SEC, getfloat=True),
+        devices=devices.split(',') if devices else None,
+        session=session,
+        **timeouts,
+        **session_parameters)
@@ -0,0 +1,441 @@
+import asyncio
+import hashlib
+import os
+import ssl
+import time
+from plico.utils.logger import Logger
+from meross_iot.http_api import MerossHttpClient
+from meross_iot.manager import MerossManager
+from meross_iot.model.credentials import MerossCloudCreds
+from meross_iot.model.exception import CommandError
+from meross_iot.model.http.error_codes import ErrorCodes
+from meross_iot.model.http.exception import HttpApiError, TokenExpiredException, UnauthorizedException
+from plico_io_server.utils.circuit_breaker import CircuitBreaker
+from plico_io_server.utils.deadline import DeadlineExceeded, boundTimeout, checkDeadline
+from plico_io_server.utils.event_loop_thread import EventLoopThread
+from plico_io_server.utils.metrics import MetricsRegistry
+from plico_io_server.utils.rate_limiter import RateLimiter
+
+
+class MerossSession:
+    '''
+    Connection to the Meross cloud of an account, shared by its controllers
+    
+    The session logs in, connects to the MQTT broker and discovers the
+    devices once for all its controllers, and forwards them the pushed
+    notifications. Every cloud call goes through async_call(), which
+    applies the rate limiter and the circuit breaker and records the call
+    metrics. The metrics of the session are labelled with its account, a
+    hash of the email, so that the sessions of different accounts sharing a
+    registry are told apart without exposing the addresses.
+    '''
+    
+    DEFAULT_API_BASE_URL = 'https://iotx-eu.meross.com'
+    DEFAULT_RATE_LIMIT_PER_SEC = 4.0
+    DEFAULT_RATE_LIMIT_BURST = 10
+    DEFAULT_BREAKER_FAILURE_THRESHOLD = 5
+    DEFAULT_BREAKER_RESET_SEC = 30.0
+    DEFAULT_CLEANUP_TIMEOUT_SEC = 5.0
+    UNHEALTHY_FAILURES = 5
+    UNHEALTHY_AFTER_SEC = 30.0
+    
+    # Cloud operations with their own metrics, and their rate limiter priority
+    CLOUD_OPERATIONS = {
+        'login': RateLimiter.PRIORITY_BACKGROUND,
+        'verify': RateLimiter.PRIORITY_BACKGROUND,
+        'discovery': RateLimiter.PRIORITY_BACKGROUND,
+        'update': RateLimiter.PRIORITY_REFRESH,
+        'switch': RateLimiter.PRIORITY_COMMAND
+    }
+    
+    def __init__(self, email, password, api_base_url=DEFAULT_API_BASE_URL, loop_thread=None, discovery_cache_file=None, credentials_cache_file=None, mqtt_override_server=None, mqtt_ca_cert=None, rate_limit_per_sec=DEFAULT_RATE_LIMIT_PER_SEC, rate_limit_burst=DEFAULT_RATE_LIMIT_BURST, breaker_failure_threshold=DEFAULT_BREAKER_FAILURE_THRESHOLD, breaker_reset_sec=DEFAULT_BREAKER_RESET_SEC, metrics=None):
+        self._logger = Logger.of(f'MerossSession({email})')
+        self._email = email
+        self._password = password
+        self._api_base_url = api_base_url
+        self._discovery_cache_file = discovery_cache_file
+        self._credentials_cache_file = credentials_cache_file
+        self._mqtt_override_server = mqtt_override_server
+        self._mqtt_ca_cert = mqtt_ca_cert
+        self._metrics = metrics if metrics is not None else MetricsRegistry()
+        self._account = hashlib.sha256(email.encode()).hexdigest()[:8]
+        self._owns_loop_thread = loop_thread is None
+        self._loop_thread = loop_thread or EventLoopThread(name=f'meross-{email}', metrics=self._metrics)
+        self._http_client = None
+        self._manager = None
+        self._login_count = 0
+        self._warm_start = False
+        self._connect_task = None
+        self._discovery_task = None
+        self._push_handlers = []
+        self._consecutive_failures = 0
+        self._last_success_time = time.monotonic()
+        self._generation = 0
+        self._create_metrics()
+        self._rate_limiter = None
+        if rate_limit_per_sec > 0:
+            self._rate_limiter = RateLimiter(rate_limit_per_sec, rate_limit_burst,
+                                             metrics=self._metrics, name='meross',
+                                             labels={'account': self._account})
+        self._circuit_breaker = None
+        if breaker_failure_threshold > 0:
+            self._circuit_breaker = CircuitBreaker(breaker_failure_threshold, breaker_reset_sec,
+                                                   metrics=self._metrics, name='Meross cloud',
+                                                   labels={'account': self._account})
+    
+    def _create_metrics(self):
+        """Create the metrics of the cloud calls, labelled with the account"""
+        account = self._account
+        self._call_metrics = {
+            operation: (
+                self._metrics.histogram('meross_call_latency_seconds', 'Duration of the Meross cloud calls', operation=operation, account=account),
+                self._metrics.counter('meross_call_timeouts_total', 'Meross cloud calls timed out', operation=operation, account=account),
+                self._metrics.counter('meross_call_errors_total', 'Meross cloud calls failed', operation=operation, account=account))
+            for operation in self.CLOUD_OPERATIONS}
+        self._calls_in_flight = self._metrics.gauge('meross_calls_in_flight', 'Meross cloud calls waiting for an answer', account=account)
+        self._expired_calls = {
+            operation: self._metrics.counter('meross_calls_expired_total', 'Meross cloud calls dropped or cut short at the deadline of the caller', operation=operation, account=account)
+            for operation in self.CLOUD_OPERATIONS}
+        self._logins = self._metrics.counter('meross_logins_total', 'Meross cloud logins with the account password', account=account)
+    
+    @staticmethod
+    def key(email, api_base_url=DEFAULT_API_BASE_URL, mqtt_override_server=None, **_):
+        """Identify the session a controller configured with these parameters can share"""
+        return (email, api_base_url, tuple(mqtt_override_server) if mqtt_override_server else None)
+    
+    @property
+    def loop(self):
+        """Event loop running the coroutines of the session"""
+        return self._loop_thread.loop
+    
+    @property
+    def loop_thread(self):
+        """EventLoopThread running the event loop of the session"""
+        return self._loop_thread
+    
+    @property
+    def manager(self):
+        """MerossManager of the account, None until connected"""
+        return self._manager
+    
+    @property
+    def login_count(self):
+        """Logins with email and password done by the session"""
+        return self._login_count
+    
+    @property
+    def generation(self):
+        """Number of the current connection, increased by every successful connection"""
+        return self._generation
+    
+    @property
+    def warm_start(self):
+        """Whether the devices were loaded from the discovery cache"""
+        return self._warm_start
+    
+    @property
+    def rate_limiter(self):
+        """RateLimiter of the cloud calls, None if disabled"""
+        return self._rate_limiter
+    
+    @property
+    def circuit_breaker(self):
+        """CircuitBreaker of the cloud calls, None if disabled"""
+        return self._circuit_breaker
+    
+    def is_healthy(self):
+        """Check whether the cloud calls of the session are succeeding"""
+        return (self._consecutive_failures < self.UNHEALTHY_FAILURES or
+                time.monotonic() - self._last_success_time < self.UNHEALTHY_AFTER_SEC)
+    
+    def start(self):
+        """Start the event loop of the session, if the session owns it"""
+        self._loop_thread.start()
+    
+    def is_running(self):
+        """Check whether the event loop of the session is running"""
+        return self._loop_thread.isRunning()
+    
+    def run(self, coroutine):
+        """Schedule a coroutine on the event loop of the session, returning its concurrent future"""
+        return self._loop_thread.run(coroutine)
+    
+    def add_push_handler(self, handler):
+        """Forward the push notifications to the coroutine handler(push_notification, target_devices, manager)"""
+        self._push_handlers.append(handler)
+    
+    def remove_push_handler(self, handler):
+        """Stop forwarding the push notifications to handler"""
+        if handler in self._push_handlers:
+            self._push_handlers.remove(handler)
+    
+    async def async_connect(self):
+        """Log in, connect the manager and load the devices, once for all the callers.
+        
+        Concurrent callers wait for the same connection. After a failure,
+        the next call tries to connect again.
+        """
+        if self._connect_task is None or _failed(self._connect_task):
+            self._connect_task = asyncio.ensure_future(self._async_connect())
+        await asyncio.shield(self._connect_task)
+    
+    async def _async_connect(self):
+        try:
+            self._http_client = await self._async_login()
+            
+            self._manager = MerossManager(http_client=self._http_client,
+                                          mqtt_override_server=self._mqtt_override_server,
+                                          mqtt_ssl_context=self._mqtt_ssl_context())
+            await self._manager.async_init()
+            self._manager.register_push_notification_handler_coroutine(self._async_dispatch_push)
+            
+            # Start from the devices of the previous discovery if they are
+            # cached, the callers revalidate them once initialized
+            self._warm_start = self._load_discovery_cache()
+            if not self._warm_start:
+                await self._async_discover_devices()
+            self._generation += 1
+        except Exception as e:
+            self._logger.error(f"Failed connecting to the Meross cloud: {str(e)}")
+            await self._async_disconnect()
+            raise
+    
+    async def async_revalidate_discovery(self):
+        """Discover the devices again, once for all the concurrent callers"""
+        if self._discovery_task is None or self._discovery_task.done():
+            self._discovery_task = asyncio.ensure_future(self._async_discover_devices())
+        await asyncio.shield(self._discovery_task)
+    
+    async def async_call(self, operation, awaitable, timeout=None, deadline=None):
+        """Await a cloud call within the rate limit, recording its metrics.
+        
+        The call times out after timeout seconds, or at the monotonic
+        deadline of the caller if it comes first. A call whose deadline
+        passed while it waited for the rate limiter is not made, and
+        raises DeadlineExceeded.
+        """
+        latency, timeouts, errors = self._call_metrics[operation]
+        probe = False
+        try:
+            if self._circuit_breaker is not None:
+                probe = self._circuit_breaker.allow()
+            if self._rate_limiter is not None:
+                await self._rate_limiter.acquire(self.CLOUD_OPERATIONS[operation])
+            checkDeadline(deadline, f"{operation} call")
+        except BaseException as e:
+            # Rejected, expired or cancelled while waiting, the call is never made
+            if isinstance(e, DeadlineExceeded):
+                self._expired_calls[operation].inc()
+            if asyncio.iscoroutine(awaitable):
+                awaitable.close()
+            if self._circuit_breaker is not None:
+                self._circuit_breaker.release(probe)
+            raise
+        call_timeout = boundTimeout(timeout, deadline)
+        start_time = time.perf_counter()
+        self._calls_in_flight.inc()
+        try:
+            if call_timeout is None:
+                result = await awaitable
+            else:
+                result = await asyncio.wait_for(awaitable, timeout=call_timeout)
+        except asyncio.TimeoutError as e:
+            if call_timeout != timeout:
+                # Cut short by the deadline of the caller, not a cloud failure
+                self._expired_calls[operation].inc()
+                if self._circuit_breaker is not None:
+                    self._circuit_breaker.release(probe)
+                raise DeadlineExceeded(f"Deadline of the {operation} call exceeded") from e
+            timeouts.inc()
+            self._call_failed(e)
+            raise
+        except Exception as e:
+            errors.inc()
+            if self._rate_limiter is not None and self._is_throttling_error(e):
+                self._rate_limiter.throttled()
+                self._logger.warn(f"Meross cloud requested too frequently, rate reduced to {self._rate_limiter.rate():.2f} calls/s")
+            if isinstance(e, (HttpApiError, CommandError)):
+                # The cloud answered, with an error
+                if self._circuit_breaker is not None:
+                    self._circuit_breaker.release(probe)
+            else:
+                self._call_failed(e)
+            raise
+        except BaseException:
+            if self._circuit_breaker is not None:
+                self._circuit_breaker.release(probe)
+            raise
+        finally:
+            self._calls_in_flight.dec()
+            latency.observe(time.perf_counter() - start_time)
+        self._consecutive_failures = 0
+        self._last_success_time = time.monotonic()
+        if self._circuit_breaker is not None:
+            self._circuit_breaker.success()
+        return result
+    
+    def _call_failed(self, error):
+        """Record a cloud call that failed or timed out"""
+        self._consecutive_failures += 1
+        if self._circuit_breaker is not None:
+            self._circuit_breaker.failure(error)
+    
+    def _is_throttling_error(self, error):
+        """Check whether the cloud rejected a call because of the request rate"""
+        if isinstance(error, HttpApiError):
+            return error.error_code == ErrorCodes.REQUESTED_TOO_FREQUENTLY
+        if isinstance(error, CommandError):
+            code = ((error.error_payload or {}).get('error') or {}).get('code')
+            return code == ErrorCodes.REQUESTED_TOO_FREQUENTLY.value
+        return False
+    
+    async def _async_dispatch_push(self, push_notification, target_devices, manager):
+        """Forward a push notification to the handlers of all the controllers"""
+        for handler in list(self._push_handlers):
+            try:
+                await handler(push_notification, target_devices, manager)
+            except Exception as e:
+                self._logger.error(f"Error handling push notification: {str(e)}")
+    
+    def _mqtt_ssl_context(self):
+        """SSL context trusting mqtt_ca_cert, None to use the default one"""
+        if not self._mqtt_ca_cert:
+            return None
+        return ssl.create_default_context(cafile=self._mqtt_ca_cert)
+    
+    async def _async_login(self):
+        """Create the HTTP client, reusing the cached credentials while the cloud accepts them"""
+        creds = self._load_credentials()
+        if creds is not None:
+            try:
+                http_client = await self.async_call('verify', MerossHttpClient.async_from_cloud_creds(creds))
+                self._logger.notice("Reusing cached Meross cloud credentials")
+                return http_client
+            except (TokenExpiredException, UnauthorizedException) as e:
+                self._logger.notice(f"Cached Meross cloud credentials rejected ({type(e).__name__}), logging in again")
+            except Exception as e:
+                self._logger.warn(f"Cannot verify cached Meross cloud credentials ({str(e)}), logging in again")
+        
+        http_client = await self.async_call('login', MerossHttpClient.async_from_user_password(
+            api_base_url=self._api_base_url,
+            email=self._email,
+            password=self._password
+        ))
+        self._login_count += 1
+        self._logins.inc()
+        self._save_credentials(http_client.cloud_credentials)
+        return http_client
+    
+    def _load_credentials(self):
+        """Load the cached cloud credentials of the configured account, if any"""
+        if not self._credentials_cache_file or not os.path.exists(self._credentials_cache_file):
+            return None
+        try:
+            with open(self._credentials_cache_file, 'r') as f:
+                creds = MerossCloudCreds.from_json(f.read())
+        except Exception as e:
+            self._logger.warn(f"Ignoring unreadable credentials cache {self._credentials_cache_file}: {str(e)}")
+            return None
+        if creds.user_email != self._email:
+            self._logger.notice("Cached Meross cloud credentials belong to another account, ignoring them")
+            return None
+        return creds
+    
+    def _save_credentials(self, creds):
+        """Save the cloud credentials to the cache file, readable by the owner only"""
+        if not self._credentials_cache_file:
+            return
+        try:
+            fd = os.open(self._credentials_cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            # The mode of open() does not apply to an existing file
+            os.chmod(self._credentials_cache_file, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                f.write(creds.to_json())
+        except Exception as e:
+            self._logger.warn(f"Cannot write credentials cache {self._credentials_cache_file}: {str(e)}")
+    
+    def _load_discovery_cache(self):
+        """Load the devices found by a previous discovery, returning whether the cache was used"""
+        if not self._discovery_cache_file or not os.path.exists(self._discovery_cache_file):
+            return False
+        try:
+            self._manager.load_devices_from_dump(self._discovery_cache_file)
+            self._logger.notice(f"Loaded cached device discovery from {self._discovery_cache_file}")
+            return True
+        except Exception as e:
+            self._logger.warn(f"Ignoring unreadable discovery cache {self._discovery_cache_file}: {str(e)}")
+            return False
+    
+    async def _async_discover_devices(self):
+        """Discover the devices of the account and save them to the discovery cache"""
+        await self.async_call('discovery', self._manager.async_device_discovery())
+        if self._discovery_cache_file:
+            try:
+                self._manager.dump_device_registry(self._discovery_cache_file)
+            except Exception as e:
+                self._logger.warn(f"Cannot write discovery cache {self._discovery_cache_file}: {str(e)}")
+    
+    async def _async_disconnect(self):
+        """Close the manager and log out, unless the credentials are cached"""
+        # Detach the connection first, a new one may be created meanwhile
+        manager, http_client = self._manager, self._http_client
+        self._manager = self._http_client = None
+        if manager:
+            manager.close()
+        if http_client:
+            # Logging out would invalidate the cached credentials
+            if not self._credentials_cache_file:
+                try:
+                    await http_client.async_logout()
+                except Exception as e:
+                    self._logger.error(f"Error logging out http client: {e}")
+    
+    async def async_reset(self):
+        """Drop the connection, so that the next async_connect() creates a new one"""
+        self._logger.notice("Resetting the connection to the Meross cloud")
+        for task in (self._connect_task, self._discovery_task):
+            if task is not None and not task.done():
+                task.cancel()
+        self._connect_task = self._discovery_task = None
+        self._consecutive_failures = 0
+        self._last_success_time = time.monotonic()
+        await self._async_disconnect()
+    
+    def abandon(self):
+        """Forget the connection bound to an event loop that was replaced.
+        
+        The tasks of the old loop are never awaited again; the manager is
+        only disconnected from the MQTT broker.
+        """
+        self._logger.notice("Abandoning the connection of a stalled event loop")
+        manager = self._manager
+        self._manager = self._http_client = None
+        self._connect_task = self._discovery_task = None
+        self._consecutive_failures = 0
+        self._last_success_time = time.monotonic()
+        if self._rate_limiter is not None:
+            self._rate_limiter.reset()
+        if manager:
+            try:
+                manager.close()
+            except Exception as e:
+                self._logger.error(f"Error closing the abandoned manager: {str(e)}")
+    
+    def close(self, timeout=DEFAULT_CLEANUP_TIMEOUT_SEC):
+        """Disconnect from the cloud and stop the event loop if the session owns it"""
+        for task in (self._discovery_task, self._connect_task):
+            if task is not None and not task.done():
+                self._loop_thread.loop.call_soon_threadsafe(task.cancel)
+        if self.is_running():
+            future = self.run(self._async_disconnect())
+            try:
+                future.result(timeout=timeout)
+            except Exception as e:
+                self._logger.error(f"Error during cleanup: {str(e)}")
+        if self._owns_loop_thread:
+            self._loop_thread.stop(timeout)
+
+
+def _failed(task):
+    """Check whether a task completed without success"""
+    return task.done() and (task.cancelled() or task.exception() is not None)
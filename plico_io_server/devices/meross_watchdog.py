@@ -0,0 +1,114 @@
+import threading
+import time
+from plico.utils.logger import Logger
+from plico_io_server.utils.metrics import MetricsRegistry
+
+
+class MerossWatchdog:
+    '''
+    Supervisor restoring the Meross controllers running on an event loop
+    
+    A thread checks every CHECK_PERIOD_SEC seconds the event loop and the
+    controllers, independently of the event loop itself:
+    - when the loop has not run its callbacks for stall_sec seconds, it is
+      replaced by a new one, the sessions of the controllers abandon their
+      connection and every controller is initialized again
+    - a controller that reports a recovery_reason(), because its
+      initialization failed or its session stopped getting answers from
+      the cloud, is initialized again on a new connection
+    
+    Failed recoveries are retried with exponential backoff, from
+    min_backoff_sec up to max_backoff_sec, until the controller is ready.
+    Meanwhile the controller reports its state as degraded.
+    '''
+    
+    CHECK_PERIOD_SEC = 1.0
+    DEFAULT_STALL_SEC = 5.0
+    DEFAULT_MIN_BACKOFF_SEC = 1.0
+    DEFAULT_MAX_BACKOFF_SEC = 60.0
+    
+    REASON_EVENT_LOOP = 'event_loop'
+    
+    def __init__(self, loop_thread, stall_sec=DEFAULT_STALL_SEC, min_backoff_sec=DEFAULT_MIN_BACKOFF_SEC, max_backoff_sec=DEFAULT_MAX_BACKOFF_SEC, metrics=None):
+        self._logger = Logger.of('MerossWatchdog')
+        self._loop_thread = loop_thread
+        self._stall_sec = stall_sec
+        self._min_backoff_sec = min_backoff_sec
+        self._max_backoff_sec = max_backoff_sec
+        self._controllers = []
+        # Object being recovered -> (attempts, time of the next attempt)
+        self._backoff = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._metrics = metrics if metrics is not None else MetricsRegistry()
+    
+    def watch(self, controller):
+        """Supervise a MerossController running on the event loop"""
+        self._controllers.append(controller)
+    
+    def unwatch(self, controller):
+        """Stop supervising a controller"""
+        if controller in self._controllers:
+            self._controllers.remove(controller)
+        self._backoff.pop(controller, None)
+    
+    def start(self):
+        """Start checking in a background thread"""
+        self._thread = threading.Thread(target=self._run, name='meross-watchdog', daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Stop checking and wait for the thread to exit"""
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+    
+    def _run(self):
+        while not self._stop_event.wait(self.CHECK_PERIOD_SEC):
+            try:
+                self.check()
+            except Exception as e:
+                self._logger.error(f"Watchdog check failed: {str(e)}")
+    
+    def check(self):
+        """Check the event loop and the controllers once, recovering them if needed"""
+        now = time.monotonic()
+        controllers = list(self._controllers)
+        stalled_sec = self._loop_thread.stalledSec()
+        if stalled_sec > self._stall_sec:
+            if self._attempt(self._loop_thread, now):
+                self._logger.error(f"Event loop stalled for {stalled_sec:.1f}s, replacing it")
+                self._recoveries(self.REASON_EVENT_LOOP).inc()
+                self._loop_thread.restart()
+                for session in {controller.session for controller in controllers if controller.session}:
+                    session.abandon()
+                for controller in controllers:
+                    controller.recover(self.REASON_EVENT_LOOP)
+            return
+        
+        for controller in controllers:
+            reason = controller.recovery_reason()
+            if reason is None:
+                if controller.is_ready():
+                    self._backoff.pop(controller, None)
+                continue
+            if self._attempt(controller, now):
+                self._recoveries(reason).inc()
+                controller.recover(reason)
+        if all(controller.is_ready() for controller in controllers):
+            self._backoff.pop(self._loop_thread, None)
+    
+    def _attempt(self, target, now):
+        """Check whether the backoff of target allows a recovery now, and schedule the next one"""
+        attempts, next_time = self._backoff.get(target, (0, now))
+        if now < next_time:
+            return False
+        delay = min(self._max_backoff_sec, self._min_backoff_sec * 2 ** attempts)
+        self._backoff[target] = (attempts + 1, now + delay)
+        if attempts:
+            self._logger.notice(f"Recovery attempt {attempts + 1}, next one in {delay:.0f}s if it fails")
+        return True
+    
+    def _recoveries(self, reason):
+        return self._metrics.counter('meross_recoveries_total', 'Recoveries started by the watchdog', reason=reason)
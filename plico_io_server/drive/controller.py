@@ -2,7 +2,7 @@ import time
 import threading
 from plico.utils.logger import Logger
 from plico.utils.decorator import override
-from plico_controller_server.controller_types.controller_status import ControllerStatus
+from plico_io_server.controller_types.controller_status import ControllerStatus
 
 
 class Controller:
@@ -55,19 +55,22 @@ class Controller:
                 time.sleep(1)
     
     def _publishStatus(self):
-        """Publish current status."""
+        """Publish current status.
+        
+        The states of all the devices are collected with a single bulk
+        call, so that a sweep does not grow with the number of devices.
+        """
         try:
             devices = self._device.list_devices()
+            statuses = self._device.get_statuses()
             # Convert devices to a serializable format
             serializable_devices = {}
             for device_id, device in devices.items():
-                if hasattr(device, 'name'):
-                    serializable_devices[device_id] = {
-                        'name': device.name,
-                        'status': self._device.get_status(device_id)
-                    }
-                else:
-                    serializable_devices[device_id] = str(device)
+                name = device.get('name') if isinstance(device, dict) else getattr(device, 'name', str(device))
+                serializable_devices[device_id] = {
+                    'name': name,
+                    'status': statuses.get(device_id)
+                }
             
             status = ControllerStatus(self._name, serializable_devices)
             self._statusSocket.send_json(status.getSnapshot(self._name))
@@ -136,6 +139,16 @@ class Controller:
         """
         return self._device.get_status(device_id, channel)
     
+    def get_statuses(self):
+        """Get the state of all the devices with a single call.
+        
+        Returns
+        -------
+        dict
+            For every device ID, the state of each channel
+        """
+        return self._device.get_statuses()
+    
     def list_devices(self):
         """List available devices.
         
@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import json
+import os
+import pickle
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zmq
+from plico.rpc.zmq_remote_procedure_call import ZmqRpcTimeoutError
+
+
+CONTROLLER_SECTION = 'controllerBenchmark'
+DEVICE_SECTION = 'deviceBenchmark'
+
+
+def _parseArguments():
+    """Parse command line arguments.
+
+    Returns
+    -------
+    argparse.Namespace
+        Parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark the RPC latency and throughput of a controller '
+                    'server running against a simulated backend')
+    parser.add_argument('--backend', choices=['simulation', 'fake-cloud'],
+                        default='simulation',
+                        help='simulation_mode devices, or the real Meross '
+                             'client talking to a local fake cloud '
+                             '(default: %(default)s)')
+    parser.add_argument('--port', type=int, default=5610,
+                        help='Base port of the controller (default: %(default)s)')
+    parser.add_argument('--polling', action='store_true',
+                        help='Run the controller in polling mode instead of '
+                             'event driven mode')
+    parser.add_argument('--async-requests', action='store_true',
+                        help='Serve the requests concurrently (async_requests mode)')
+    parser.add_argument('--iteration-interval-sec', type=float, default=1.0,
+                        help='Status publication period of the controller, '
+                             'at least 1s (default: %(default)s)')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='Requests per method in the latency test '
+                             '(default: %(default)s)')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='Requests discarded before each latency test '
+                             '(default: %(default)s)')
+    parser.add_argument('--clients', default='1,2,4,8',
+                        help='Comma separated numbers of concurrent clients '
+                             'of the throughput test (default: %(default)s)')
+    parser.add_argument('--duration-sec', type=float, default=5.0,
+                        help='Duration of each throughput test (default: %(default)s)')
+    parser.add_argument('--throughput-method', default='getStatus',
+                        help='Method called by the throughput test (default: %(default)s)')
+    parser.add_argument('--timeout-sec', type=float, default=10.0,
+                        help='Timeout of a single request (default: %(default)s)')
+    parser.add_argument('--latency-ms', type=float, default=20.0,
+                        help='Command latency of the fake cloud (default: %(default)s)')
+    parser.add_argument('--jitter-ms', type=float, default=5.0,
+                        help='Command jitter of the fake cloud (default: %(default)s)')
+    parser.add_argument('--rate-limit-per-sec', type=float, default=0.0,
+                        help='Rate limit of the calls to the fake cloud, 0 to '
+                             'measure the round-trips without it (default: %(default)s)')
+    parser.add_argument('--output', default='controller_benchmark.json',
+                        help='JSON file the results are written to (default: %(default)s)')
+    return parser.parse_args()
+
+
+class _RpcClient:
+    """REQ client speaking the plico RPC protocol. Not thread safe, use one per thread."""
+
+    def __init__(self, context, port, timeoutSec):
+        self._context = context
+        self._address = f'tcp://localhost:{port}'
+        self._timeoutMs = int(timeoutSec * 1000)
+        self._connect()
+
+    def _connect(self):
+        self._socket = self._context.socket(zmq.REQ)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.setsockopt(zmq.SNDTIMEO, self._timeoutMs)
+        self._socket.setsockopt(zmq.RCVTIMEO, self._timeoutMs)
+        self._socket.connect(self._address)
+
+    def call(self, method, *args):
+        try:
+            self._socket.send_multipart([method.encode(), pickle.dumps(args)])
+            result = pickle.loads(self._socket.recv())
+        except zmq.Again:
+            # A REQ socket cannot send again before receiving the reply
+            self._socket.close()
+            self._connect()
+            raise ZmqRpcTimeoutError(f'{method} timed out')
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        self._socket.close()
+
+
+class _StatusListener(threading.Thread):
+    """Collect the status messages published by the controller."""
+
+    def __init__(self, context, port):
+        threading.Thread.__init__(self, daemon=True)
+        self._socket = context.socket(zmq.SUB)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.setsockopt(zmq.RCVTIMEO, 100)
+        self._socket.setsockopt(zmq.SUBSCRIBE, b'')
+        self._socket.connect(f'tcp://localhost:{port}')
+        self._messages = []
+        self._condition = threading.Condition()
+        self._running = True
+
+    def run(self):
+        while self._running:
+            try:
+                status = pickle.loads(self._socket.recv())
+            except zmq.Again:
+                continue
+            with self._condition:
+                self._messages.append((time.time(), status))
+                self._condition.notify_all()
+        self._socket.close()
+
+    def stop(self):
+        self._running = False
+        self.join()
+
+    def waitForSwitchState(self, on, since, timeoutSec):
+        """Wait for a status published after since with the device switched on/off.
+
+        Returns
+        -------
+        float or None
+            Publication time of the status, None on timeout
+        """
+        deadline = time.time() + timeoutSec
+        with self._condition:
+            while True:
+                for receivedTime, status in reversed(self._messages):
+                    if receivedTime < since:
+                        break
+                    deviceStatus = status.get('target_device_status') or {}
+                    if deviceStatus.get('status') == on:
+                        return receivedTime
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def summary(self, startTime, stopTime):
+        with self._condition:
+            messages = [status for receivedTime, status in self._messages
+                        if startTime <= receivedTime <= stopTime]
+        heartbeats = len([status for status in messages if status.get('heartbeat')])
+        return {
+            'messages': len(messages),
+            'heartbeats': heartbeats,
+            'rate_hz': len(messages) / (stopTime - startTime) if stopTime > startTime else 0.0
+        }
+
+
+def _latencySummary(samplesSec):
+    if not samplesSec:
+        return {'count': 0}
+    ordered = sorted(samplesSec)
+
+    def percentile(q):
+        return 1000 * ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+    return {
+        'count': len(ordered),
+        'mean_ms': 1000 * sum(ordered) / len(ordered),
+        'p50_ms': percentile(50),
+        'p95_ms': percentile(95),
+        'p99_ms': percentile(99),
+        'max_ms': 1000 * ordered[-1]
+    }
+
+
+def _startFakeCloud(certDir, args):
+    """Start a fake Meross cloud on a background event loop."""
+    from plico_io_server.devices.fake_meross_cloud import FakeMerossCloud, create_plugs, generate_certificate
+    certFile, keyFile = generate_certificate(certDir)
+    cloud = FakeMerossCloud('benchmark@example.com', 'benchmark',
+                            create_plugs(['mss310:1:1']),
+                            cert_file=certFile, key_file=keyFile,
+                            latency_sec=args.latency_ms / 1000,
+                            jitter_sec=args.jitter_ms / 1000,
+                            seed=0)
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    asyncio.run_coroutine_threadsafe(cloud.start(), loop).result()
+    return cloud
+
+
+def _writeConfiguration(path, args, cloud):
+    """Write the configuration of the benchmarked controller."""
+    if cloud is None:
+        backend = ("email = benchmark@example.com\n"
+                   "password = benchmark\n"
+                   "simulation_mode = true\n")
+    else:
+        backend = (f"email = benchmark@example.com\n"
+                   f"password = benchmark\n"
+                   f"api_base_url = {cloud.api_base_url}\n"
+                   f"mqtt_override_server = {cloud.mqtt_address[0]}:{cloud.mqtt_address[1]}\n"
+                   f"mqtt_ca_cert = {cloud.cert_file}\n"
+                   f"discovery_cache = false\n"
+                   f"credentials_cache = false\n"
+                   f"rate_limit_per_sec = {args.rate_limit_per_sec}\n")
+    with open(path, 'w') as f:
+        f.write(f"[{DEVICE_SECTION}]\n"
+                f"name = Benchmark plug\n"
+                f"model = meross\n"
+                f"{backend}\n"
+                f"[{CONTROLLER_SECTION}]\n"
+                f"name = Benchmark controller\n"
+                f"controller = {DEVICE_SECTION}\n"
+                f"host = localhost\n"
+                f"port = {args.port}\n"
+                f"log_level = warning\n"
+                f"iteration_interval_sec = {args.iteration_interval_sec}\n"
+                f"event_driven = {'false' if args.polling else 'true'}\n"
+                f"async_requests = {'true' if args.async_requests else 'false'}\n\n"
+                f"[global]\n"
+                f"app_name = inaf.arcetri.ao.plico_io_server_benchmark\n"
+                f"app_author = INAF Arcetri Adaptive Optics\n"
+                f"python_package_name = plico_io_server\n"
+                f"force_log_dir = {os.path.dirname(path)}\n")
+
+
+def _waitFor(predicate, timeoutSec):
+    """Call predicate until it returns True, returning the time it took."""
+    startTime = time.time()
+    while time.time() - startTime < timeoutSec:
+        try:
+            if predicate():
+                return time.time() - startTime
+        except ZmqRpcTimeoutError:
+            pass
+        time.sleep(0.005)
+    raise TimeoutError(f'Controller not responding after {timeoutSec}s')
+
+
+def _measureLatency(client, method, args, requests, warmup):
+    for _ in range(warmup):
+        client.call(method, *args)
+    samples = []
+    for _ in range(requests):
+        startTime = time.perf_counter()
+        client.call(method, *args)
+        samples.append(time.perf_counter() - startTime)
+    return _latencySummary(samples)
+
+
+def _measureCommands(client, on, force, requests, warmup):
+    """Measure the setState commands of the target device, counting their outcomes.
+
+    Without force the commands asking for the known state of the channel
+    are skipped by the controller: only forced commands measure the
+    round-trip to the backend.
+    """
+    for _ in range(warmup):
+        client.call('setState', None, 0, on, force)
+    samples = []
+    outcomes = {}
+    for _ in range(requests):
+        startTime = time.perf_counter()
+        result = client.call('setState', None, 0, on, force)
+        samples.append(time.perf_counter() - startTime)
+        outcome = result['outcome'] if result['success'] else 'failed'
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    summary = _latencySummary(samples)
+    summary['outcomes'] = outcomes
+    return summary
+
+
+def _measureStatusPublish(client, listener, durationSec, timeoutSec):
+    """Toggle the device and measure how long the change takes to be published."""
+    samples = []
+    missed = 0
+    on = True
+    startTime = time.time()
+    while time.time() - startTime < durationSec:
+        commandTime = time.time()
+        if on:
+            client.call('turnOn')
+        else:
+            client.call('turnOff')
+        publishTime = listener.waitForSwitchState(on, commandTime, timeoutSec)
+        if publishTime is None:
+            missed += 1
+        else:
+            samples.append(publishTime - commandTime)
+        on = not on
+    result = listener.summary(startTime, time.time())
+    result['missed'] = missed
+    result['delay'] = _latencySummary(samples)
+    return result
+
+
+def _measureThroughput(context, port, method, numClients, durationSec, timeoutSec):
+    samples = [[] for _ in range(numClients)]
+    errors = [0] * numClients
+    barrier = threading.Barrier(numClients + 1)
+
+    def work(index):
+        client = _RpcClient(context, port, timeoutSec)
+        barrier.wait()
+        stopTime = time.time() + durationSec
+        while time.time() < stopTime:
+            startTime = time.perf_counter()
+            try:
+                client.call(method)
+                samples[index].append(time.perf_counter() - startTime)
+            except Exception:
+                errors[index] += 1
+        client.close()
+
+    threads = [threading.Thread(target=work, args=(index,)) for index in range(numClients)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    startTime = time.time()
+    for thread in threads:
+        thread.join()
+    elapsedSec = time.time() - startTime
+
+    allSamples = [sample for clientSamples in samples for sample in clientSamples]
+    result = {
+        'clients': numClients,
+        'requests': len(allSamples),
+        'errors': sum(errors),
+        'requests_per_sec': len(allSamples) / elapsedSec
+    }
+    result.update(_latencySummary(allSamples))
+    return result
+
+
+def _runBenchmark(args, workDir):
+    cloud = _startFakeCloud(workDir, args) if args.backend == 'fake-cloud' else None
+    configFile = os.path.join(workDir, 'benchmark.conf')
+    _writeConfiguration(configFile, args, cloud)
+
+    context = zmq.Context()
+    listener = _StatusListener(context, args.port + 1)
+    listener.start()
+    client = _RpcClient(context, args.port, args.timeout_sec)
+    results = {}
+
+    startTime = time.time()
+    with open(os.path.join(workDir, 'controller.out'), 'w') as output:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'plico_io_server.scripts.controller_start',
+             configFile, CONTROLLER_SECTION],
+            stdout=output, stderr=subprocess.STDOUT)
+    try:
+        _waitFor(lambda: client.call('getStatus') is not None, 60)
+        results['startup_sec'] = time.time() - startTime
+        _waitFor(lambda: client.call('getStatus')['state'] != 'initializing', 60)
+        results['ready_sec'] = time.time() - startTime
+        results['state'] = client.call('getStatus')['state']
+
+        results['latency'] = {
+            'getStatus': _measureLatency(client, 'getStatus', (), args.requests, args.warmup),
+            # Forced, so that every command reaches the backend
+            'turnOn': _measureCommands(client, True, True, args.requests, args.warmup),
+            'turnOff': _measureCommands(client, False, True, args.requests, args.warmup),
+            # The channel is off already: the commands are skipped
+            'skipped': _measureCommands(client, False, False, args.requests, args.warmup),
+        }
+        results['throughput'] = [
+            _measureThroughput(context, args.port, args.throughput_method,
+                               int(numClients), args.duration_sec, args.timeout_sec)
+            for numClients in args.clients.split(',')]
+        results['status_publish'] = _measureStatusPublish(
+            client, listener, args.duration_sec, args.timeout_sec)
+
+        shutdownStart = time.time()
+        client.call('terminate')
+        process.wait(timeout=60)
+        results['shutdown_sec'] = time.time() - shutdownStart
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        listener.stop()
+        client.close()
+        context.term()
+    if cloud is not None:
+        results['fake_cloud'] = {'logins': cloud.login_count, 'commands': cloud.command_count}
+    return results
+
+
+def main():
+    """Benchmark a controller server and write the results as JSON."""
+    args = _parseArguments()
+    with tempfile.TemporaryDirectory(prefix='plico_io_benchmark_') as workDir:
+        results = _runBenchmark(args, workDir)
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': vars(args),
+        'results': results
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for method, latency in results['latency'].items():
+        print(f"{method:>10}: p50 {latency['p50_ms']:.2f} ms  p95 {latency['p95_ms']:.2f} ms  p99 {latency['p99_ms']:.2f} ms")
+    for throughput in results['throughput']:
+        print(f"{throughput['clients']:>3} clients: {throughput['requests_per_sec']:.0f} req/s, p99 {throughput.get('p99_ms', 0):.2f} ms, {throughput['errors']} errors")
+    print(f"startup {results['startup_sec']:.2f}s, ready {results['ready_sec']:.2f}s, shutdown {results['shutdown_sec']:.2f}s, "
+          f"status published at {results['status_publish']['rate_hz']:.2f} Hz, "
+          f"p50 delay {results['status_publish']['delay'].get('p50_ms', 0):.2f} ms")
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+import argparse
+import asyncio
+import os
+import tempfile
+from plico_io_server.devices.fake_meross_cloud import FakeMerossCloud, create_plugs, generate_certificate
+
+
+def _parseArguments():
+    """Parse command line arguments.
+
+    Returns
+    -------
+    argparse.Namespace
+        Parsed arguments
+    """
+    parser = argparse.ArgumentParser(
+        description='Run a local fake Meross cloud (HTTP API and MQTT broker) '
+                    'serving simulated plugs')
+    parser.add_argument('--email', default='fake@example.com',
+                        help='Account email (default: %(default)s)')
+    parser.add_argument('--password', default='fake',
+                        help='Account password (default: %(default)s)')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on (default: %(default)s)')
+    parser.add_argument('--http-port', type=int, default=5080,
+                        help='HTTP API port (default: %(default)s)')
+    parser.add_argument('--mqtt-port', type=int, default=5883,
+                        help='MQTT over TLS port (default: %(default)s)')
+    parser.add_argument('--plug', action='append', dest='plugs',
+                        metavar='TYPE[:CHANNELS[:COUNT]]',
+                        help='Simulated plugs, can be repeated '
+                             '(default: mss310:1:2 and mss425e:4:1)')
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='Delay of every request and command')
+    parser.add_argument('--jitter-ms', type=float, default=0.0,
+                        help='Maximum random delay added to the latency')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Probability of a command failing with an error')
+    parser.add_argument('--drop-rate', type=float, default=0.0,
+                        help='Probability of a command never being answered')
+    parser.add_argument('--token-ttl-sec', type=float, default=0.0,
+                        help='Token lifetime, 0 for tokens that never expire')
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help='Requests per second above which the cloud answers '
+                             '"requested too frequently", 0 for no limit')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed for reproducible jitter and failures')
+    parser.add_argument('--cert-dir',
+                        default=os.path.join(tempfile.gettempdir(), 'plico_io_fake_meross'),
+                        help='Directory of the TLS certificate, generated if '
+                             'missing (default: %(default)s)')
+    return parser.parse_args()
+
+
+async def _run(args):
+    certFile, keyFile = generate_certificate(args.cert_dir, args.host)
+    cloud = FakeMerossCloud(
+        args.email, args.password,
+        create_plugs(args.plugs or ['mss310:1:2', 'mss425e:4:1']),
+        host=args.host,
+        http_port=args.http_port,
+        mqtt_port=args.mqtt_port,
+        cert_file=certFile,
+        key_file=keyFile,
+        latency_sec=args.latency_ms / 1000,
+        jitter_sec=args.jitter_ms / 1000,
+        failure_rate=args.failure_rate,
+        drop_rate=args.drop_rate,
+        token_ttl_sec=args.token_ttl_sec,
+        rate_limit_per_sec=args.rate_limit,
+        seed=args.seed)
+    await cloud.start()
+    print("Configure the Meross device section with:")
+    print(f"email = {args.email}")
+    print(f"password = {args.password}")
+    print(f"api_base_url = {cloud.api_base_url}")
+    print(f"mqtt_override_server = {cloud.mqtt_address[0]}:{cloud.mqtt_address[1]}")
+    print(f"mqtt_ca_cert = {certFile}")
+    for plug in cloud.plugs():
+        print(f"# {plug.uuid} {plug.type} {plug.channels}ch '{plug.name}'")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await cloud.stop()
+
+
+def main():
+    """Run the fake Meross cloud until interrupted."""
+    try:
+        asyncio.run(_run(_parseArguments()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
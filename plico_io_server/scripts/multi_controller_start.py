@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+import sys
+
+# Import the runner hosting many plico_io_server controllers
+from plico_io_server.controller.multi_controller_runner import MultiControllerRunner
+
+
+def main():
+    """Instantiates the IO MultiControllerRunner and starts it, 
+       relying on the base runner to parse arguments.
+    """
+    runner = MultiControllerRunner()
+    # Pass sys.argv directly to the base runner's start method
+    # which handles parsing positional config file and section name.
+    sys.exit(runner.start(sys.argv))
+
+
+if __name__ == '__main__':
+    main() 
\ No newline at end of file
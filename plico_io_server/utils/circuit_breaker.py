@@ -0,0 +1,152 @@
+import time
+from plico_io_server.utils.metrics import MetricsRegistry
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service whose circuit breaker is open."""
+
+
+class CircuitBreaker(object):
+    """Circuit breaker making the calls to a failing service fail fast.
+    
+    The breaker is closed while the service answers. After failureThreshold
+    consecutive failures it opens: calls are rejected immediately with a
+    CircuitOpenError instead of waiting for their timeout. resetSec seconds
+    later it becomes half-open and lets a single probe call through: the
+    circuit closes if the probe succeeds, and opens again if it fails.
+    
+    The breaker must be used from a single thread, e.g. an asyncio event
+    loop, while stats() can be read from any thread.
+    """
+    
+    STATE_CLOSED = 'closed'
+    STATE_OPEN = 'open'
+    STATE_HALF_OPEN = 'half_open'
+    
+    _STATE_VALUES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+    
+    def __init__(self, failureThreshold=5, resetSec=30.0, metrics=None,
+                 name='cloud', labels=None, clock=time.monotonic):
+        """Create a closed breaker.
+        
+        Parameters
+        ----------
+        failureThreshold : int, optional
+            Consecutive failures opening the circuit (default: 5)
+        resetSec : float, optional
+            Time the circuit stays open before a probe call (default: 30)
+        metrics : MetricsRegistry, optional
+            Registry the breaker metrics are created in, labelled with name
+        name : str, optional
+            Name of the protected service in the metrics and errors
+        labels : dict, optional
+            Further labels of the metrics, e.g. the account of the calls
+        clock : callable, optional
+            Monotonic clock in seconds (default: time.monotonic)
+        """
+        self._failureThreshold = max(1, failureThreshold)
+        self._resetSec = resetSec
+        self._name = name
+        self._clock = clock
+        self._state = self.STATE_CLOSED
+        self._failures = 0
+        self._openedTime = None
+        self._openedAt = None
+        self._probing = False
+        self._lastError = None
+        
+        metrics = metrics if metrics is not None else MetricsRegistry()
+        labels = dict(labels or {}, breaker=name)
+        self._rejected = metrics.counter(
+            'circuit_breaker_rejected_total', 'Calls rejected by an open circuit', **labels)
+        self._opened = metrics.counter(
+            'circuit_breaker_opened_total', 'Times the circuit opened', **labels)
+        stateGauge = metrics.gauge(
+            'circuit_breaker_state', 'Circuit state: 0 closed, 1 half open, 2 open', **labels)
+        stateGauge.setFunction(lambda: self._STATE_VALUES[self.state()])
+    
+    def state(self):
+        """Current state: closed, open or half_open."""
+        if self._state == self.STATE_OPEN and self._clock() - self._openedTime >= self._resetSec:
+            return self.STATE_HALF_OPEN
+        return self._state
+    
+    def allow(self):
+        """Check that a call can be made, to be followed by success(), failure() or release().
+        
+        Returns
+        -------
+        bool
+            True if the call is the probe of a half-open circuit, to be
+            passed to release()
+        
+        Raises
+        ------
+        CircuitOpenError
+            If the circuit is open, or half-open with a probe in progress
+        """
+        state = self.state()
+        if state == self.STATE_CLOSED:
+            return False
+        if state == self.STATE_HALF_OPEN and not self._probing:
+            self._state = self.STATE_HALF_OPEN
+            self._probing = True
+            return True
+        self._rejected.inc()
+        raise CircuitOpenError(
+            f"{self._name} unavailable, circuit open after {self._failures} consecutive failures "
+            f"(last error: {self._lastError}), retrying in {self._retryInSec():.0f}s")
+    
+    def success(self):
+        """Record a successful call, closing the circuit."""
+        self._state = self.STATE_CLOSED
+        self._failures = 0
+        self._probing = False
+        self._openedTime = self._openedAt = None
+    
+    def failure(self, error=None):
+        """Record a failed or timed out call, opening the circuit at the threshold."""
+        self._failures += 1
+        self._lastError = (str(error) or type(error).__name__) if error is not None else None
+        if self._probing or self._failures >= self._failureThreshold:
+            if self._state != self.STATE_OPEN:
+                self._opened.inc()
+            self._state = self.STATE_OPEN
+            self._openedTime = self._clock()
+            self._openedAt = time.time()
+        self._probing = False
+    
+    def release(self, probe):
+        """Record a call that neither succeeded nor failed, e.g. cancelled.
+        
+        Parameters
+        ----------
+        probe : bool
+            Value returned by allow() for the call: only the release of the
+            probe lets another probe through
+        """
+        if probe:
+            self._probing = False
+    
+    def _retryInSec(self):
+        if self._openedTime is None:
+            return 0.0
+        return max(0.0, self._resetSec - (self._clock() - self._openedTime))
+    
+    def stats(self):
+        """Get the state of the breaker.
+        
+        Returns
+        -------
+        dict
+            State, consecutive failures, threshold, reset time, wall clock
+            time the circuit opened (None if closed) and last error
+        """
+        return {
+            'state': self.state(),
+            'consecutive_failures': self._failures,
+            'failure_threshold': self._failureThreshold,
+            'reset_sec': self._resetSec,
+            'opened_at': self._openedAt,
+            'last_error': self._lastError
+        }
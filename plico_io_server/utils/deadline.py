@@ -0,0 +1,86 @@
+import time
+
+
+class DeadlineExceeded(Exception):
+    """Raised instead of doing work whose deadline has passed."""
+
+
+def deadlineAfter(timeoutSec):
+    """Get the deadline of a request the client waits timeoutSec seconds for.
+    
+    Clients send the time they are still waiting rather than a wall clock
+    deadline, so that the clocks of client and server need not agree: the
+    timeout is converted to a monotonic deadline when the request arrives.
+    
+    Parameters
+    ----------
+    timeoutSec : float or None
+        Seconds the client waits for the answer, None for no deadline
+    
+    Returns
+    -------
+    float or None
+        Monotonic time, as returned by time.monotonic(), after which the
+        client is no longer waiting, None without a timeout
+    """
+    if timeoutSec is None:
+        return None
+    return time.monotonic() + timeoutSec
+
+
+def timeLeft(deadline):
+    """Get the time left before a deadline.
+    
+    Parameters
+    ----------
+    deadline : float or None
+        Monotonic time, as returned by time.monotonic(), after which the
+        caller is no longer waiting for the result
+    
+    Returns
+    -------
+    float or None
+        Seconds left, negative once the deadline passed, None without a
+        deadline
+    """
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def checkDeadline(deadline, what='request'):
+    """Raise DeadlineExceeded if a deadline has passed.
+    
+    Parameters
+    ----------
+    deadline : float or None
+        Monotonic deadline, None for no deadline
+    what : str, optional
+        Description of the work in the error message
+    """
+    left = timeLeft(deadline)
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Deadline of the {what} exceeded by {-left:.3f}s")
+
+
+def boundTimeout(timeoutSec, deadline):
+    """Shorten a timeout so that it expires at a deadline at the latest.
+    
+    Parameters
+    ----------
+    timeoutSec : float or None
+        Timeout of the operation, None for no timeout
+    deadline : float or None
+        Monotonic deadline, None for no deadline
+    
+    Returns
+    -------
+    float or None
+        The shorter of the timeout and the time left before the deadline
+    """
+    left = timeLeft(deadline)
+    if left is None:
+        return timeoutSec
+    if timeoutSec is None:
+        return max(0.0, left)
+    return max(0.0, min(timeoutSec, left))
@@ -0,0 +1,123 @@
+import time
+import traceback
+import zmq
+from plico.utils.control_loop import ControlLoop
+
+
+class EventDrivenControlLoop(ControlLoop):
+    """Control loop driven by socket activity instead of a fixed period.
+    
+    Sockets registered with addReader() are served as soon as they become
+    readable, while tasks registered with addPeriodic() run on their own
+    schedule. Incoming requests therefore never wait for the next
+    iteration of a periodic task.
+    """
+    
+    # Upper bound of a single poll, so that termination is noticed quickly
+    MAX_POLL_TIMEOUT_SEC = 1.0
+    
+    def __init__(self, terminable, logger, timeModule=time):
+        """Create an event driven control loop.
+        
+        Parameters
+        ----------
+        terminable : object
+            Object providing isTerminated(); the loop runs until it
+            returns True
+        logger : Logger
+            Logger used to report errors raised by the callbacks
+        timeModule : module, optional
+            Time module (default: time)
+        """
+        self._terminable = terminable
+        self._logger = logger
+        self._timeModule = timeModule
+        self._poller = zmq.Poller()
+        self._readers = {}
+        self._periodicTasks = []
+    
+    def addReader(self, socket, callback):
+        """Call callback() every time socket becomes readable.
+        
+        Parameters
+        ----------
+        socket : zmq.Socket or int
+            Socket or file descriptor to watch
+        callback : callable
+            Function called without arguments
+        """
+        self._poller.register(socket, zmq.POLLIN)
+        self._readers[socket] = callback
+    
+    def removeReader(self, socket):
+        """Stop watching a socket registered with addReader().
+        
+        Parameters
+        ----------
+        socket : zmq.Socket or int
+            Socket or file descriptor to stop watching
+        """
+        if self._readers.pop(socket, None) is not None:
+            self._poller.unregister(socket)
+    
+    def addPeriodic(self, periodSec, callback):
+        """Call callback() every periodSec seconds, starting immediately.
+        
+        Parameters
+        ----------
+        periodSec : float
+            Period between two calls
+        callback : callable
+            Function called without arguments
+        """
+        self._periodicTasks.append(
+            _PeriodicTask(periodSec, callback, self._timeModule.time()))
+    
+    def start(self):
+        """Run the loop until the terminable object is terminated."""
+        while self._isAlive():
+            events = dict(self._poller.poll(self._pollTimeoutMs()))
+            for socket in events:
+                # A callback may have removed the socket in this iteration
+                callback = self._readers.get(socket)
+                if callback is not None:
+                    self._call(callback)
+            now = self._timeModule.time()
+            for task in self._periodicTasks:
+                if task.isDue(now):
+                    task.reschedule(now)
+                    self._call(task.callback)
+    
+    def _pollTimeoutMs(self):
+        timeoutSec = self.MAX_POLL_TIMEOUT_SEC
+        now = self._timeModule.time()
+        for task in self._periodicTasks:
+            timeoutSec = min(timeoutSec, task.nextTime - now)
+        return max(0, int(timeoutSec * 1000))
+    
+    def _call(self, callback):
+        try:
+            callback()
+        except Exception as e:
+            traceback.print_exc()
+            self._logger.error(str(e))
+    
+    def _isAlive(self):
+        return not self._terminable.isTerminated()
+
+
+class _PeriodicTask(object):
+
+    def __init__(self, periodSec, callback, nextTime):
+        self.periodSec = periodSec
+        self.callback = callback
+        self.nextTime = nextTime
+    
+    def isDue(self, now):
+        return now >= self.nextTime
+    
+    def reschedule(self, now):
+        self.nextTime += self.periodSec
+        # Do not try to catch up with missed periods
+        if self.nextTime <= now:
+            self.nextTime = now + self.periodSec
@@ -0,0 +1,132 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from plico.utils.logger import Logger
+from plico_io_server.utils.metrics import MetricsRegistry
+
+
+class EventLoopThread(object):
+    """Asyncio event loop running in a background thread.
+    
+    The loop can be shared by many objects, which schedule their coroutines
+    with run(). While running, the loop measures how late it wakes up a
+    sleeping task (its lag) and counts its pending tasks.
+    
+    A loop blocked by a callback that never returns is reported by
+    stalledSec(), and can be replaced by a new one with restart().
+    """
+    
+    PROBE_PERIOD_SEC = 1.0
+    
+    def __init__(self, name='asyncio', metrics=None):
+        """Create the loop, started by start().
+        
+        Parameters
+        ----------
+        name : str, optional
+            Name of the thread
+        metrics : MetricsRegistry, optional
+            Registry the lag and task metrics are recorded in
+        """
+        if os.name == 'nt':
+            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        self._name = name
+        self._logger = Logger.of(f'EventLoopThread({name})')
+        self._loop = asyncio.new_event_loop()
+        self._thread = None
+        self._monitorFuture = None
+        self._lastTick = None
+        metrics = metrics if metrics is not None else MetricsRegistry()
+        self._lag = metrics.histogram(
+            'event_loop_lag_seconds', 'Delay of the event loop in running a ready callback')
+        self._tasks = metrics.gauge(
+            'event_loop_tasks', 'Tasks pending on the event loop')
+        self._restarts = metrics.counter(
+            'event_loop_restarts_total', 'Stalled event loops replaced by a new one')
+    
+    @property
+    def loop(self):
+        """The asyncio event loop."""
+        return self._loop
+    
+    def isRunning(self):
+        """Check whether the loop is running."""
+        return self._loop.is_running()
+    
+    def start(self):
+        """Start the loop thread, if not started yet."""
+        if self._thread is not None:
+            return
+        self._lastTick = time.monotonic()
+        self._thread = threading.Thread(
+            target=self._run, args=(self._loop,), name=self._name, daemon=True)
+        self._thread.start()
+        self._monitorFuture = self.run(self._monitor())
+    
+    def stalledSec(self):
+        """Seconds the loop has not been running its callbacks, 0 if it is responsive.
+        
+        Returns
+        -------
+        float
+            Time elapsed since the loop should have run its probe, inf if
+            the thread of the loop exited
+        """
+        if self._thread is None:
+            return 0.0
+        if not self._thread.is_alive():
+            return math.inf
+        return max(0.0, time.monotonic() - self._lastTick - 2 * self.PROBE_PERIOD_SEC)
+    
+    def restart(self):
+        """Replace the loop with a new one running in a new thread.
+        
+        The thread of a stalled loop cannot be interrupted: it is abandoned,
+        with the tasks of its loop, and exits if the loop ever unblocks.
+        """
+        self._logger.warn("Replacing the event loop")
+        oldLoop = self._loop
+        oldLoop.call_soon_threadsafe(oldLoop.stop)
+        self._loop = asyncio.new_event_loop()
+        self._thread = None
+        self._monitorFuture = None
+        self._restarts.inc()
+        self.start()
+    
+    def run(self, coroutine):
+        """Schedule a coroutine on the loop from any thread.
+        
+        Returns
+        -------
+        concurrent.futures.Future
+            Future of the result of the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+    
+    def stop(self, timeoutSec=5):
+        """Stop the loop and wait for its thread to exit."""
+        if self._monitorFuture is not None:
+            self._monitorFuture.cancel()
+            self._monitorFuture = None
+        if self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        if self._thread is not None and self._thread.is_alive():
+            self._thread.join(timeout=timeoutSec)
+            if self._thread.is_alive():
+                self._logger.warn("Event loop thread did not terminate cleanly.")
+    
+    def _run(self, loop):
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+    
+    async def _monitor(self):
+        """Measure how late the loop wakes up a sleeping task."""
+        loop = asyncio.get_running_loop()
+        while True:
+            startTime = loop.time()
+            await asyncio.sleep(self.PROBE_PERIOD_SEC)
+            self._lag.observe(max(0.0, loop.time() - startTime - self.PROBE_PERIOD_SEC))
+            self._tasks.set(len(asyncio.all_tasks()))
+            self._lastTick = time.monotonic()
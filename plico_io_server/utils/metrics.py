@@ -0,0 +1,353 @@
+import bisect
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Upper bounds of the default latency buckets, from 1ms to 10s
+DEFAULT_LATENCY_BUCKETS_SEC = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                               0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter(object):
+    """Monotonically increasing value."""
+    
+    __slots__ = ('value', '_lock')
+    
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+    
+    def inc(self, amount=1):
+        """Increase the counter by amount."""
+        with self._lock:
+            self.value += amount
+    
+    def sample(self):
+        return {'value': self.value}
+
+
+class Gauge(object):
+    """Value that can go up and down, or be computed when it is read."""
+    
+    __slots__ = ('value', '_function', '_lock')
+    
+    def __init__(self):
+        self.value = 0
+        self._function = None
+        self._lock = threading.Lock()
+    
+    def set(self, value):
+        """Set the gauge to value."""
+        self.value = value
+    
+    def inc(self, amount=1):
+        """Increase the gauge by amount."""
+        with self._lock:
+            self.value += amount
+    
+    def dec(self, amount=1):
+        """Decrease the gauge by amount."""
+        with self._lock:
+            self.value -= amount
+    
+    def setFunction(self, function):
+        """Compute the value of the gauge calling function() when it is read.
+        
+        Parameters
+        ----------
+        function : callable
+            Function without arguments returning a number, or None when
+            the value is unknown
+        """
+        self._function = function
+    
+    def read(self):
+        """Get the current value of the gauge."""
+        if self._function is not None:
+            return self._function()
+        return self.value
+    
+    def sample(self):
+        return {'value': self.read()}
+
+
+class Histogram(object):
+    """Distribution of observed values in fixed buckets.
+    
+    The buckets are allocated when the histogram is created, so that an
+    observation only increments a counter found by bisection.
+    """
+    
+    __slots__ = ('bounds', 'counts', 'sum', 'count', '_lock')
+    
+    def __init__(self, bounds=DEFAULT_LATENCY_BUCKETS_SEC):
+        self.bounds = tuple(sorted(bounds))
+        # The last bucket collects the values above the highest bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+    
+    def observe(self, value):
+        """Record an observed value."""
+        index = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+    
+    def quantile(self, q):
+        """Estimate the q-quantile, interpolating linearly inside its bucket.
+        
+        Parameters
+        ----------
+        q : float
+            Quantile, between 0 and 1
+        
+        Returns
+        -------
+        float or None
+            Estimated quantile, None if nothing was observed. Values in the
+            overflow bucket are reported as the highest bound.
+        """
+        counts = list(self.counts)
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            if count and cumulative + count >= rank:
+                if index == len(self.bounds):
+                    return self.bounds[-1]
+                lower = self.bounds[index - 1] if index else 0.0
+                return lower + (self.bounds[index] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.bounds[-1]
+    
+    def sample(self):
+        counts = list(self.counts)
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.bounds + (math.inf,), counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        return {
+            'count': cumulative,
+            'sum': self.sum,
+            'buckets': buckets,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99)
+        }
+
+
+class MetricsRegistry(object):
+    """Registry of the metrics of a server process.
+    
+    Metrics are identified by name and labels, and are created once,
+    typically when the instrumented object is built, which then keeps a
+    reference to them: recording a value does not look up the registry or
+    allocate memory, so instrumentation can stay on in production.
+    
+    Every metric has its own lock, so that it can be updated from any
+    thread, e.g. the command outcomes from the RPC threads and the Meross
+    event loop, without losing updates.
+    """
+    
+    _COUNTER = 'counter'
+    _GAUGE = 'gauge'
+    _HISTOGRAM = 'histogram'
+    
+    def __init__(self, prefix=''):
+        """Create an empty registry.
+        
+        Parameters
+        ----------
+        prefix : str, optional
+            Prefix of the metric names in the text exposition
+        """
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        # name -> [type, help, {labels: metric}]
+        self._families = {}
+        self._included = []
+    
+    def counter(self, name, help='', **labels):
+        """Get or create the counter with the given name and labels."""
+        return self._metric(self._COUNTER, name, help, labels, Counter)
+    
+    def gauge(self, name, help='', **labels):
+        """Get or create the gauge with the given name and labels."""
+        return self._metric(self._GAUGE, name, help, labels, Gauge)
+    
+    def histogram(self, name, help='', buckets=DEFAULT_LATENCY_BUCKETS_SEC, **labels):
+        """Get or create the histogram with the given name and labels.
+        
+        Parameters
+        ----------
+        name : str
+            Metric name
+        help : str, optional
+            Description of the metric
+        buckets : sequence of float, optional
+            Upper bounds of the buckets (default: 1ms to 10s)
+        **labels
+            Label values identifying the histogram within the metric
+        """
+        return self._metric(self._HISTOGRAM, name, help, labels,
+                            lambda: Histogram(buckets))
+    
+    def include(self, registry):
+        """Report the metrics of another registry with the ones of this one.
+        
+        Parameters
+        ----------
+        registry : MetricsRegistry
+            Registry of objects shared with other servers of the process,
+            e.g. a cloud session, whose metrics are recorded only once
+        """
+        with self._lock:
+            self._included.append(registry)
+    
+    def _metric(self, metricType, name, help, labels, factory):
+        key = tuple(sorted((label, str(value)) for label, value in labels.items()))
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = [metricType, help, {}]
+            elif family[0] != metricType:
+                raise ValueError(f"Metric '{name}' already registered as a {family[0]}")
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = factory()
+            return metric
+    
+    def snapshot(self):
+        """Get the current value of all the metrics.
+        
+        Returns
+        -------
+        dict
+            For every metric name, its type, help and one sample per set
+            of labels. Histogram samples report count, sum, cumulative
+            bucket counts and the estimated p50/p95/p99.
+        """
+        with self._lock:
+            families = [(name, family[0], family[1], list(family[2].items()))
+                        for name, family in self._families.items()]
+            included = list(self._included)
+        snapshot = {}
+        for name, metricType, help, metrics in families:
+            samples = []
+            for key, metric in metrics:
+                sample = metric.sample()
+                sample['labels'] = dict(key)
+                samples.append(sample)
+            snapshot[name] = {'type': metricType, 'help': help, 'samples': samples}
+        for registry in included:
+            for name, family in registry.snapshot().items():
+                if name in snapshot:
+                    snapshot[name]['samples'].extend(family['samples'])
+                else:
+                    snapshot[name] = family
+        return snapshot
+    
+    def exposition(self):
+        """Format all the metrics in the Prometheus text exposition format.
+        
+        Returns
+        -------
+        str
+            One line per sample, with HELP and TYPE comments per metric
+        """
+        lines = []
+        for name, family in sorted(self.snapshot().items()):
+            name = self._prefix + name
+            if family['help']:
+                lines.append(f"# HELP {name} {family['help']}")
+            lines.append(f"# TYPE {name} {family['type']}")
+            for sample in family['samples']:
+                labels = sample['labels']
+                if family['type'] == self._HISTOGRAM:
+                    for bound, count in sample['buckets'].items():
+                        le = '+Inf' if bound == math.inf else repr(bound)
+                        lines.append(f"{name}_bucket{_formatLabels(labels, le=le)} {count}")
+                    lines.append(f"{name}_sum{_formatLabels(labels)} {sample['sum']}")
+                    lines.append(f"{name}_count{_formatLabels(labels)} {sample['count']}")
+                else:
+                    value = sample['value']
+                    lines.append(f"{name}{_formatLabels(labels)} {'NaN' if value is None else value}")
+        return '\n'.join(lines) + '\n'
+
+
+def _formatLabels(labels, **extra):
+    items = list(labels.items()) + list(extra.items())
+    if not items:
+        return ''
+    return '{' + ','.join(f'{label}="{_escape(value)}"' for label, value in items) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsHttpServer(object):
+    """HTTP server exposing a MetricsRegistry in the text exposition format.
+    
+    Every GET request is answered with the current metrics, whatever the
+    path. The server runs in a daemon thread.
+    """
+    
+    def __init__(self, registry, port, host=''):
+        """Create the server, bound to host:port.
+        
+        Parameters
+        ----------
+        registry : MetricsRegistry
+            Metrics to expose
+        port : int
+            TCP port to listen on, 0 for any free port
+        host : str, optional
+            Address to listen on (default: all interfaces)
+        """
+        class Handler(BaseHTTPRequestHandler):
+            
+            def do_GET(self):
+                body = registry.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def log_message(self, format, *args):
+                pass
+        
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = None
+    
+    @property
+    def host(self):
+        """Address the server listens on."""
+        return self._server.server_address[0]
+    
+    @property
+    def port(self):
+        """Port the server listens on."""
+        return self._server.server_address[1]
+    
+    def start(self):
+        """Serve the metrics in background."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+    
+    def stop(self):
+        """Stop serving and close the socket."""
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
@@ -0,0 +1,181 @@
+import asyncio
+import heapq
+import itertools
+import time
+from plico_io_server.utils.metrics import MetricsRegistry
+
+
+class RateLimiter(object):
+    """Token bucket limiting the rate of the calls to a remote service.
+    
+    Tokens accumulate at the current rate up to burst, and every call
+    takes one. Calls that find the bucket empty wait in priority order,
+    so that e.g. user commands overtake status refreshes.
+    
+    The rate adapts to the service: throttled() is called when the service
+    answers that it is receiving too many requests, which divides the rate
+    by backoffFactor (down to minRatePerSec) and empties the bucket. The
+    rate then grows back linearly by recoveryPerSec every second, up to
+    the configured ratePerSec.
+    
+    The limiter must be used from a single asyncio event loop, while
+    stats() can be read from any thread.
+    """
+    
+    PRIORITY_COMMAND = 0
+    PRIORITY_REFRESH = 1
+    PRIORITY_BACKGROUND = 2
+    
+    _PRIORITY_NAMES = {PRIORITY_COMMAND: 'command',
+                       PRIORITY_REFRESH: 'refresh',
+                       PRIORITY_BACKGROUND: 'background'}
+    
+    def __init__(self, ratePerSec, burst=1, minRatePerSec=None, backoffFactor=2.0,
+                 recoveryPerSec=None, metrics=None, name='cloud', labels=None,
+                 clock=time.monotonic):
+        """Create a rate limiter with a full bucket.
+        
+        Parameters
+        ----------
+        ratePerSec : float
+            Maximum sustained rate of the calls
+        burst : int, optional
+            Calls that can be done at once after an idle period (default: 1)
+        minRatePerSec : float, optional
+            Lowest rate reached backing off (default: ratePerSec / 16)
+        backoffFactor : float, optional
+            Division of the rate at every throttling error (default: 2)
+        recoveryPerSec : float, optional
+            Rate increase per second after a backoff (default: the rate
+            is back to ratePerSec 30s after a single backoff)
+        metrics : MetricsRegistry, optional
+            Registry the limiter metrics are created in, labelled with name
+        name : str, optional
+            Name of the limited service in the metrics
+        labels : dict, optional
+            Further labels of the metrics, e.g. the account of the calls
+        clock : callable, optional
+            Monotonic clock in seconds (default: time.monotonic)
+        """
+        self._maxRate = float(ratePerSec)
+        self._minRate = minRatePerSec if minRatePerSec is not None else self._maxRate / 16
+        self._backoffFactor = backoffFactor
+        self._recoveryPerSec = (recoveryPerSec if recoveryPerSec is not None
+                                else self._maxRate * (1 - 1 / backoffFactor) / 30)
+        self._burst = max(1, burst)
+        self._clock = clock
+        self._tokens = float(self._burst)
+        self._updateTime = clock()
+        self._backoffRate = self._maxRate
+        self._backoffTime = self._updateTime
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._wakeUp = None
+        
+        metrics = metrics if metrics is not None else MetricsRegistry()
+        labels = dict(labels or {}, limiter=name)
+        self._waitTime = {
+            priority: metrics.histogram('rate_limiter_wait_seconds',
+                                        'Time spent waiting for a token',
+                                        priority=priorityName, **labels)
+            for priority, priorityName in self._PRIORITY_NAMES.items()}
+        self._delayed = metrics.counter(
+            'rate_limiter_delayed_total', 'Calls that waited for a token', **labels)
+        self._throttled = metrics.counter(
+            'rate_limiter_throttled_total', 'Throttling errors returned by the service', **labels)
+        self._waiting = metrics.gauge(
+            'rate_limiter_waiting', 'Calls waiting for a token', **labels)
+        self._waiting.setFunction(lambda: len(self._waiters))
+        self._rateGauge = metrics.gauge(
+            'rate_limiter_rate_per_sec', 'Current rate limit', **labels)
+        self._rateGauge.setFunction(self.rate)
+    
+    def rate(self):
+        """Current rate limit, in calls per second."""
+        elapsed = self._clock() - self._backoffTime
+        return min(self._maxRate, self._backoffRate + self._recoveryPerSec * elapsed)
+    
+    async def acquire(self, priority=PRIORITY_BACKGROUND):
+        """Wait for a token.
+        
+        Parameters
+        ----------
+        priority : int, optional
+            Lower values are served first (default: PRIORITY_BACKGROUND)
+        
+        Returns
+        -------
+        float
+            Seconds spent waiting
+        """
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        
+        loop = asyncio.get_running_loop()
+        startTime = self._clock()
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._delayed.inc()
+        self._schedule(loop)
+        await future
+        waited = self._clock() - startTime
+        self._waitTime.get(priority, self._waitTime[self.PRIORITY_BACKGROUND]).observe(waited)
+        return waited
+    
+    def throttled(self):
+        """Back off after the service rejected a call for exceeding its rate."""
+        self._refill()
+        self._backoffRate = max(self._minRate, self.rate() / self._backoffFactor)
+        self._backoffTime = self._clock()
+        self._tokens = min(self._tokens, 0.0)
+        self._throttled.inc()
+    
+    def reset(self):
+        """Forget the waiting calls, e.g. when their event loop was replaced."""
+        self._waiters = []
+        self._wakeUp = None
+    
+    def stats(self):
+        """Get the state and the counters of the limiter.
+        
+        Returns
+        -------
+        dict
+            Current and maximum rate, available tokens, waiting calls,
+            delayed calls and throttling errors
+        """
+        rate = self.rate()
+        tokens = min(self._burst, self._tokens + (self._clock() - self._updateTime) * rate)
+        return {
+            'rate_per_sec': rate,
+            'max_rate_per_sec': self._maxRate,
+            'tokens': tokens,
+            'waiting': len(self._waiters),
+            'delayed': self._delayed.value,
+            'throttled': self._throttled.value
+        }
+    
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self._burst, self._tokens + (now - self._updateTime) * self.rate())
+        self._updateTime = now
+    
+    def _schedule(self, loop):
+        """Wake up the first waiter when its token is available."""
+        if self._wakeUp is not None or not self._waiters:
+            return
+        delay = max(0.0, (1 - self._tokens) / self.rate())
+        self._wakeUp = loop.call_later(delay, self._release, loop)
+    
+    def _release(self, loop):
+        self._wakeUp = None
+        self._refill()
+        while self._waiters and self._tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            # Skip the callers that stopped waiting
+            if not future.done():
+                self._tokens -= 1
+                future.set_result(None)
+        self._schedule(loop)
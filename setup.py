@@ -27,8 +27,14 @@ setup(
         'console_scripts': [
             'plico_io_start=plico_io_server.process_monitor.process_monitor_start:main',
             'plico_io_server=plico_io_server.scripts.controller_start:main',
+            'plico_io_multi_server=plico_io_server.scripts.multi_controller_start:main',
             'plico_io_stop=plico_io_server.scripts.io_stop:main',
             'plico_io_monitor_start=plico_io_server.process_monitor.process_monitor_start:main',
+            'plico_io_fake_meross_cloud=plico_io_server.scripts.fake_meross_cloud_start:main',
+            'plico_io_controller_benchmark=plico_io_server.scripts.controller_benchmark:main',
+        ],
+        'plico_io_server.drivers': [
+            'meross=plico_io_server.devices.meross_driver:create_controller',
         ],
     }
 )
\ No newline at end of file
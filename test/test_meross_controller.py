@@ -0,0 +1,115 @@
+import asyncio
+import threading
+import time
+import pytest
+from plico_io_server.devices.fake_meross_cloud import FakeMerossCloud, create_plugs, generate_certificate
+from plico_io_server.devices.meross_controller import MerossController
+
+EMAIL = 'user@example.com'
+PASSWORD = 'secret'
+
+
+@pytest.fixture(scope='module')
+def certificate(tmp_path_factory):
+    return generate_certificate(str(tmp_path_factory.mktemp('certificate')))
+
+
+@pytest.fixture(scope='module')
+def loop():
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield loop
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+@pytest.fixture
+def cloud(loop, certificate):
+    cert_file, key_file = certificate
+    cloud = FakeMerossCloud(EMAIL, PASSWORD, create_plugs(['mss310:1:1']),
+                            cert_file=cert_file, key_file=key_file, seed=0)
+    asyncio.run_coroutine_threadsafe(cloud.start(), loop).result()
+    yield cloud
+    asyncio.run_coroutine_threadsafe(cloud.stop(), loop).result()
+
+
+def start_controller(cloud, **kwargs):
+    controller = MerossController(
+        name='test', email=EMAIL, password=PASSWORD,
+        api_base_url=cloud.api_base_url, mqtt_override_server=cloud.mqtt_address,
+        mqtt_ca_cert=cloud.cert_file, rate_limit_per_sec=0, **kwargs)
+    deadline = time.monotonic() + 30
+    while controller.getStatus()['state'] != MerossController.STATE_READY:
+        assert time.monotonic() < deadline, "controller not ready"
+        time.sleep(0.1)
+    return controller
+
+
+@pytest.fixture
+def controller(cloud):
+    controller = start_controller(cloud)
+    yield controller
+    controller.deinitialize()
+
+
+def test_turn_on_and_off_reach_the_cloud(cloud, controller):
+    plug = cloud.plugs()[0]
+    commands = cloud.command_count
+    assert controller.turnOn(force=True)
+    assert plug.states == [True]
+    assert controller.turnOff(force=True)
+    assert plug.states == [False]
+    assert cloud.command_count == commands + 2
+
+
+def test_commands_for_the_same_channel_are_coalesced(cloud, controller):
+    plug = cloud.plugs()[0]
+    cloud._latency_sec = 0.5
+    commands = cloud.command_count
+    results = {}
+
+    def switch(index, on):
+        results[index] = controller.setState(state=on, force=True)
+
+    threads = []
+    for index, on in enumerate([True, False, True]):
+        thread = threading.Thread(target=switch, args=(index, on))
+        thread.start()
+        threads.append(thread)
+        # The first command is in flight when the others are queued
+        time.sleep(0.1)
+    for thread in threads:
+        thread.join()
+
+    outcomes = [results[index]['outcome'] for index in range(3)]
+    assert outcomes == [MerossController.COMMAND_SENT, MerossController.COMMAND_COALESCED,
+                        MerossController.COMMAND_SENT]
+    assert all(result['success'] for result in results.values())
+    assert cloud.command_count == commands + 2
+    assert plug.states == [True]
+
+
+def test_circuit_breaker_opens_and_recovers(cloud):
+    controller = start_controller(cloud, command_timeout_sec=0.5, breaker_failure_threshold=2,
+                                  breaker_reset_sec=1)
+    try:
+        cloud._drop_rate = 1.0
+        for _ in range(2):
+            assert not controller.setState(state=True, force=True)['success']
+        assert controller.getStatus()['circuit_breaker']['state'] == 'open'
+        commands = cloud.command_count
+        started = time.monotonic()
+        result = controller.setState(state=True, force=True)
+        assert not result['success']
+        assert time.monotonic() - started < 0.5
+        assert cloud.command_count == commands
+
+        cloud._drop_rate = 0.0
+        time.sleep(1.2)
+        assert controller.setState(state=True, force=True)['success']
+        assert cloud.plugs()[0].states == [True]
+        assert controller.getStatus()['circuit_breaker']['state'] == 'closed'
+    finally:
+        controller.deinitialize()